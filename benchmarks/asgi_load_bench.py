@@ -0,0 +1,169 @@
+"""
+Compares serving the API with gunicorn sync workers against uvicorn running
+the ASGI entry point, while a number of clients hold idle connections open
+the way displays keep their keep-alive connections. Active clients fetch a
+widget and the latency of every request is recorded; requests that take
+longer than TIMEOUT seconds count as failed. Needs gunicorn and uvicorn.
+Run from the repository root with:
+
+    python -m benchmarks.asgi_load_bench
+"""
+
+import asyncio
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+SYNC_WORKERS = 2
+ASGI_WORKERS = 1
+IDLE = (0, 1000)
+REQUESTS = 400
+CONCURRENCY = 20
+TIMEOUT = 3.0
+PATH = "/api/widgets/1/"
+
+
+def _config():
+    directory = os.environ["NAUTTO_BENCH_DIR"]
+    return {
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(directory, "bench.db"),
+        "METRICS_DIR": directory,
+        "BLOB_DIR": directory,
+    }
+
+
+def wsgi_app():
+    from nautto import create_app
+    return create_app(_config())
+
+
+def asgi_app():
+    from nautto.asgi import create_asgi_app
+    return create_asgi_app(_config())
+
+
+def _populate():
+    from nautto import db
+    from nautto.models import User, Widget
+
+    app = wsgi_app()
+    with app.app_context():
+        db.create_all()
+        user = User(name="benchmark")
+        db.session.add(Widget(name="clock", type="HTML", content="<p>12:00</p>", user=user))
+        db.session.commit()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _server(mode, port):
+    if mode == "sync":
+        command = [
+            sys.executable, "-m", "gunicorn", "-w", str(SYNC_WORKERS),
+            "-b", f'127.0.0.1:{port}', "benchmarks.asgi_load_bench:wsgi_app()",
+        ]
+    else:
+        command = [
+            sys.executable, "-m", "uvicorn", "--factory", "--workers", str(ASGI_WORKERS),
+            "--port", str(port), "--log-level", "warning", "--no-access-log",
+            "benchmarks.asgi_load_bench:asgi_app",
+        ]
+    process = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", port), 0.1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError(f'{mode} server did not start')
+
+
+async def _fetch(port):
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    try:
+        writer.write(
+            f'GET {PATH} HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n'.encode()
+        )
+        await writer.drain()
+        response = await reader.read()
+        return response.startswith(b"HTTP/1.1 200")
+    finally:
+        writer.close()
+
+
+async def _load(port, idle):
+    connections = []
+    for _ in range(idle):
+        # connected but silent, like a display between polls
+        connections.append(await asyncio.open_connection("127.0.0.1", port))
+
+    latencies = []
+    failures = 0
+    pending = iter(range(REQUESTS))
+
+    async def client():
+        nonlocal failures
+        for _ in pending:
+            start = time.perf_counter()
+            try:
+                ok = await asyncio.wait_for(_fetch(port), TIMEOUT)
+            except (asyncio.TimeoutError, OSError):
+                ok = False
+            if ok:
+                latencies.append(time.perf_counter() - start)
+            else:
+                failures += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(CONCURRENCY)])
+    elapsed = time.perf_counter() - start
+    for _, writer in connections:
+        writer.close()
+    return sorted(latencies), failures, elapsed
+
+
+def _percentile(values, share):
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * share))] * 1000
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    os.environ["NAUTTO_BENCH_DIR"] = directory
+    _populate()
+
+    print(f'{REQUESTS} requests from {CONCURRENCY} clients, {TIMEOUT:.0f} s timeout')
+    print(f'{"mode":<22} {"idle":>5} {"p50 ms":>8} {"p99 ms":>8} {"failed":>7} {"req/s":>7} {"conns/worker":>13}')
+    for mode, workers in (("sync", SYNC_WORKERS), ("asgi", ASGI_WORKERS)):
+        for idle in IDLE:
+            port = _free_port()
+            server = _server(mode, port)
+            try:
+                latencies, failures, elapsed = asyncio.run(_load(port, idle))
+            finally:
+                server.terminate()
+                server.wait()
+            # connections open at once, idle ones plus the active clients,
+            # per worker, counted only if the active requests got through
+            held = (idle + CONCURRENCY) / workers if not failures else float("nan")
+            label = f'{mode} ({workers} worker{"s" if workers > 1 else ""})'
+            print(
+                f'{label:<22} {idle:>5} {_percentile(latencies, 0.5):>8.1f} '
+                f'{_percentile(latencies, 0.99):>8.1f} {failures:>7} '
+                f'{len(latencies) / elapsed:>7.0f} {held:>13.0f}'
+            )
+    shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,64 @@
+"""
+Compares creating widgets with one POST per widget against a single bulk
+POST of all of them, on a file backed SQLite database so that every commit
+pays for its sync. Run from the repository root with:
+
+    python -m benchmarks.bulk_create_bench
+"""
+
+import os
+import shutil
+import tempfile
+import time
+
+from nautto import create_app, db
+from nautto.models import User
+
+SINGLE = 500
+BULK = 20000
+
+
+def _document(number):
+    return {
+        "name": f'widget-{number}',
+        "description": "benchmark widget",
+        "type": "HTML",
+        "content": "<h1> Hello </h1>" * 10,
+    }
+
+
+def main():
+    db_fd, db_fname = tempfile.mkstemp()
+    metrics_dir = tempfile.mkdtemp()
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "METRICS_DIR": metrics_dir,
+    })
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(name="benchmark"))
+        db.session.commit()
+    client = app.test_client()
+
+    start = time.perf_counter()
+    for number in range(SINGLE):
+        client.post("/api/users/1/widgets/", json=_document(number))
+    single = SINGLE / (time.perf_counter() - start)
+
+    documents = [_document(number) for number in range(BULK)]
+    start = time.perf_counter()
+    resp = client.post("/api/users/1/widgets/", json=documents)
+    resp.get_data()
+    bulk = BULK / (time.perf_counter() - start)
+    assert resp.status_code == 201
+
+    os.close(db_fd)
+    os.unlink(db_fname)
+    shutil.rmtree(metrics_dir)
+    print(f'one POST per widget: {single:.0f} widgets/s')
+    print(f'bulk POST:           {bulk:.0f} widgets/s')
+    print(f'speedup:             {bulk / single:.1f}x')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+"""
+Measures small writes per second with group commit off and with windows of
+a few milliseconds. THREADS clients each create widgets for DURATION
+seconds, in one process as under a threaded server, with both SQLite
+profiles: the safe one syncs every commit to disk, the performance one
+only at WAL checkpoints. Run from the repository root with:
+
+    python -m benchmarks.group_commit_bench
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from sqlalchemy import event
+
+from nautto import create_app, db
+from nautto.models import User
+
+THREADS = 16
+DURATION = 3.0
+WINDOWS = (0, 0.001, 0.002, 0.005, 0.01)
+PROFILES = ("safe", "performance")
+
+
+def _app(directory, profile, window):
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(directory, "bench.db"),
+        "METRICS_DIR": directory,
+        "BLOB_DIR": directory,
+        "SQLITE_PROFILE": profile,
+        "GROUP_COMMIT_WINDOW": window,
+        # lets lock timeouts show up as failed requests
+        "PROPAGATE_EXCEPTIONS": False,
+    })
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(name="benchmark"))
+        db.session.commit()
+    return app
+
+
+def _run(app):
+    stop = time.perf_counter() + DURATION
+    latencies = []
+    failures = [0]
+    lock = threading.Lock()
+
+    def client(number):
+        http = app.test_client()
+        count = 0
+        while time.perf_counter() < stop:
+            count += 1
+            start = time.perf_counter()
+            resp = http.post("/api/users/1/widgets/", json={
+                "name": f'widget-{number}-{count}', "type": "HTML", "content": "<p>hi</p>",
+            })
+            with lock:
+                if resp.status_code == 201:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    failures[0] += 1
+
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    latencies.sort()
+    return latencies, failures[0]
+
+
+def main():
+    print(f'{THREADS} threads creating widgets for {DURATION:.0f} s')
+    print(f'{"profile":<12} {"window ms":>9} {"writes/s":>9} {"p50 ms":>8} {"p99 ms":>8} {"failed":>7} {"per commit":>10}')
+    for profile in PROFILES:
+        for window in WINDOWS:
+            directory = tempfile.mkdtemp()
+            try:
+                app = _app(directory, profile, window)
+                committer = app.extensions.get("group_commit")
+                with app.app_context():
+                    engine = committer.engine if committer else db.get_engine()
+                commits = []
+                event.listen(engine, "commit", commits.append)
+                latencies, failures = _run(app)
+                if committer is not None:
+                    committer.connection.close()
+            finally:
+                shutil.rmtree(directory)
+            p50 = latencies[len(latencies) // 2] * 1000 if latencies else float("nan")
+            p99 = latencies[int(len(latencies) * 0.99)] * 1000 if latencies else float("nan")
+            print(
+                f'{profile:<12} {window * 1000:>9g} {len(latencies) / DURATION:>9.0f} '
+                f'{p50:>8.1f} {p99:>8.1f} {failures:>7} '
+                f'{len(latencies) / max(len(commits), 1):>10.1f}'
+            )
+
+
+if __name__ == "__main__":
+    main()
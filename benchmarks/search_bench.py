@@ -0,0 +1,105 @@
+"""
+Times full-text searches of the widget collection on a database of a
+million widgets, against filtering the same rows with LIKE. The widgets
+are written with core inserts, so the search index is filled by the same
+triggers that keep it up to date in production. Run from the repository
+root with:
+
+    python -m benchmarks.search_bench [widgets]
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from sqlalchemy import select
+
+from nautto import create_app, db
+from nautto.models import User, Widget, store_contents
+
+WIDGETS = 1000000
+BATCH = 20000
+WORDS = [f'word{number}' for number in range(20000)]
+QUERIES = {
+    # a couple of thousand matches in a million widgets
+    "rare word": "word17",
+    "two words": "word17 word42",
+    "prefix": "word1234*",
+}
+REPEAT = 20
+
+
+def _fill(app, count):
+    rng = random.Random(1)
+    with app.app_context():
+        connection = db.session.connection()
+        user = User(name="benchmark")
+        db.session.add(user)
+        db.session.flush()
+        contents = [" ".join(rng.choices(WORDS, k=30)) for _ in range(1000)]
+        hashes = store_contents(db.session, contents)
+        table = Widget.__table__
+        for start in range(0, count, BATCH):
+            connection.execute(table.insert(), [
+                {
+                    "id": number + 1,
+                    "name": " ".join(rng.choices(WORDS, k=3)),
+                    "description": " ".join(rng.choices(WORDS, k=8)),
+                    "type": "HTML",
+                    "content_hash": rng.choice(hashes),
+                    "user_id": user.id,
+                    "version": 1,
+                }
+                for number in range(start, min(start + BATCH, count))
+            ])
+        db.session.commit()
+
+
+def _time(client, url):
+    resp = client.get(url)
+    resp.get_data()
+    assert resp.status_code == 200, resp.status_code
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        client.get(url).get_data()
+    return (time.perf_counter() - start) / REPEAT * 1000
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else WIDGETS
+    db_fd, db_fname = tempfile.mkstemp()
+    directory = tempfile.mkdtemp()
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "METRICS_DIR": directory,
+        "BLOB_DIR": directory,
+    })
+    with app.app_context():
+        db.create_all()
+    start = time.perf_counter()
+    _fill(app, count)
+    print(f'{count} widgets written and indexed in {time.perf_counter() - start:.0f} s')
+
+    client = app.test_client()
+    for label, query in QUERIES.items():
+        search = _time(client, f'/api/widgets/?q={query}&limit=50')
+        print(f'{label + ":":<12} {search:8.1f} ms')
+    word = QUERIES["rare word"]
+    with app.app_context():
+        like = Widget.__table__.c.name.like(f'%{word} %')
+        start = time.perf_counter()
+        db.session.execute(select([Widget.__table__.c.id]).where(like).limit(50)).fetchall()
+        print(f'{"LIKE scan:":<12} {(time.perf_counter() - start) * 1000:8.1f} ms (name only)')
+
+    os.close(db_fd)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_fname + suffix):
+            os.unlink(db_fname + suffix)
+    shutil.rmtree(directory)
+
+
+if __name__ == "__main__":
+    main()
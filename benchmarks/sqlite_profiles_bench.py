@@ -0,0 +1,113 @@
+"""
+Compares the SQLite pragma profiles under concurrent worker processes, the
+way gunicorn runs the application. Every worker has an application of its
+own on a shared database file and serves a mix of widget reads and creates
+for a fixed time. Run from the repository root with:
+
+    python -m benchmarks.sqlite_profiles_bench
+"""
+
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from nautto import create_app, db
+from nautto.models import User, Widget
+
+WORKERS = 4
+DURATION = 5.0
+# one write for every WRITE_EVERY requests
+WRITE_EVERY = 5
+PROFILES = {
+    "safe": {"SQLITE_PROFILE": "safe"},
+    # the same pragmas without a busy timeout, so workers fail on locks
+    "safe, no timeout": {"SQLITE_PROFILE": "safe", "SQLITE_PRAGMAS": {"busy_timeout": 0}},
+    "performance": {"SQLITE_PROFILE": "performance"},
+}
+
+
+def _config(db_fname, directory, profile):
+    config = dict(PROFILES[profile])
+    config.update({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "METRICS_DIR": directory,
+        "BLOB_DIR": directory,
+        # lock errors reach the worker instead of becoming 500 responses
+        "PROPAGATE_EXCEPTIONS": True,
+    })
+    return config
+
+
+def _worker(db_fname, directory, profile, results):
+    app = create_app(_config(db_fname, directory, profile))
+    client = app.test_client()
+    reads = writes = locked = 0
+    number = 0
+    deadline = time.perf_counter() + DURATION
+    while time.perf_counter() < deadline:
+        number += 1
+        try:
+            if number % WRITE_EVERY:
+                resp = client.get("/api/widgets/1/")
+                resp.get_data()
+                reads += resp.status_code == 200
+            else:
+                resp = client.post("/api/users/1/widgets/", json={
+                    "name": f'widget-{os.getpid()}-{number}',
+                    "type": "HTML",
+                    "content": "<h1> Hello </h1>",
+                })
+                writes += resp.status_code == 201
+        except Exception as e:
+            if "database is locked" not in str(e):
+                raise
+            locked += 1
+            with app.app_context():
+                db.session.rollback()
+    results.put((reads, writes, locked))
+
+
+def run(profile):
+    db_fd, db_fname = tempfile.mkstemp()
+    directory = tempfile.mkdtemp()
+    app = create_app(_config(db_fname, directory, profile))
+    with app.app_context():
+        db.create_all()
+        user = User(name="benchmark")
+        db.session.add(user)
+        db.session.add(Widget(name="widget", type="HTML", content="<p></p>", user=user))
+        db.session.commit()
+        db.session.remove()
+    db.get_engine(app).dispose()
+
+    results = multiprocessing.Queue()
+    workers = [
+        multiprocessing.Process(target=_worker, args=(db_fname, directory, profile, results))
+        for _ in range(WORKERS)
+    ]
+    for worker in workers:
+        worker.start()
+    totals = [sum(column) for column in zip(*(results.get() for _ in workers))]
+    for worker in workers:
+        worker.join()
+
+    os.close(db_fd)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(db_fname + suffix):
+            os.unlink(db_fname + suffix)
+    shutil.rmtree(directory)
+    return totals
+
+
+def main():
+    print(f'{WORKERS} workers, {DURATION:.0f} s, one write per {WRITE_EVERY} requests')
+    print(f'{"profile":<18} {"reads/s":>9} {"writes/s":>9} {"locked":>7}')
+    for profile in PROFILES:
+        reads, writes, locked = run(profile)
+        print(f'{profile:<18} {reads / DURATION:>9.0f} {writes / DURATION:>9.0f} {locked:>7}')
+
+
+if __name__ == "__main__":
+    main()
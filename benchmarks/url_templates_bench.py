@@ -0,0 +1,44 @@
+"""
+Compares building item hrefs with url_for and with the precompiled URL
+templates of nautto.urls. Run from the repository root with:
+
+    python -m benchmarks.url_templates_bench
+"""
+
+import timeit
+
+from flask import url_for
+
+from nautto import create_app
+from nautto.urls import url_template
+
+ITEMS = 100000
+
+
+def main():
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+    with app.test_request_context("/api/widgets/"):
+        def with_url_for():
+            for number in range(ITEMS):
+                url_for("api.widgetoflayout", layout=1, widget=number)
+
+        def with_template():
+            build = url_template("api.widgetoflayout")
+            for number in range(ITEMS):
+                build(layout=1, widget=number)
+
+        for number in range(ITEMS):
+            assert (
+                url_template("api.widgetoflayout")(layout=1, widget=number)
+                == url_for("api.widgetoflayout", layout=1, widget=number)
+            )
+
+        baseline = min(timeit.repeat(with_url_for, number=1, repeat=3))
+        compiled = min(timeit.repeat(with_template, number=1, repeat=3))
+    print(f'url_for:      {baseline:.3f} s for {ITEMS} items')
+    print(f'url_template: {compiled:.3f} s for {ITEMS} items')
+    print(f'speedup:      {baseline / compiled:.1f}x')
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+"""
+Compares validating widget documents with jsonschema.validate against the
+validators compiled at app start by nautto.validation. Run from the
+repository root with:
+
+    python -m benchmarks.validation_bench
+"""
+
+import timeit
+
+import jsonschema
+
+from nautto import create_app
+from nautto.models import Widget
+from nautto.validation import validate
+
+DOCUMENTS = 20000
+
+
+def main():
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+    document = {
+        "name": "widget",
+        "description": "benchmark widget",
+        "type": "HTML",
+        "content": "<h1> Hello </h1>" * 100,
+    }
+    with app.app_context():
+        def uncompiled():
+            for _ in range(DOCUMENTS):
+                jsonschema.validate(document, Widget.get_schema())
+
+        def compiled():
+            for _ in range(DOCUMENTS):
+                validate(document, Widget)
+
+        baseline = min(timeit.repeat(uncompiled, number=1, repeat=3))
+        cached = min(timeit.repeat(compiled, number=1, repeat=3))
+    print(f'jsonschema.validate: {DOCUMENTS / baseline:.0f} documents/s')
+    print(f'compiled validator:  {DOCUMENTS / cached:.0f} documents/s')
+    print(f'speedup:             {baseline / cached:.1f}x')
+
+
+if __name__ == "__main__":
+    main()
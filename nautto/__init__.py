@@ -1,12 +1,10 @@
 import os
 import json
 
-from flask import Flask, Response, url_for
+from flask import Flask, Response, request, url_for
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.engine import Engine
-from sqlalchemy import event
 
-from nautto.utils import NauttoBuilder
+from nautto.utils import NauttoBuilder, create_error_response
 from nautto.constants import *
 
 db = SQLAlchemy()
@@ -22,7 +20,12 @@ def create_app(test_config=None):
         SECRET_KEY="dev",
         SQLALCHEMY_DATABASE_URI="sqlite:///" +
         os.path.join(app.instance_path, "development.db"),
-        SQLALCHEMY_TRACK_MODIFICATIONS=False
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        SCHEMA_MODE=SCHEMA_INLINE,
+        REPRESENTATION_CACHE_SIZE=REPRESENTATION_CACHE_SIZE,
+        SERVER_TIMING=False,
+        BLOB_INLINE_MAX=BLOB_INLINE_MAX,
+        SQLITE_PROFILE=SQLITE_PROFILE
     )
 
     if test_config is not None:
@@ -35,20 +38,24 @@ def create_app(test_config=None):
 
     db.init_app(app)
 
-    # Force foreing key usage
-    @event.listens_for(Engine, "connect")
-    def set_sqlite_pragma(dbapi_connection, connection_record):
-        cursor = dbapi_connection.cursor()
-        cursor.execute("PRAGMA foreign_keys=ON")
-        cursor.close()
+    from . import pragmas
+    pragmas.init_app(app)
 
     from . import models
     app.cli.add_command(models.db_init_cmd)
+    app.cli.add_command(models.db_migrate_cmd)
     app.cli.add_command(models.db_drop_cmd)
     app.cli.add_command(models.db_populate_cmd)
 
-    from . import api
+    from . import api, blobstore, cache, groupcommit, instrumentation, metrics, urls, validation
     app.register_blueprint(api.api_bp)
+    urls.init_app(app)
+    validation.init_app(app)
+    cache.init_app(app)
+    blobstore.init_app(app)
+    instrumentation.init_app(app)
+    metrics.init_app(app)
+    groupcommit.init_app(app)
 
     @app.route("/")
     def index():
@@ -73,4 +80,24 @@ def create_app(test_config=None):
     def send_profile(profile):
         return "you requests {} profile".format(profile)
 
+    @app.route("/schemas/<model>/")
+    def send_schema(model):
+        Model = {
+            "user": models.User,
+            "widget": models.Widget,
+            "layout": models.Layout,
+            "set": models.Set,
+        }.get(model)
+        if Model is None:
+            return create_error_response(
+                404, "Not found",
+                f'No schema was found for {model}'
+            )
+
+        resp = Response(json.dumps(Model.get_schema()), 200, mimetype="application/schema+json")
+        resp.add_etag()
+        resp.cache_control.public = True
+        resp.cache_control.max_age = SCHEMA_MAX_AGE
+        return resp.make_conditional(request)
+
     return app
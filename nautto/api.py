@@ -1,20 +1,34 @@
 
 from nautto.resources.user import UserCollection, UserItem
-from nautto.resources.widget import WidgetsByUserCollection, WidgetCollection, WidgetItem, WidgetOfLayout
+from nautto.resources.widget import WidgetsByUserCollection, WidgetCollection, WidgetItem, WidgetOfLayout, WidgetContent
 from nautto.resources.layout import LayoutsByUserCollection, LayoutCollection, LayoutItem, LayoutOfSet
-from nautto.resources.set import SetsByUserCollection, SetCollection, SetItem
+from nautto.resources.set import SetsByUserCollection, SetCollection, SetItem, SetTree
 from flask import Blueprint
 from flask_restful import Api
 
+from nautto.compression import compress_response
+
 api_bp = Blueprint("api", __name__, url_prefix="/api")
 api = Api(api_bp)
 
+
+@api_bp.after_request
+def vary_on_prefer(response):
+    # Controls carry an inline schema or a schemaUrl depending on Prefer
+    response.vary.add("Prefer")
+    return response
+
+
+api_bp.after_request(compress_response)
+
+
 api.add_resource(UserCollection, "/users/")
 api.add_resource(UserItem, "/users/<user>/")
 
 api.add_resource(WidgetsByUserCollection, "/users/<user>/widgets/")
 api.add_resource(WidgetCollection, "/widgets/")
 api.add_resource(WidgetItem, "/widgets/<widget>/")
+api.add_resource(WidgetContent, "/widgets/<widget>/content/")
 
 api.add_resource(LayoutsByUserCollection, "/users/<user>/layouts/")
 api.add_resource(LayoutCollection, "/layouts/")
@@ -24,4 +38,5 @@ api.add_resource(WidgetOfLayout, "/layouts/<layout>/widgets/<widget>/")
 api.add_resource(SetsByUserCollection, "/users/<user>/sets/")
 api.add_resource(SetCollection, "/sets/")
 api.add_resource(SetItem, "/sets/<set>/")
+api.add_resource(SetTree, "/sets/<set>/tree/")
 api.add_resource(LayoutOfSet, "/sets/<set>/layouts/<layout>/")
\ No newline at end of file
@@ -0,0 +1,199 @@
+import asyncio
+import io
+import sys
+import threading
+from concurrent import futures
+
+from nautto import create_app
+from nautto.constants import *
+
+# marks the end of a response body in the queue between thread and loop
+_DONE = object()
+
+
+class AsgiApp(object):
+    """
+    Serves a Flask application to an ASGI server such as uvicorn. The server
+    keeps every connection on its event loop, so idle keep-alive connections
+    and slow clients cost no thread. A request only gets one from a bounded
+    pool once its whole body has been received, and gives it back once its
+    response has been produced; bodies larger than ASGI_QUEUE_CHUNKS chunks
+    hold it until the client has read enough of them.
+
+    The handlers are the same as under a WSGI server. Each request is run
+    from start to finish on one thread, because SQLAlchemy sessions and
+    SQLite connections belong to the thread that opened them.
+    """
+
+    def __init__(self, app, threads=ASGI_THREADS, queue_chunks=ASGI_QUEUE_CHUNKS):
+        self.app = app
+        self.queue_chunks = queue_chunks
+        self.executor = futures.ThreadPoolExecutor(threads, thread_name_prefix="nautto-asgi")
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            await self._lifespan(receive, send)
+        elif scope["type"] == "http":
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError(f'Unsupported ASGI scope type {scope["type"]!r}')
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                self.executor.shutdown(wait=True)
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def _http(self, scope, receive, send):
+        body = io.BytesIO()
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return
+            body.write(message.get("body", b""))
+            if not message.get("more_body", False):
+                break
+        body.seek(0)
+
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(self.queue_chunks)
+        cancelled = threading.Event()
+        worker = loop.run_in_executor(
+            self.executor, self._run, build_environ(scope, body), loop, queue, cancelled
+        )
+        try:
+            while True:
+                message = await queue.get()
+                if message is _DONE:
+                    break
+                await send(message)
+        except BaseException:
+            # the client went away; let the thread close the response
+            cancelled.set()
+            while not queue.empty():
+                queue.get_nowait()
+            raise
+        finally:
+            await worker
+
+    def _run(self, environ, loop, queue, cancelled):
+        response = {"start": None, "sent": False}
+
+        def put(message):
+            # waits for room in the queue, which holds back large bodies
+            future = asyncio.run_coroutine_threadsafe(queue.put(message), loop)
+            while not cancelled.is_set():
+                try:
+                    return future.result(0.1)
+                except futures.TimeoutError:
+                    continue
+            future.cancel()
+
+        def write(chunk):
+            if not response["sent"]:
+                put(response["start"])
+                response["sent"] = True
+            if chunk and not cancelled.is_set():
+                put({"type": "http.response.body", "body": chunk, "more_body": True})
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and response["sent"]:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response["start"] = {
+                "type": "http.response.start",
+                "status": int(status.split(" ", 1)[0]),
+                "headers": [
+                    (name.lower().encode("latin-1"), value.encode("latin-1"))
+                    for name, value in headers
+                ],
+            }
+            return write
+
+        chunks = None
+        try:
+            chunks = self.app(environ, start_response)
+            for chunk in chunks:
+                if cancelled.is_set():
+                    break
+                write(chunk)
+            write(b"")
+            put({"type": "http.response.body", "body": b"", "more_body": False})
+        finally:
+            try:
+                # ends the request context, which releases the database session
+                if hasattr(chunks, "close"):
+                    chunks.close()
+            finally:
+                put(_DONE)
+
+
+def build_environ(scope, body):
+    """
+    Builds the WSGI environ of an ASGI HTTP request.
+
+    : param dict scope: the ASGI connection scope
+    : param body: file object holding the request body
+    """
+
+    server = scope.get("server") or ("localhost", 80)
+    client = scope.get("client") or ("", 0)
+    path = scope.get("raw_path")
+    if path is None:
+        path = scope["path"].encode("utf-8")
+    path = path.split(b"?", 1)[0].decode("latin-1")
+    root_path = scope.get("root_path", "")
+    if root_path and path.startswith(root_path):
+        path = path[len(root_path):]
+    environ = {
+        "REQUEST_METHOD": scope["method"],
+        "SCRIPT_NAME": root_path,
+        "PATH_INFO": path,
+        "QUERY_STRING": scope.get("query_string", b"").decode("latin-1"),
+        "SERVER_NAME": server[0],
+        "SERVER_PORT": str(server[1]),
+        "SERVER_PROTOCOL": f'HTTP/{scope.get("http_version", "1.1")}',
+        "REMOTE_ADDR": client[0],
+        "REMOTE_PORT": str(client[1]),
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": scope.get("scheme", "http"),
+        "wsgi.input": body,
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": True,
+        "wsgi.run_once": False,
+    }
+    for name, value in scope.get("headers", []):
+        name = name.decode("latin-1").upper().replace("-", "_")
+        value = value.decode("latin-1")
+        if name in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+            environ[name] = value
+            continue
+        key = "HTTP_" + name
+        environ[key] = f'{environ[key]},{value}' if key in environ else value
+    if "CONTENT_LENGTH" not in environ:
+        environ["CONTENT_LENGTH"] = str(body.getbuffer().nbytes)
+    return environ
+
+
+def create_asgi_app(test_config=None):
+    """
+    Creates the application with create_app and returns it as an ASGI
+    application. Run it with an ASGI server, e.g.
+
+        uvicorn --factory nautto.asgi:create_asgi_app
+
+    ASGI_THREADS sets how many requests are handled at the same time.
+
+    : param dict test_config: configuration passed on to create_app
+    """
+
+    app = create_app(test_config)
+    return AsgiApp(
+        app,
+        threads=app.config.get("ASGI_THREADS", ASGI_THREADS),
+        queue_chunks=app.config.get("ASGI_QUEUE_CHUNKS", ASGI_QUEUE_CHUNKS),
+    )
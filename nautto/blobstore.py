@@ -0,0 +1,106 @@
+import mmap
+import os
+import tempfile
+
+from flask import current_app
+
+from nautto.constants import *
+
+
+class BlobStore(object):
+    """
+    Content addressed files under a directory, named by the SHA-256 hash of
+    their content and spread over subdirectories by its first two digits.
+    Files are written once, atomically, and never modified afterwards.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def path(self, digest):
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def put(self, digest, data):
+        """
+        Writes the content of a hash unless it is already stored. Returns
+        whether the file was written.
+
+        : param str digest: SHA-256 hash of the content
+        : param bytes data: the content
+        """
+
+        path = self.path(digest)
+        if os.path.exists(path):
+            return False
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handle, temp = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(handle, "wb") as temp_file:
+            temp_file.write(data)
+        os.replace(temp, path)
+        return True
+
+    def read(self, digest):
+        with open(self.path(digest), "rb") as blob_file:
+            return blob_file.read()
+
+    def open(self, digest):
+        return open(self.path(digest), "rb")
+
+    def remove(self, digest):
+        try:
+            os.unlink(self.path(digest))
+        except FileNotFoundError:
+            pass
+
+
+class MappedBlob(object):
+    """
+    A stored file memory-mapped for serving. It iterates over the file in
+    chunks and can seek, which lets range requests jump straight to their
+    first byte; only the pages that are sent are ever read.
+    """
+
+    def __init__(self, blob_file, chunk_size=BLOB_CHUNK_SIZE):
+        self._map = mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ)
+        blob_file.close()
+        self._chunk_size = chunk_size
+
+    def __len__(self):
+        return len(self._map)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        chunk = self._map.read(self._chunk_size)
+        if not chunk:
+            raise StopIteration()
+        return chunk
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset):
+        self._map.seek(offset)
+
+    def tell(self):
+        return self._map.tell()
+
+    def close(self):
+        self._map.close()
+
+
+def init_app(app):
+    """
+    Creates the store for widget content larger than BLOB_INLINE_MAX bytes,
+    kept in BLOB_DIR (instance/blobs by default).
+
+    : param app: the Flask application
+    """
+
+    directory = app.config.get("BLOB_DIR") or os.path.join(app.instance_path, "blobs")
+    app.extensions["blob_store"] = BlobStore(directory)
+
+
+def get_store():
+    return current_app.extensions["blob_store"]
@@ -0,0 +1,204 @@
+import json
+
+from flask import Response, current_app, request, url_for
+from jsonschema.exceptions import best_match
+from sqlalchemy import func, select
+from sqlalchemy.exc import IntegrityError
+
+from nautto import db
+from nautto.membership import MemberNotFound, insert_members
+from nautto.models import User, store_contents, touch_tables
+from nautto.projection import selectable_fields
+from nautto.streaming import stream_collection
+from nautto.urls import url_template
+from nautto.utils import MasonBuilder, NauttoBuilder, create_error_response
+from nautto.constants import *
+
+
+class BulkError(ValueError):
+    """
+    Raised when the body of a bulk request can't be read as a list of
+    documents. The message is meant to be shown to the client in an error
+    response.
+    """
+
+
+def read_documents():
+    """
+    Reads the documents of a bulk create request, either a JSON array or
+    newline delimited JSON with one document per line. Returns None when the
+    request is not a bulk request. Raises BulkError for malformed bodies.
+    """
+
+    if request.mimetype == NDJSON:
+        documents = []
+        for number, line in enumerate(request.get_data(as_text=True).splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                documents.append(json.loads(line))
+            except ValueError as e:
+                raise BulkError(f'Line {number} is not valid JSON: {e}')
+        return documents
+
+    documents = request.get_json(silent=True)
+    if isinstance(documents, list):
+        return documents
+    return None
+
+
+def _error_response(status_code, title, messages):
+    # Like create_error_response but with one message per rejected document
+    body = MasonBuilder(resource_url=request.path)
+    body.add_error(title, None)
+    body["@error"]["@messages"] = messages
+    body.add_control("profile", href=ERROR_PROFILE)
+    return Response(json.dumps(body), status_code, mimetype=MASON)
+
+
+def _check_documents(documents, Model):
+    validator = current_app.extensions["validators"][Model]
+    errors = []
+    ids = {}
+    for index, document in enumerate(documents):
+        if not validator.is_valid(document):
+            error = best_match(validator.iter_errors(document))
+            errors.append(f'Item {index}: {error.message}')
+            continue
+        if "id" not in document:
+            continue
+        identifier = document["id"]
+        if not identifier.isdigit():
+            errors.append(f'Item {index}: id must be an integer, got {identifier!r}')
+        elif int(identifier) in ids:
+            errors.append(
+                f'Item {index}: id {identifier} is also used by item {ids[int(identifier)]}'
+            )
+        else:
+            ids[int(identifier)] = index
+    return errors, ids
+
+
+def _existing_ids(table, ids):
+    existing = set()
+    ids = sorted(ids)
+    for start in range(0, len(ids), SQL_MAX_VARIABLES):
+        chunk = ids[start:start + SQL_MAX_VARIABLES]
+        rows = db.session.execute(select([table.c.id]).where(table.c.id.in_(chunk)))
+        existing.update(row[0] for row in rows)
+    return existing
+
+
+def _created_items(ids, endpoint, profile, argument):
+    item_url = url_template(endpoint)
+    for identifier in ids:
+        item = NauttoBuilder(id=identifier)
+        item.add_control("self", item_url(**{argument: identifier}))
+        item.add_control("profile", profile)
+        yield item
+
+
+def create_many(Model, user, documents, endpoint, profile, members=None):
+    """
+    Creates the resources of a bulk request for a user in one transaction.
+    Every document is validated first and nothing is written if any of them
+    is rejected; the error response then has one message per rejected
+    document. The rows are written with a single multi-row INSERT, with ids
+    allocated up front so that no row has to be read back. The "items" of
+    the documents become the first members of the created resources, all of
+    them written together too.
+
+    The response is 201 with an "items" array holding the id and location of
+    every created resource, in the order of the documents.
+
+    : param Model: the model of the created resources
+    : param user: id of the owning user from the URL
+    : param list documents: the documents as read by read_documents
+    : param str endpoint: item endpoint of the model, e.g. "api.widgetitem"
+    : param str profile: profile of the created resources
+    : param members: the relationship attribute holding the members given
+        as "items", e.g. Layout.widgets, if the model has one
+    """
+
+    if not documents:
+        return create_error_response(
+            400, "Invalid JSON document",
+            "Bulk requests must contain at least one document"
+        )
+    if len(documents) > BULK_MAX_ITEMS:
+        return create_error_response(
+            413, "Too many documents",
+            f'Bulk requests can contain at most {BULK_MAX_ITEMS} documents'
+        )
+
+    errors, explicit = _check_documents(documents, Model)
+    if errors:
+        return _error_response(400, "Invalid JSON document", errors)
+
+    db_user = User.query.filter_by(id=user).first()
+    if not db_user:
+        return create_error_response(
+            404, "Not found",
+            f'No user was found with the id {user}'
+        )
+
+    table = Model.__table__
+    conflicts = _existing_ids(table, explicit)
+    if conflicts:
+        return _error_response(409, "Already exists", [
+            f'Item {explicit[identifier]}: id {identifier} already exists'
+            for identifier in sorted(conflicts, key=explicit.get)
+        ])
+
+    # Bumping the table version first takes the write lock, after which the
+    # largest id can't change under us.
+    connection = db.session.connection()
+    touch_tables(connection, [table.name])
+    next_id = max(
+        connection.execute(select([func.max(table.c.id)])).scalar() or 0,
+        max(explicit, default=0)
+    ) + 1
+
+    fields = [field for field in selectable_fields(Model) if field != "id"]
+    rows = []
+    ids = []
+    items = {}
+    for document in documents:
+        if "id" in document:
+            identifier = int(document["id"])
+        else:
+            identifier = next_id
+            next_id += 1
+        row = {field: document.get(field) for field in fields}
+        row["id"] = identifier
+        row["user_id"] = db_user.id
+        rows.append(row)
+        ids.append(identifier)
+        # removing members from a new resource leaves it without any
+        if "items" in document and document.get("membership") != MEMBERSHIP_REMOVE:
+            items[identifier] = document["items"]
+
+    if "content" in fields:
+        # widget content goes to the blob table, the rows get its hash
+        hashes = store_contents(db.session, [row.pop("content") for row in rows])
+        for row, digest in zip(rows, hashes):
+            row["content_hash"] = digest
+
+    try:
+        connection.execute(table.insert(), rows)
+        if members is not None and items:
+            insert_members(members, items)
+        db.session.commit()
+    except IntegrityError as e:
+        db.session.rollback()
+        return create_error_response(409, "Already exists", str(e))
+    except MemberNotFound as e:
+        db.session.rollback()
+        return create_error_response(404, "Not found", str(e))
+
+    body = NauttoBuilder()
+    body.add_namespace("nautto", LINK_RELATIONS_URL)
+    body.add_control("self", url_for(request.endpoint, **request.view_args))
+    # The URL argument of every item endpoint is named after its table
+    created = _created_items(ids, endpoint, profile, table.name)
+    return stream_collection(body, created, status=201)
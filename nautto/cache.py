@@ -0,0 +1,273 @@
+import threading
+from collections import OrderedDict
+
+from flask import Response, current_app, g, request
+from sqlalchemy import literal, or_, select, union_all
+
+from nautto import db
+from nautto.models import Layout, Set, Widget, layout_widgets, set_layouts
+from nautto.constants import *
+from nautto.utils import schema_mode
+
+
+class Representation(object):
+    """
+    A cached document. Besides the plain bytes it holds compressed forms of
+    the document by content coding, filled in as clients ask for them.
+    """
+
+    def __init__(self, data, mimetype=MASON):
+        self.data = data
+        self.mimetype = mimetype
+        self.encoded = {}
+
+
+class RepresentationCache(object):
+    """
+    A size bounded LRU cache of serialized item representations. Entries are
+    keyed by resource type, id and a variant that captures everything else the
+    document depends on (query string, schema mode, mount point and the ETag
+    of the versions it was built from). All variants of an entity are
+    dropped together when it is invalidated.
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._variants = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, entity, variant):
+        """
+        Returns the cached representation of an entity or None.
+
+        : param tuple entity: (resource type, id) pair
+        : param variant: hashable description of the request variant
+        """
+
+        with self._lock:
+            representation = self._entries.get((entity, variant))
+            if representation is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end((entity, variant))
+            self.hits += 1
+            return representation
+
+    def put(self, entity, variant, representation):
+        """
+        Stores the representation of an entity, evicting the least recently
+        used entries when the cache is full.
+
+        : param tuple entity: (resource type, id) pair
+        : param variant: hashable description of the request variant
+        : param Representation representation: the serialized document
+        """
+
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._entries[(entity, variant)] = representation
+            self._entries.move_to_end((entity, variant))
+            self._variants.setdefault(entity, set()).add(variant)
+            while len(self._entries) > self.max_size:
+                (old_entity, old_variant), _ = self._entries.popitem(last=False)
+                self._forget(old_entity, old_variant)
+
+    def invalidate(self, entities):
+        """
+        Drops every cached variant of the given entities.
+
+        : param entities: iterable of (resource type, id) pairs
+        """
+
+        with self._lock:
+            for entity in entities:
+                for variant in self._variants.pop(entity, ()):
+                    self._entries.pop((entity, variant), None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._variants.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def _forget(self, entity, variant):
+        variants = self._variants.get(entity)
+        if variants is not None:
+            variants.discard(variant)
+            if not variants:
+                del self._variants[entity]
+
+
+def init_app(app):
+    """
+    Creates the representation cache of the application. Its size is set
+    with REPRESENTATION_CACHE_SIZE; 0 disables caching.
+
+    : param app: the Flask application
+    """
+
+    app.extensions["representation_cache"] = RepresentationCache(
+        app.config.get("REPRESENTATION_CACHE_SIZE", REPRESENTATION_CACHE_SIZE)
+    )
+
+
+def get_cache():
+    return current_app.extensions["representation_cache"]
+
+
+def _entity(kind, identifier):
+    # Ids arrive as URL strings; only canonical integers can be cached
+    # because "01" and "1" address the same row.
+    identifier = str(identifier)
+    if not identifier.isdigit():
+        return None
+    return (kind, int(identifier))
+
+
+def _variant(etag):
+    # The ETag changes with the versions of the rows shown, so entries built
+    # before a write made by another process or thread are never hit again.
+    return (request.script_root, schema_mode(), request.query_string, etag)
+
+
+def cached_response(kind, identifier, etag):
+    """
+    Returns a response built from the cached representation of an item, or
+    None when it is not cached.
+
+    : param str kind: resource type, e.g. "widget"
+    : param identifier: id of the item from the URL
+    : param str etag: current ETag of the item, from its validators
+    """
+
+    entity = _entity(kind, identifier)
+    if entity is None:
+        return None
+    representation = get_cache().get(entity, _variant(etag))
+    g.cache_hit = representation is not None
+    if representation is None:
+        return None
+    g.representation = representation
+    return Response(representation.data, 200, mimetype=representation.mimetype)
+
+
+def cache_response(kind, identifier, etag, response):
+    """
+    Stores the body of a successful item response in the cache and returns
+    the response. Streamed responses are buffered first. The cached
+    representation is remembered for the request so that compressed forms
+    can be stored alongside it.
+
+    : param str kind: resource type, e.g. "widget"
+    : param identifier: id of the item from the URL
+    : param str etag: ETag of the item, computed before it was read
+    : param response: the response of the item GET
+    """
+
+    entity = _entity(kind, identifier)
+    if entity is not None and response.status_code == 200:
+        g.representation = Representation(response.get_data(), response.mimetype)
+        get_cache().put(entity, _variant(etag), g.representation)
+    return response
+
+
+def invalidate(entities):
+    """
+    Drops the cached representations of the given entities.
+
+    : param entities: iterable of (resource type, id) pairs
+    """
+
+    entities = list(entities)
+    get_cache().invalidate(entities)
+    # Writes waiting for a group commit are not visible yet; the entities
+    # are dropped again once they are
+    pending = g.get("pending_invalidations")
+    if pending is not None:
+        pending.extend(entities)
+
+
+def _container_queries(widgets=None, layouts=None):
+    # (kind, id) rows of the layouts listing the widgets and of the sets
+    # listing those layouts or the given ones
+    lw, sl = layout_widgets.c, set_layouts.c
+    queries = []
+    listed = []
+    if widgets is not None:
+        queries.append(
+            select([literal("layout"), lw.layout_id]).where(lw.widget_id.in_(widgets))
+        )
+        listed.append(
+            sl.layout_id.in_(select([lw.layout_id]).where(lw.widget_id.in_(widgets)))
+        )
+    if layouts is not None:
+        listed.append(sl.layout_id.in_(layouts))
+    queries.append(select([literal("set"), sl.set_id]).where(or_(*listed)))
+    return queries
+
+
+def _entities(own, queries):
+    # One statement for all of them, instead of loading the relationships
+    # item by item
+    statement = union_all(*queries) if len(queries) > 1 else queries[0]
+    return own + [(kind, identifier) for kind, identifier in db.session.execute(statement)]
+
+
+def widget_dependents(db_widget):
+    """
+    Returns the entities whose representation shows the given widget: the
+    widget itself, the layouts listing it and the sets of those layouts,
+    which can embed the widget.
+    """
+
+    return _entities(
+        [("widget", db_widget.id)], _container_queries(widgets=[db_widget.id])
+    )
+
+
+def layout_dependents(db_layout):
+    """
+    Returns the entities whose representation shows the given layout: the
+    layout itself and the sets listing it.
+    """
+
+    return _entities(
+        [("layout", db_layout.id)], _container_queries(layouts=[db_layout.id])
+    )
+
+
+def set_dependents(db_set):
+    return [("set", db_set.id)]
+
+
+def user_dependents(db_user, owned=False):
+    """
+    Returns the entities whose representation shows the given user. With
+    owned=True the resources of the user and everything showing them are
+    included too, which is needed when the user is deleted or gets a new id.
+    """
+
+    entities = [("user", db_user.id)]
+    if not owned:
+        return entities
+    widgets = select([Widget.id]).where(Widget.user_id == db_user.id)
+    layouts = select([Layout.id]).where(Layout.user_id == db_user.id)
+    return _entities(entities, [
+        select([literal("widget"), Widget.id]).where(Widget.user_id == db_user.id),
+        select([literal("layout"), Layout.id]).where(Layout.user_id == db_user.id),
+        select([literal("set"), Set.id]).where(Set.user_id == db_user.id),
+    ] + _container_queries(widgets=widgets, layouts=layouts))
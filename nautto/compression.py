@@ -0,0 +1,98 @@
+import gzip
+import zlib
+
+from flask import current_app, g, request
+
+from nautto.constants import *
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def available_encodings():
+    """
+    Returns the content codings the server can produce, in order of
+    preference. Brotli is only offered when the brotli package is installed.
+    """
+
+    if brotli is not None:
+        return ("br", "gzip")
+    return ("gzip",)
+
+
+def _compress(data, encoding):
+    if encoding == "br":
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _compress_stream(chunks, encoding):
+    if encoding == "br":
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        compress, flush = compressor.process, compressor.finish
+    else:
+        compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+        compress, flush = compressor.compress, compressor.flush
+    try:
+        for chunk in chunks:
+            if isinstance(chunk, str):
+                chunk = chunk.encode("utf-8")
+            data = compress(chunk)
+            if data:
+                yield data
+        yield flush()
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+
+
+def _encoded_body(data, encoding):
+    # Cached representations keep their compressed forms next to the plain
+    # one so that hits are not compressed again.
+    representation = g.get("representation")
+    if representation is None or representation.data != data:
+        return _compress(data, encoding)
+    encoded = representation.encoded.get(encoding)
+    if encoded is None:
+        encoded = _compress(data, encoding)
+        representation.encoded[encoding] = encoded
+    return encoded
+
+
+def compress_response(response):
+    """
+    Compresses a response with the best content coding accepted by the
+    client. Responses below COMPRESSION_MIN_SIZE bytes are sent as they are;
+    streamed responses are always compressed, chunk by chunk, because their
+    size is not known up front. Strong ETags get the coding as a suffix so
+    that each coding has its own validator.
+
+    : param response: the response of an api view
+    """
+
+    response.vary.add("Accept-Encoding")
+    if (response.status_code != 200
+            or response.direct_passthrough
+            or "Content-Encoding" in response.headers):
+        return response
+
+    encoding = request.accept_encodings.best_match(available_encodings())
+    if encoding is None:
+        return response
+
+    if response.is_streamed:
+        response.response = _compress_stream(response.response, encoding)
+        response.headers.pop("Content-Length", None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config.get("COMPRESSION_MIN_SIZE", COMPRESSION_MIN_SIZE):
+            return response
+        response.set_data(_encoded_body(data, encoding))
+
+    response.headers["Content-Encoding"] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag(f'{etag}-{encoding}', weak)
+    return response
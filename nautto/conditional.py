@@ -0,0 +1,104 @@
+import hashlib
+
+from flask import Response, request
+from werkzeug.http import is_resource_modified
+
+from nautto import db
+from nautto.models import TableVersion
+from nautto.compression import available_encodings
+from nautto.utils import schema_mode
+
+
+class Validators(object):
+    """
+    The ETag and Last-Modified values of a representation. They are computed
+    from version columns without building the representation itself, unless
+    the representation already has a natural ETag such as a content hash.
+    """
+
+    def __init__(self, parts, last_modified, etag=None):
+        if etag is None:
+            variant = (request.script_root, schema_mode(), request.query_string)
+            etag = hashlib.sha1(repr((parts, variant)).encode("utf-8")).hexdigest()
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def not_modified(self):
+        """
+        Returns a 304 response if the conditional headers of the current
+        request match, otherwise None.
+        """
+
+        # Compressed responses carry the coding as an ETag suffix, and any
+        # coding of the representation validates the cached copy. The 304
+        # carries the ETag of the coding that matched, as the 200 did.
+        for etag in [self.etag] + [f'{self.etag}-{encoding}' for encoding in available_encodings()]:
+            if not is_resource_modified(request.environ, etag, last_modified=self.last_modified):
+                response = self.apply(Response(status=304))
+                response.set_etag(etag)
+                return response
+        return None
+
+    def apply(self, response):
+        """
+        Adds the validators to a response and returns it.
+        """
+
+        response.set_etag(self.etag)
+        if self.last_modified is not None:
+            response.last_modified = self.last_modified
+        return response
+
+
+def _latest(*dates):
+    dates = [date for date in dates if date is not None]
+    return max(dates) if dates else None
+
+
+def _table_versions(tables):
+    if not tables:
+        return (), None
+    rows = dict(
+        (name, (version, updated_at)) for name, version, updated_at in
+        db.session.query(
+            TableVersion.name, TableVersion.version, TableVersion.updated_at
+        ).filter(TableVersion.name.in_(tables))
+    )
+    versions = tuple(rows.get(name, (0, None))[0] for name in tables)
+    return versions, _latest(*[updated_at for _, updated_at in rows.values()])
+
+
+def item_validators(Model, identifier, *tables):
+    """
+    Returns the validators of an item representation, or None if the item
+    does not exist. They are based on the version column of the row and the
+    change counters of the given tables, which must cover everything else
+    the representation shows (e.g. the widgets listed by a layout).
+
+    : param Model: model of the item
+    : param identifier: id of the item from the URL
+    : param tables: names of the tables the representation also depends on
+    """
+
+    row = db.session.query(Model.version, Model.updated_at).filter(
+        Model.id == identifier
+    ).first()
+    if row is None:
+        return None
+    versions, updated_at = _table_versions(tables)
+    return Validators(
+        (Model.__tablename__, identifier, row.version, versions),
+        _latest(row.updated_at, updated_at)
+    )
+
+
+def collection_validators(*tables):
+    """
+    Returns the validators of a collection representation based on the
+    change counters of the given tables.
+
+    : param tables: names of the tables the collection shows
+    """
+
+    versions, updated_at = _table_versions(tables)
+    return Validators((tables, versions), updated_at)
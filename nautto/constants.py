@@ -1,8 +1,93 @@
 MASON = "application/vnd.mason+json"
+JSON = "application/json"
 LINK_RELATIONS_URL = "/nautto/link-relations/"
 ERROR_PROFILE = "/profiles/error/"
 WIDGET_PROFILE = "/profiles/widget/"
 LAYOUT_PROFILE = "/profiles/layout/"
 SET_PROFILE = "/profiles/set/"
 USER_PROFILE = "/profiles/user/"
-WIDGET_PAGE_SIZE = 50
+PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+UNLIMITED = "all"
+PAGE_ARGS = ("after", "before", "limit")
+STREAM_CHUNK_SIZE = 1000
+LIST_FIELDS = ("id", "name")
+SCHEMA_INLINE = "inline"
+SCHEMA_URL = "url"
+SCHEMA_MODES = (SCHEMA_INLINE, SCHEMA_URL)
+SCHEMA_MAX_AGE = 86400
+REPRESENTATION_CACHE_SIZE = 10000
+COMPRESSION_MIN_SIZE = 500
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+LAYOUT_EMBEDS = ("widgets",)
+SET_EMBEDS = ("layouts", "widgets")
+PROMETHEUS = "text/plain; version=0.0.4"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+METRICS_FLUSH_INTERVAL = 1.0
+# metrics of exited worker processes, added up
+METRICS_AGGREGATE_FILE = "aggregate.json"
+METRICS_LOCK_FILE = "metrics.lock"
+NDJSON = "application/x-ndjson"
+MERGE_PATCH = "application/merge-patch+json"
+BULK_MAX_ITEMS = 100000
+SQL_MAX_VARIABLES = 32766
+MEMBERSHIP_ADD = "add"
+MEMBERSHIP_REMOVE = "remove"
+MEMBERSHIP_REPLACE = "replace"
+MEMBERSHIP_MODES = (MEMBERSHIP_ADD, MEMBERSHIP_REMOVE, MEMBERSHIP_REPLACE)
+BLOB_INLINE_MAX = 65536
+BLOB_CHUNK_SIZE = 65536
+WIDGET_MEDIA_TYPES = {
+    "html": "text/html",
+    "css": "text/css",
+    "js": "application/javascript",
+    "javascript": "application/javascript",
+    "json": "application/json",
+    "markdown": "text/markdown",
+    "svg": "image/svg+xml",
+    "text": "text/plain",
+}
+SQLITE_PRAGMA_NAMES = (
+    "foreign_keys", "journal_mode", "synchronous", "mmap_size", "cache_size",
+    "busy_timeout", "temp_store",
+)
+SQLITE_PROFILES = {
+    # SQLite defaults apart from foreign keys
+    "safe": {"foreign_keys": "ON"},
+    "performance": {
+        "foreign_keys": "ON",
+        "journal_mode": "WAL",
+        "synchronous": "NORMAL",
+        "mmap_size": 268435456,
+        "cache_size": -65536,
+        "busy_timeout": 5000,
+        "temp_store": "MEMORY",
+    },
+}
+SQLITE_PROFILE = "safe"
+SEARCH_COLUMNS = {
+    "widget": ("name", "description", "content"),
+    "layout": ("name", "description"),
+    "set": ("name", "description"),
+}
+# columns whose changes update the search index of a table
+SEARCH_WATCHED = {
+    "widget": ("name", "description", "content_hash"),
+    "layout": ("name", "description"),
+    "set": ("name", "description"),
+}
+SEARCH_ARG = "q"
+FILTER_EQUAL = "eq"
+FILTER_PREFIX = "prefix"
+SORT_ARG = "sort"
+# query parameters of collections that aren't filters
+RESERVED_ARGS = PAGE_ARGS + ("fields", "embed", SORT_ARG, SEARCH_ARG, "schema")
+ASGI_THREADS = 32
+# response chunks buffered for a client before the handler thread waits
+ASGI_QUEUE_CHUNKS = 16
+# seconds concurrent writes wait to be committed together; 0 commits each
+# request on its own
+GROUP_COMMIT_WINDOW = 0
+GROUP_COMMIT_METHODS = ("POST", "PUT", "PATCH", "DELETE")
@@ -0,0 +1,128 @@
+from flask import request
+
+from nautto.pagination import paginate
+from nautto.search import search
+from nautto.constants import *
+
+
+class FilterError(ValueError):
+    """
+    Raised when the filter or sort query parameters of a request are
+    malformed or not supported by the listed model. The message is meant to
+    be shown to the client in an error response.
+    """
+
+
+def _prefix_range(column, prefix):
+    # A range instead of LIKE, which SQLite only runs on an index when the
+    # index and LIKE agree on case sensitivity.
+    condition = column >= prefix
+    if ord(prefix[-1]) < 0x10FFFF:
+        condition = condition & (column < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+    return condition
+
+
+def apply_filters(query, Model):
+    """
+    Restricts a query with the filter query parameters of the current
+    request that Model.FILTERS allows. Equality filters may be repeated to
+    accept any of the values; prefix filters take one value. Raises
+    FilterError for query parameters that are neither filters of the model
+    nor reserved, and for values that don't suit their column.
+
+    Returns the query and, when a filter can only be served by an index in
+    the order of its own column, the name of the filter and that column.
+    This is the case for prefixes and repeated values, whose rows come out
+    of the index ordered by the filtered column instead of the id.
+
+    : param query: SQLAlchemy query returning instances of Model
+    : param Model: the listed model
+    """
+
+    for name in request.args:
+        if name not in Model.FILTERS and name not in RESERVED_ARGS:
+            raise FilterError(
+                f'Unknown query parameter {name!r}, {Model.__tablename__} collections '
+                f'can be filtered by {", ".join(Model.FILTERS)}'
+            )
+
+    order = None
+    for name, (attribute, operator) in Model.FILTERS.items():
+        values = request.args.getlist(name)
+        if not values:
+            continue
+        column = getattr(Model, attribute)
+        if operator == FILTER_PREFIX:
+            if len(values) > 1:
+                raise FilterError(f'Only one {name!r} can be given')
+            if not values[0]:
+                continue
+            query = query.filter(_prefix_range(column, values[0]))
+        else:
+            if column.type.python_type is int:
+                if not all(value.isdigit() for value in values):
+                    raise FilterError(f'{name!r} must be an integer')
+                values = [int(value) for value in values]
+            if len(values) == 1:
+                query = query.filter(column == values[0])
+                continue
+            query = query.filter(column.in_(values))
+        if order is not None and order[1] != attribute:
+            raise FilterError(f'{order[0]!r} and {name!r} can\'t be combined')
+        order = (name, attribute)
+    return query, order
+
+
+def parse_sort(Model):
+    """
+    Reads the sort order of the current request from the "sort" query
+    parameter, a column name from Model.SORTS with a leading "-" for
+    descending order. Returns the column, or None when no order is given,
+    and whether the order is descending. Raises FilterError for columns
+    that can't be sorted by.
+
+    : param Model: the listed model
+    """
+
+    value = request.args.get(SORT_ARG)
+    if value is None:
+        return None, False
+    name = value[1:] if value.startswith("-") else value
+    if name not in Model.SORTS:
+        raise FilterError(
+            f'Unknown sort {value!r}, expected one of {", ".join(Model.SORTS)}'
+            ' with an optional leading -'
+        )
+    return getattr(Model, name), value.startswith("-")
+
+
+def paginate_collection(query, Model, default_limit=PAGE_SIZE):
+    """
+    Returns a page of a collection with the filters, sort order, search and
+    pagination query parameters of the current request applied, all of them
+    in SQL.
+
+    : param query: SQLAlchemy query returning instances of Model
+    : param Model: the listed model
+    : param int default_limit: page size when the request doesn't give one
+    """
+
+    query, order = apply_filters(query, Model)
+    sort, descending = parse_sort(Model)
+    if SEARCH_ARG in request.args:
+        if Model.__tablename__ not in SEARCH_COLUMNS:
+            raise FilterError(f'{Model.__tablename__} collections can\'t be searched')
+        return search(
+            query, Model, default_limit=default_limit, sort=sort, descending=descending
+        )
+    if order is not None:
+        # Sorting the filtered rows by anything else would sort all of them
+        # before the page could be cut
+        name, attribute = order
+        if sort is None:
+            sort = getattr(Model, attribute)
+        elif sort.key != attribute:
+            raise FilterError(f'Rows filtered by {name!r} can only be sorted by {attribute!r}')
+    return paginate(
+        query, Model.id, default_limit=default_limit, sort=sort, descending=descending
+    )
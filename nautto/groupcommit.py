@@ -0,0 +1,194 @@
+import threading
+
+from flask import current_app, g, request
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import StaticPool
+
+from nautto import db
+from nautto.cache import get_cache
+from nautto.models import collect_blob_garbage
+from nautto.pragmas import apply_pragmas, resolve_pragmas
+from nautto.utils import create_error_response
+from nautto.constants import *
+
+
+class Batch(object):
+    """
+    The writes of one group commit. done is set once the transaction holding
+    them has been committed or, with error set, rolled back.
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.error = None
+        self.blob_garbage = False
+        self.written_blobs = set()
+
+
+class GroupCommitter(object):
+    """
+    Commits the writes of concurrent requests of one process together. All
+    of them run on one connection, one request at a time, each inside a
+    SAVEPOINT of a transaction that is kept open for a window of a few
+    milliseconds. A request that fails only rolls back its savepoint. When
+    the window closes the transaction is committed, with a single sync for
+    the whole batch, and the waiting requests get their responses.
+    """
+
+    def __init__(self, app, window):
+        self.app = app
+        self.window = window
+        self.engine = create_engine(
+            app.config["SQLALCHEMY_DATABASE_URI"],
+            poolclass=StaticPool,
+            # used by one request thread at a time, under the lock
+            connect_args={"check_same_thread": False},
+        )
+        pragmas = resolve_pragmas(app.config)
+
+        @event.listens_for(self.engine, "connect")
+        def connect(dbapi_connection, connection_record):
+            apply_pragmas(dbapi_connection, pragmas)
+            # pysqlite would otherwise begin and end transactions around
+            # statements itself, and releasing the first savepoint would
+            # commit
+            dbapi_connection.isolation_level = None
+
+        @event.listens_for(self.engine, "begin")
+        def begin(connection):
+            connection.execute("BEGIN IMMEDIATE")
+
+        self.connection = self.engine.connect()
+        self._lock = threading.Lock()
+        self._transaction = None
+        self._batch = None
+
+    def join(self):
+        """
+        Waits for the connection and returns a session on it for the writes
+        of the current request, which joins the open batch or starts one.
+        Must be followed by leave.
+        """
+
+        self._lock.acquire()
+        try:
+            if self._batch is None:
+                self._transaction = self.connection.begin()
+                self._batch = Batch()
+                timer = threading.Timer(self.window, self._commit, [self._batch])
+                timer.daemon = True
+                timer.start()
+            session = db.session.session_factory(bind=self.connection, binds={})
+            session.info["commit_batch"] = self._batch
+            session.begin_nested()
+        except BaseException:
+            self._lock.release()
+            raise
+
+        @event.listens_for(session, "after_transaction_end")
+        def restart_savepoint(session, transaction):
+            # commit and rollback in the handlers end the savepoint only
+            if session.info.get("leaving"):
+                return
+            if transaction.nested and not transaction._parent.nested:
+                session.begin_nested()
+
+        @event.listens_for(session, "after_commit")
+        def joined(session):
+            session.info["wrote"] = True
+
+        return session
+
+    def leave(self, session):
+        """
+        Discards whatever the session has not committed and gives the
+        connection to the next request.
+        """
+
+        session.info["leaving"] = True
+        try:
+            if session.transaction is not None and session.transaction.nested:
+                session.rollback()
+            # Ends the part of the session in the batch, which leaves the
+            # connection as it is. Closing it instead would roll back the
+            # whole batch.
+            session.commit()
+        finally:
+            session.close()
+            self._lock.release()
+
+    def _commit(self, batch):
+        with self._lock:
+            try:
+                self._transaction.commit()
+            except Exception as e:
+                batch.error = e
+                self._transaction.rollback()
+            finally:
+                self._transaction = None
+                self._batch = None
+        try:
+            # Files written by requests that were rolled back, or by the
+            # whole batch if it failed, have no blob rows
+            if batch.blob_garbage or batch.written_blobs:
+                # outside the lock; it waits for the write lock of the next
+                # batch, if any, for at most one window
+                with self.app.app_context():
+                    collect_blob_garbage(batch.written_blobs)
+        finally:
+            batch.done.set()
+
+
+def _begin_write():
+    if request.method not in GROUP_COMMIT_METHODS:
+        return
+    session = current_app.extensions["group_commit"].join()
+    db.session.registry.set(session)
+    g.group_commit = session
+    g.pending_invalidations = []
+
+
+def _end_write(response=None):
+    session = g.pop("group_commit", None)
+    if session is None:
+        return response
+    batch = session.info["commit_batch"]
+    wrote = session.info.get("wrote", False)
+    db.session.registry.clear()
+    current_app.extensions["group_commit"].leave(session)
+    if response is None or not wrote:
+        return response
+
+    batch.done.wait()
+    if batch.error is not None:
+        return create_error_response(
+            503, "Commit failed",
+            f'The change could not be saved: {batch.error}'
+        )
+    # Other requests may have cached what they read before the commit
+    get_cache().invalidate(g.pop("pending_invalidations", ()))
+    return response
+
+
+def _abandon_write(exception):
+    _end_write()
+
+
+def init_app(app):
+    """
+    Turns on group commit when GROUP_COMMIT_WINDOW, in seconds, is above
+    zero. The writes of POST, PUT, PATCH and DELETE requests are then
+    committed in batches, and each request waits for the commit of its batch
+    before answering. Only threaded servers benefit: a process serving one
+    request at a time only adds the window to every write.
+
+    : param app: the Flask application
+    """
+
+    window = app.config.get("GROUP_COMMIT_WINDOW", GROUP_COMMIT_WINDOW)
+    if not window:
+        return
+    app.extensions["group_commit"] = GroupCommitter(app, window)
+    app.before_request(_begin_write)
+    app.after_request(_end_write)
+    app.teardown_request(_abandon_write)
@@ -0,0 +1,92 @@
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import current_app, g, has_app_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+_local = threading.local()
+
+
+class QueryStats(object):
+    """
+    Number of SQL statements and the time spent executing them.
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def add(self, duration):
+        self.count += 1
+        self.duration += duration
+
+
+def _active_stats():
+    stats = list(getattr(_local, "counters", ()))
+    if has_app_context() and "query_stats" in g:
+        stats.append(g.query_stats)
+    return stats
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _start_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _stop_timer(conn, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - conn.info["query_start"].pop()
+    for stats in _active_stats():
+        stats.add(duration)
+
+
+@contextmanager
+def count_queries():
+    """
+    Counts the SQL statements executed by the current thread inside the
+    with block. Meant for tests that keep endpoints within a query budget.
+    """
+
+    stats = QueryStats()
+    counters = _local.__dict__.setdefault("counters", [])
+    counters.append(stats)
+    try:
+        yield stats
+    finally:
+        counters.remove(stats)
+
+
+def _start_request():
+    g.request_start = time.perf_counter()
+    g.query_stats = QueryStats()
+
+
+def _add_server_timing(response):
+    stats = g.get("query_stats")
+    if stats is None or not current_app.config.get("SERVER_TIMING"):
+        return response
+    total = (time.perf_counter() - g.request_start) * 1000
+    db = stats.duration * 1000
+    response.headers["Server-Timing"] = ", ".join([
+        f'db;dur={db:.2f};desc="{stats.count} queries"',
+        f'serialize;dur={max(total - db, 0):.2f}',
+        f'total;dur={total:.2f}',
+    ])
+    return response
+
+
+def init_app(app):
+    """
+    Starts collecting per request SQL statistics. When SERVER_TIMING is
+    enabled they are reported in a Server-Timing header with the time spent
+    in the database, the rest of the time spent building the response and
+    the total. Bodies that are streamed are only measured up to the point
+    their first byte is ready.
+
+    : param app: the Flask application
+    """
+
+    app.before_request(_start_request)
+    app.after_request(_add_server_timing)
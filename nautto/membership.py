@@ -0,0 +1,138 @@
+from datetime import datetime
+
+from sqlalchemy import bindparam, select
+
+from nautto import db
+from nautto.constants import *
+
+
+class MemberNotFound(LookupError):
+    """
+    Raised when the "items" of a PUT request refer to a resource that
+    doesn't exist. The message is meant to be shown to the client in an
+    error response.
+    """
+
+
+def _member_ids(items, Member):
+    ids = set()
+    for item in items:
+        identifier = str(item.get("id")) if isinstance(item, dict) else ""
+        if not identifier.isdigit():
+            raise MemberNotFound(
+                f'No {Member.__tablename__} was found with id {identifier}'
+            )
+        ids.add(int(identifier))
+    return ids
+
+
+def _select_in(column, ids):
+    found = set()
+    ids = sorted(ids)
+    for start in range(0, len(ids), SQL_MAX_VARIABLES):
+        chunk = ids[start:start + SQL_MAX_VARIABLES]
+        rows = db.session.execute(
+            select([column]).where(column.in_(chunk))
+        )
+        found.update(row[0] for row in rows)
+    return found
+
+
+def update_members(owner, relationship, items, mode=MEMBERSHIP_ADD):
+    """
+    Changes the members of a many-to-many relationship, e.g. the widgets of
+    a layout, with a constant number of queries: the ids are resolved with
+    one IN query per SQL_MAX_VARIABLES ids, the current members are read
+    with another, and the difference is written with one executemany
+    INSERT and one executemany DELETE on the association table, each
+    prepared once for all of its rows. Members that are added again or
+    removed while absent are ignored. Raises MemberNotFound when an item
+    doesn't exist.
+
+    The owner is marked as modified when its members change so that its
+    version is bumped when the session is flushed.
+
+    : param owner: the resource whose members are changed
+    : param relationship: the relationship attribute, e.g. Layout.widgets
+    : param list items: {"id": ...} objects from the request document
+    : param str mode: "add", "remove" or "replace"
+    """
+
+    prop = relationship.property
+    Member = prop.mapper.class_
+    association = prop.secondary
+    owner_column = prop.synchronize_pairs[0][1]
+    member_column = prop.secondary_synchronize_pairs[0][1]
+
+    wanted = _member_ids(items, Member)
+    existing = _select_in(Member.__table__.c.id, wanted)
+    missing = wanted - existing
+    if missing:
+        raise MemberNotFound(
+            f'No {Member.__tablename__} was found with id {min(missing)}'
+        )
+
+    current = {
+        row[0] for row in db.session.execute(
+            select([member_column]).where(owner_column == owner.id)
+        )
+    }
+    if mode == MEMBERSHIP_REPLACE:
+        added, removed = wanted - current, current - wanted
+    elif mode == MEMBERSHIP_REMOVE:
+        added, removed = set(), wanted & current
+    else:
+        added, removed = wanted - current, set()
+
+    owner_key, member_key = owner_column.name, member_column.name
+    if added:
+        db.session.execute(association.insert(), [
+            {owner_key: owner.id, member_key: identifier}
+            for identifier in sorted(added)
+        ])
+    if removed:
+        db.session.execute(
+            association.delete().where(owner_column == owner.id).where(
+                member_column == bindparam("member")
+            ),
+            [{"member": identifier} for identifier in sorted(removed)]
+        )
+    if added or removed:
+        db.session.expire(owner, [prop.key])
+        # works whether or not the column is loaded, unlike flag_modified
+        owner.updated_at = datetime.utcnow()
+    return added, removed
+
+
+def insert_members(relationship, members):
+    """
+    Gives newly created resources, e.g. the layouts of a bulk request, their
+    first members with a constant number of queries: the ids of all of them
+    are resolved together with one IN query per SQL_MAX_VARIABLES ids and
+    written with one executemany INSERT on the association table. Raises
+    MemberNotFound when an item doesn't exist.
+
+    : param relationship: the relationship attribute, e.g. Layout.widgets
+    : param dict members: lists of {"id": ...} objects by the id of their
+        owner
+    """
+
+    prop = relationship.property
+    Member = prop.mapper.class_
+    owner_key = prop.synchronize_pairs[0][1].name
+    member_key = prop.secondary_synchronize_pairs[0][1].name
+
+    wanted = {owner: _member_ids(items, Member) for owner, items in members.items()}
+    ids = set().union(*wanted.values())
+    missing = ids - _select_in(Member.__table__.c.id, ids)
+    if missing:
+        raise MemberNotFound(
+            f'No {Member.__tablename__} was found with id {min(missing)}'
+        )
+    rows = [
+        {owner_key: owner, member_key: identifier}
+        for owner, identifiers in sorted(wanted.items())
+        for identifier in sorted(identifiers)
+    ]
+    if rows:
+        db.session.execute(prop.secondary.insert(), rows)
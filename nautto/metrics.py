@@ -0,0 +1,329 @@
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from flask import Response, current_app, g, request
+
+from nautto.constants import *
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# name: (type, help, buckets)
+METRICS = {
+    "nautto_requests_total": (
+        "counter", "Requests served.", None),
+    "nautto_request_duration_seconds": (
+        "histogram", "Time spent serving requests.", LATENCY_BUCKETS),
+    "nautto_response_size_bytes": (
+        "histogram", "Size of response bodies as sent.", SIZE_BUCKETS),
+    "nautto_db_queries_total": (
+        "counter", "SQL statements executed while serving requests.", None),
+    "nautto_db_duration_seconds_total": (
+        "counter", "Time spent executing SQL statements.", None),
+    "nautto_cache_hits_total": (
+        "counter", "Representation cache hits.", None),
+    "nautto_cache_misses_total": (
+        "counter", "Representation cache misses.", None),
+}
+
+
+class MetricsStore(object):
+    """
+    The metrics of one process. They are kept in memory and written to a
+    file of their own in a directory shared by all worker processes, from
+    which the /metrics endpoint adds them up. Files of workers that have
+    exited are folded into one aggregate file, so that counters never go
+    backwards while the number of files stays bounded as workers are
+    recycled.
+    """
+
+    def __init__(self, directory, flush_interval):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._path = os.path.join(
+            self.directory, f'{self._pid}-{uuid.uuid4().hex[:8]}.json'
+        )
+        self._values = {}
+        self._flushed = 0.0
+
+    def _ensure_process(self):
+        # A store created before a fork must not share its file with the
+        # parent or with sibling workers.
+        if os.getpid() != self._pid:
+            self._reset()
+
+    def inc(self, name, labels, amount=1):
+        with self._lock:
+            self._ensure_process()
+            key = (name, tuple(sorted(labels.items())))
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        with self._lock:
+            self._ensure_process()
+            key = (name, tuple(sorted(labels.items())))
+            # one count per bucket and one for +Inf, then the sum and count
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(buckets) + 3)
+            counts[bisect.bisect_left(buckets, value)] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def flush(self, force=False):
+        """
+        Writes the metrics of this process to its file if the flush interval
+        has passed since the previous write.
+        """
+
+        with self._lock:
+            self._ensure_process()
+            now = time.monotonic()
+            if not force and now - self._flushed < self.flush_interval:
+                return
+            self._flushed = now
+            entries = [
+                [name, dict(labels), value]
+                for (name, labels), value in self._values.items()
+            ]
+        temp = self._path + ".tmp"
+        with open(temp, "w") as handle:
+            json.dump(entries, handle)
+        os.replace(temp, self._path)
+
+    def flush_at_exit(self):
+        """
+        Writes what this process recorded since the last write before it
+        exits, so that it is in the file when the file is folded. Processes
+        that recorded nothing, such as the parent of forked workers, leave
+        no file behind.
+        """
+
+        with self._lock:
+            recorded = os.getpid() == self._pid and bool(self._values)
+        if not recorded:
+            return
+        try:
+            self.flush(force=True)
+        except OSError:
+            # the directory is gone, and nobody is left to read the file
+            pass
+
+    def collect(self):
+        """
+        Reads and adds up the metrics of all processes.
+        """
+
+        with self._directory_lock():
+            self._fold_exited()
+            totals = {}
+            for filename in os.listdir(self.directory):
+                if filename.endswith(".json"):
+                    _add(totals, _read(os.path.join(self.directory, filename)))
+        return totals
+
+    @contextmanager
+    def _directory_lock(self):
+        # Keeps a scrape from reading the files while another worker is
+        # folding them, which would count the folded ones twice
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, METRICS_LOCK_FILE), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _fold_exited(self):
+        # Only where the directory can be locked and processes can be probed
+        if fcntl is None:
+            return
+        exited = [
+            filename for filename in os.listdir(self.directory)
+            if _exited(filename) and filename.endswith((".json", ".tmp"))
+        ]
+        if not exited:
+            return
+        aggregate = os.path.join(self.directory, METRICS_AGGREGATE_FILE)
+        totals = {}
+        _add(totals, _read(aggregate))
+        for filename in exited:
+            if filename.endswith(".json"):
+                _add(totals, _read(os.path.join(self.directory, filename)))
+        entries = [[name, dict(labels), value] for (name, labels), value in totals.items()]
+        with open(aggregate + ".tmp", "w") as handle:
+            json.dump(entries, handle)
+        os.replace(aggregate + ".tmp", aggregate)
+        for filename in exited:
+            try:
+                os.unlink(os.path.join(self.directory, filename))
+            except FileNotFoundError:
+                pass
+
+
+def _exited(filename):
+    # Files are named after the id of the process writing them
+    pid = filename.split("-", 1)[0]
+    if not pid.isdigit() or int(pid) == os.getpid():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return True
+    except OSError:
+        # exists but belongs to someone else
+        return False
+    return False
+
+
+def _read(path):
+    try:
+        with open(path) as handle:
+            return json.load(handle)
+    except (OSError, ValueError):
+        return []
+
+
+def _add(totals, entries):
+    for name, labels, value in entries:
+        if name not in METRICS:
+            continue
+        key = (name, tuple(sorted(labels.items())))
+        if isinstance(value, list):
+            current = totals.setdefault(key, [0] * len(value))
+            totals[key] = [a + b for a, b in zip(current, value)]
+        else:
+            totals[key] = totals.get(key, 0) + value
+
+
+def _format_labels(labels):
+    return ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in labels
+    )
+
+
+def render(totals):
+    """
+    Formats collected metrics in the Prometheus text exposition format.
+
+    : param dict totals: metrics as returned by MetricsStore.collect
+    """
+
+    lines = []
+    for name, (kind, description, buckets) in METRICS.items():
+        series = sorted(
+            (labels, value) for (key, labels), value in totals.items() if key == name
+        )
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {kind}')
+        for labels, value in series:
+            if kind != "histogram":
+                lines.append(f'{name}{{{_format_labels(labels)}}} {value}')
+                continue
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ["+Inf"], value[:-2]):
+                cumulative += count
+                bucket_labels = _format_labels(labels + (("le", bound),))
+                lines.append(f'{name}_bucket{{{bucket_labels}}} {cumulative}')
+            lines.append(f'{name}_sum{{{_format_labels(labels)}}} {value[-2]}')
+            lines.append(f'{name}_count{{{_format_labels(labels)}}} {value[-1]}')
+
+    hits = sum(v for (k, _), v in totals.items() if k == "nautto_cache_hits_total")
+    misses = sum(v for (k, _), v in totals.items() if k == "nautto_cache_misses_total")
+    lines.append("# HELP nautto_cache_hit_ratio Share of representation cache lookups that hit.")
+    lines.append("# TYPE nautto_cache_hit_ratio gauge")
+    lines.append(f'nautto_cache_hit_ratio {hits / (hits + misses) if hits + misses else 0}')
+    return "\n".join(lines) + "\n"
+
+
+def _counting(chunks, on_close):
+    sent = 0
+    try:
+        for chunk in chunks:
+            # uncompressed chunks are ASCII only JSON, so characters are bytes
+            sent += len(chunk)
+            yield chunk
+    finally:
+        if hasattr(chunks, "close"):
+            chunks.close()
+        on_close(sent)
+
+
+def _record_response(response):
+    store = current_app.extensions["metrics"]
+    endpoint = request.endpoint or "unmatched"
+    labels = {"endpoint": endpoint}
+    start = g.get("request_start")
+    queries = g.get("query_stats")
+    cache_hit = g.get("cache_hit")
+
+    status = {
+        "endpoint": endpoint,
+        "method": request.method,
+        "status": str(response.status_code),
+    }
+
+    def record(size):
+        store.inc("nautto_requests_total", status)
+        if start is not None:
+            store.observe("nautto_request_duration_seconds", labels, time.perf_counter() - start)
+        store.observe("nautto_response_size_bytes", labels, size)
+        if queries is not None:
+            store.inc("nautto_db_queries_total", labels, queries.count)
+            store.inc("nautto_db_duration_seconds_total", labels, queries.duration)
+        if cache_hit is not None:
+            store.inc("nautto_cache_hits_total" if cache_hit else "nautto_cache_misses_total", labels)
+        store.flush()
+
+    # Streamed bodies are measured once they have been sent completely.
+    # Passthrough bodies such as files keep their length and must stay as
+    # they are for the server to send them with sendfile.
+    if response.is_streamed and not response.direct_passthrough:
+        response.response = _counting(response.response, record)
+    else:
+        record(response.content_length or 0)
+    return response
+
+
+def init_app(app):
+    """
+    Collects per endpoint request metrics and serves them at /metrics in the
+    Prometheus text format. Every worker process writes its metrics to
+    METRICS_DIR (instance/metrics by default) and the endpoint adds up the
+    files, so the numbers are right whichever worker answers the scrape.
+
+    : param app: the Flask application
+    """
+
+    directory = app.config.get("METRICS_DIR") or os.path.join(app.instance_path, "metrics")
+    os.makedirs(directory, exist_ok=True)
+    store = app.extensions["metrics"] = MetricsStore(
+        directory, app.config.get("METRICS_FLUSH_INTERVAL", METRICS_FLUSH_INTERVAL)
+    )
+    # Workers are recycled and shut down gracefully with a normal exit,
+    # which runs the handlers registered before the fork too
+    atexit.register(store.flush_at_exit)
+    app.after_request(_record_response)
+
+    @app.route("/metrics")
+    def send_metrics():
+        store = app.extensions["metrics"]
+        store.flush(force=True)
+        return Response(render(store.collect()), 200, mimetype=PROMETHEUS)
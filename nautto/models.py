@@ -1,26 +1,44 @@
+import hashlib
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import DDL, MetaData, bindparam, event, inspect, select, union_all
+from sqlalchemy.types import TypeDecorator
+
 from . import db
+from nautto.blobstore import get_store
+from nautto.constants import *
 
+# The primary keys serve lookups by owner and the member indexes lookups the
+# other way, such as the layouts that use a widget.
 set_layouts = db.Table(
     "set_layouts",
     db.Column("set_id", db.Integer, db.ForeignKey("set.id"), primary_key=True),
-    db.Column("layout_id", db.Integer, db.ForeignKey("layout.id"), primary_key=True)
+    db.Column("layout_id", db.Integer, db.ForeignKey("layout.id"), primary_key=True, index=True)
 )
 
 layout_widgets = db.Table(
     "layout_widgets",
     db.Column("layout_id", db.Integer, db.ForeignKey("layout.id"), primary_key=True),
-    db.Column("widget_id", db.Integer, db.ForeignKey("widget.id"), primary_key=True)
+    db.Column("widget_id", db.Integer, db.ForeignKey("widget.id"), primary_key=True, index=True)
 )
 
 class User(db.Model):
     id = db.Column(db.Integer, nullable=False, unique=True, primary_key=True)
-    name = db.Column(db.String(128), nullable=False)
+    name = db.Column(db.String(128), nullable=False, index=True)
     description = db.Column(db.String(1024), nullable=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
     widgets = db.relationship("Widget", back_populates="user", cascade="all, delete-orphan")
     layouts = db.relationship("Layout", back_populates="user", cascade="all, delete-orphan")
     sets = db.relationship("Set", back_populates="user", cascade="all, delete-orphan")
 
+    # Filter and sort query parameters of the collections, with the columns
+    # they apply to. Each of them is served by an index.
+    FILTERS = {"name_prefix": ("name", FILTER_PREFIX)}
+    SORTS = ("id", "name")
+
     def __repr__(self):
         return f'{self.name} <{self.id}>'
 
@@ -46,13 +64,19 @@ class User(db.Model):
 
 class Set(db.Model):
     id = db.Column(db.Integer, nullable=False, unique=True, primary_key=True)
-    name = db.Column(db.String(128), nullable=False)
+    name = db.Column(db.String(128), nullable=False, index=True)
     description = db.Column(db.String(1024), nullable=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"))
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), index=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
     user = db.relationship("User", back_populates="sets", uselist=False)
     layouts = db.relationship("Layout", secondary=set_layouts, back_populates="sets")
 
+    FILTERS = {"name_prefix": ("name", FILTER_PREFIX), "user": ("user_id", FILTER_EQUAL)}
+    SORTS = ("id", "name")
+    __table_args__ = (db.Index("ix_set_user_id_name", "user_id", "name"),)
+
     def __repr__(self):
         return f'{self.name} <{self.id}>'
     
@@ -78,18 +102,29 @@ class Set(db.Model):
             "description": "Layout ids of the set",
             "type": "array"
         }
+        props["membership"] = {
+            "description": "Whether the items are added to the current ones, removed from them or replace them",
+            "type": "string",
+            "enum": ["add", "remove", "replace"]
+        }
         return schema
 
 class Layout(db.Model):
     id = db.Column(db.Integer, nullable=False, unique=True, primary_key=True)
-    name = db.Column(db.String(120), nullable=False)
+    name = db.Column(db.String(120), nullable=False, index=True)
     description = db.Column(db.String(1024), nullable=True)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"))
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), index=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
     user = db.relationship("User", back_populates="layouts", uselist=False)
     widgets = db.relationship("Widget", secondary=layout_widgets, back_populates="layouts")
     sets = db.relationship("Set", secondary=set_layouts, back_populates="layouts")
 
+    FILTERS = {"name_prefix": ("name", FILTER_PREFIX), "user": ("user_id", FILTER_EQUAL)}
+    SORTS = ("id", "name")
+    __table_args__ = (db.Index("ix_layout_user_id_name", "user_id", "name"),)
+
     def __repr__(self):
         return f'{self.name} <{self.id}>'
     
@@ -115,19 +150,131 @@ class Layout(db.Model):
             "description": "Widget ids of the layout",
             "type": "array"
         }
+        props["membership"] = {
+            "description": "Whether the items are added to the current ones, removed from them or replace them",
+            "type": "string",
+            "enum": ["add", "remove", "replace"]
+        }
         return schema
 
+class BlobData(TypeDecorator):
+    """
+    Text that may live in the blob store. Content stored on disk is kept in
+    the column as a BLOB holding its hash, which is never confused with the
+    TEXT of inline content, and is read back from the store transparently.
+    """
+
+    impl = db.Text
+
+    def process_result_value(self, value, dialect):
+        if isinstance(value, bytes):
+            return get_store().read(value.decode("ascii")).decode("utf-8")
+        return value
+
+
+class ContentBlob(db.Model):
+    """
+    Widget content stored once per SHA-256 hash. refs counts the widgets
+    pointing at the blob; it is kept up to date by triggers on the widget
+    table, which also delete the blob when the last reference goes away.
+    Content larger than BLOB_INLINE_MAX bytes is kept in the blob store
+    under the instance folder instead of the database.
+    """
+
+    hash = db.Column(db.String(64), primary_key=True)
+    data = db.Column(BlobData(), nullable=False)
+    refs = db.Column(db.Integer, nullable=False, default=0)
+
+
+# Hashes of deleted blobs whose files are still to be removed from the store
+blob_garbage = db.Table(
+    "blob_garbage",
+    db.Column("hash", db.String(64), primary_key=True)
+)
+
+
+def _written_files(session):
+    # A group commit collects the files of the whole batch once it has ended
+    batch = session.info.get("commit_batch")
+    if batch is not None:
+        return batch.written_blobs
+    return session.info.setdefault("written_blobs", set())
+
+
+def store_contents(session, contents):
+    """
+    Makes sure blobs exist for the given contents and returns their hashes
+    in the same order. Must run in the transaction that then points widgets
+    at the hashes, before the widgets are written. Files written to the
+    blob store are removed again if the transaction doesn't commit.
+
+    : param session: session of the transaction doing the writes
+    : param list contents: content strings
+    """
+
+    inline_max = current_app.config.get("BLOB_INLINE_MAX", BLOB_INLINE_MAX)
+    hashes = []
+    blobs = {}
+    files = {}
+    for content in contents:
+        data = content.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        hashes.append(digest)
+        if digest in blobs:
+            continue
+        if len(data) > inline_max:
+            files[digest] = data
+            blobs[digest] = {"hash": digest, "data": digest.encode("ascii"), "refs": 0}
+        else:
+            blobs[digest] = {"hash": digest, "data": content, "refs": 0}
+    if blobs:
+        session.connection().execute(
+            ContentBlob.__table__.insert().prefix_with("OR IGNORE"), list(blobs.values())
+        )
+    # Files are written after the insert has taken the write lock, so that
+    # collect_blob_garbage can't remove them in between.
+    store = get_store()
+    for digest, data in files.items():
+        if store.put(digest, data):
+            _written_files(session).add(digest)
+    return hashes
+
+
 class Widget(db.Model):
     id = db.Column(db.Integer, nullable=False, unique=True, primary_key=True)
-    name = db.Column(db.String(128), nullable=False)
+    name = db.Column(db.String(128), nullable=False, index=True)
     description = db.Column(db.String(1024), nullable=True)
     type = db.Column(db.String(64), nullable=False)
-    content = db.Column(db.Text(), nullable=False)
-    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"))
+    content_hash = db.Column(
+        db.String(64), db.ForeignKey("content_blob.hash"), nullable=False, index=True
+    )
+    # Read through the blob. Assigned values are stored by store_widget_contents.
+    content = db.column_property(
+        select([ContentBlob.data]).where(ContentBlob.hash == content_hash).as_scalar()
+    )
+    user_id = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), index=True)
+    version = db.Column(db.Integer, nullable=False, default=1)
+    updated_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
 
     user = db.relationship("User", back_populates="widgets", uselist=False)
     layouts = db.relationship("Layout", secondary=layout_widgets, back_populates="widgets")
 
+    FILTERS = {
+        "type": ("type", FILTER_EQUAL),
+        "name_prefix": ("name", FILTER_PREFIX),
+        "user": ("user_id", FILTER_EQUAL),
+    }
+    SORTS = ("id", "name", "type")
+    # Every filter has an index for each sort column, which serves the
+    # filtered rows in the sorted order. Ties are ordered by the id, the
+    # rowid at the end of every index.
+    __table_args__ = (
+        db.Index("ix_widget_type", "type"),
+        db.Index("ix_widget_type_name", "type", "name"),
+        db.Index("ix_widget_user_id_name", "user_id", "name"),
+        db.Index("ix_widget_user_id_type", "user_id", "type"),
+    )
+
     def __repr__(self):
         return f'{self.name} <{self.id}>'
     
@@ -159,6 +306,425 @@ class Widget(db.Model):
         }
         return schema
 
+class TableVersion(db.Model):
+    """
+    Change counter of a table. It is bumped in the same transaction as every
+    flush that inserts, modifies or deletes rows of the table, which makes it
+    a cheap validator for collection responses.
+    """
+
+    name = db.Column(db.String(64), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=True)
+
+
+class SetSnapshot(db.Model):
+    """
+    Materialized resolved tree of a set, as served by the tree endpoint.
+    Snapshots are dropped in the transaction of any write to the set or to
+    a layout or widget they contain, found through the snapshot_layouts and
+    snapshot_widgets dependency index, and rebuilt after the next read.
+    Widget content is referred to by hash and read when the tree is served.
+    """
+
+    set_id = db.Column(
+        db.Integer,
+        db.ForeignKey("set.id", ondelete="CASCADE", onupdate="CASCADE"),
+        primary_key=True
+    )
+    data = db.Column(db.Text, nullable=False)
+    digest = db.Column(db.String(40), nullable=False)
+    built_at = db.Column(db.DateTime, nullable=False)
+
+
+# Reverse dependency index of the snapshots. Layouts and widgets have no
+# foreign key here: their rows must still be found when they are deleted.
+snapshot_layouts = db.Table(
+    "snapshot_layouts",
+    db.Column("layout_id", db.Integer, primary_key=True),
+    db.Column(
+        "set_id", db.Integer,
+        db.ForeignKey("set_snapshot.set_id", ondelete="CASCADE", onupdate="CASCADE"),
+        primary_key=True, index=True
+    )
+)
+
+snapshot_widgets = db.Table(
+    "snapshot_widgets",
+    db.Column("widget_id", db.Integer, primary_key=True),
+    db.Column(
+        "set_id", db.Integer,
+        db.ForeignKey("set_snapshot.set_id", ondelete="CASCADE", onupdate="CASCADE"),
+        primary_key=True, index=True
+    )
+)
+
+
+# The reference counts of content blobs follow every write to the widget
+# table, including the ones that bypass the ORM.
+CONTENT_TRIGGERS = [
+    """
+    CREATE TRIGGER widget_content_insert AFTER INSERT ON widget BEGIN
+        UPDATE content_blob SET refs = refs + 1 WHERE hash = NEW.content_hash;
+    END
+    """,
+    """
+    CREATE TRIGGER widget_content_update AFTER UPDATE OF content_hash ON widget
+    WHEN OLD.content_hash IS NOT NEW.content_hash BEGIN
+        UPDATE content_blob SET refs = refs + 1 WHERE hash = NEW.content_hash;
+        UPDATE content_blob SET refs = refs - 1 WHERE hash = OLD.content_hash;
+        DELETE FROM content_blob WHERE hash = OLD.content_hash AND refs <= 0;
+    END
+    """,
+    """
+    CREATE TRIGGER widget_content_delete AFTER DELETE ON widget BEGIN
+        UPDATE content_blob SET refs = refs - 1 WHERE hash = OLD.content_hash;
+        DELETE FROM content_blob WHERE hash = OLD.content_hash AND refs <= 0;
+    END
+    """,
+]
+
+for trigger in CONTENT_TRIGGERS:
+    event.listen(Widget.__table__, "after_create", DDL(trigger))
+
+event.listen(ContentBlob.__table__, "after_create", DDL(
+    """
+    CREATE TRIGGER content_blob_file_delete AFTER DELETE ON content_blob
+    WHEN typeof(OLD.data) = 'blob' BEGIN
+        INSERT OR IGNORE INTO blob_garbage (hash) VALUES (OLD.hash);
+    END
+    """
+))
+
+
+def _search_ddl(table, source, columns):
+    # The index is deleted from before a row changes, while the source still
+    # has the values that were indexed, and added to after it has changed.
+    name = f'{table}_search'
+    indexed = ", ".join(columns)
+    rows = f'SELECT id, {indexed} FROM "{source}"'
+    return [
+        f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS {name} USING fts5(
+            {indexed}, content='{source}', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {name}_insert AFTER INSERT ON "{table}" BEGIN
+            INSERT INTO {name} (rowid, {indexed}) {rows} WHERE id = NEW.id;
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {name}_update_old
+        BEFORE UPDATE OF id, {", ".join(SEARCH_WATCHED[table])} ON "{table}" BEGIN
+            INSERT INTO {name} ({name}, rowid, {indexed})
+            SELECT 'delete', id, {indexed} FROM "{source}" WHERE id = OLD.id;
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {name}_update_new
+        AFTER UPDATE OF id, {", ".join(SEARCH_WATCHED[table])} ON "{table}" BEGIN
+            INSERT INTO {name} (rowid, {indexed}) {rows} WHERE id = NEW.id;
+        END
+        """,
+        f"""
+        CREATE TRIGGER IF NOT EXISTS {name}_delete BEFORE DELETE ON "{table}" BEGIN
+            INSERT INTO {name} ({name}, rowid, {indexed})
+            SELECT 'delete', id, {indexed} FROM "{source}" WHERE id = OLD.id;
+        END
+        """,
+    ]
+
+
+# Full-text search indexes, FTS5 tables with external content kept in step
+# with their tables by triggers. The widget index reads content through a
+# view on the blob table; content kept in the blob store isn't indexed.
+SEARCH_DDL = {
+    Layout: _search_ddl("layout", "layout", SEARCH_COLUMNS["layout"]),
+    Set: _search_ddl("set", "set", SEARCH_COLUMNS["set"]),
+    Widget: [
+        """
+        CREATE VIEW IF NOT EXISTS widget_search_source AS
+        SELECT widget.id AS id, widget.name AS name, widget.description AS description,
+            CASE WHEN typeof(content_blob.data) = 'text' THEN content_blob.data END AS content
+        FROM widget LEFT JOIN content_blob ON content_blob.hash = widget.content_hash
+        """,
+    ] + _search_ddl("widget", "widget_search_source", SEARCH_COLUMNS["widget"]),
+}
+
+for Model, statements in SEARCH_DDL.items():
+    for statement in statements:
+        event.listen(Model.__table__, "after_create", DDL(statement))
+    event.listen(Model.__table__, "before_drop", DDL(
+        f'DROP TABLE IF EXISTS {Model.__tablename__}_search'
+    ))
+event.listen(Widget.__table__, "before_drop", DDL("DROP VIEW IF EXISTS widget_search_source"))
+
+
+def create_search_indexes(connection):
+    """
+    Creates the full-text search indexes that are missing from a database
+    made by an older version and fills them from their tables. Returns the
+    names of the created indexes.
+
+    : param connection: connection to run the statements on
+    """
+
+    created = []
+    for Model, statements in SEARCH_DDL.items():
+        name = f'{Model.__tablename__}_search'
+        if connection.dialect.has_table(connection, name):
+            continue
+        for statement in statements:
+            connection.execute(statement)
+        connection.execute(f"INSERT INTO {name} ({name}) VALUES ('rebuild')")
+        created.append(name)
+    return created
+
+
+def _columns(connection, table):
+    return {row[1] for row in connection.execute(f'PRAGMA table_info("{table}")')}
+
+
+def add_missing_columns(connection):
+    """
+    Adds the columns that are missing from the tables of a database made by
+    an older version. Existing rows start at version 1 and are updated at
+    the time of the migration. Widget content hashes are left empty for
+    move_widget_contents to fill in. Returns the names of the added columns.
+
+    : param connection: connection to run the statements on
+    """
+
+    # the format SQLAlchemy stores DateTime columns in on SQLite
+    now = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S.%f")
+    defaults = {"version": "NOT NULL DEFAULT 1", "updated_at": f"NOT NULL DEFAULT '{now}'"}
+    added = []
+    for table in db.metadata.sorted_tables:
+        existing = _columns(connection, table.name)
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            definition = column.type.compile(dialect=connection.dialect)
+            connection.execute(
+                f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" {definition} '
+                + defaults.get(column.name, "")
+            )
+            added.append(f'{table.name}.{column.name}')
+    return added
+
+
+def move_widget_contents(connection):
+    """
+    Moves the content of widgets made by an older version, kept in the
+    widget table itself, to content blobs. The widget table is then rebuilt
+    without the content column, with its content hashes required and the
+    triggers counting blob references. Returns whether there was anything
+    to move.
+
+    : param connection: connection in a transaction, with foreign keys off
+    """
+
+    if "content" not in _columns(connection, "widget"):
+        return False
+    rows = connection.execute("SELECT id, content FROM widget").fetchall()
+    session = db.session.session_factory(bind=connection, binds={})
+    hashes = store_contents(session, [content for id, content in rows])
+    # Only ends the part of the session in the transaction of the connection
+    session.commit()
+    if rows:
+        connection.execute(
+            Widget.__table__.update()
+            .where(Widget.__table__.c.id == bindparam("widget_id"))
+            .values(content_hash=bindparam("digest")),
+            [{"widget_id": id, "digest": digest} for (id, content), digest in zip(rows, hashes)]
+        )
+
+    # The search index of the old table is rebuilt by create_search_indexes
+    connection.execute("DROP VIEW IF EXISTS widget_search_source")
+    connection.execute("DROP TABLE IF EXISTS widget_search")
+    metadata = MetaData()
+    for table in db.metadata.sorted_tables:
+        table.tometadata(metadata)
+    rebuilt = Widget.__table__.tometadata(metadata, name="widget_migrated")
+    # created on the renamed table afterwards
+    rebuilt.indexes.clear()
+    rebuilt.create(connection)
+    columns = ", ".join(f'"{column.name}"' for column in rebuilt.columns)
+    connection.execute(f"INSERT INTO widget_migrated ({columns}) SELECT {columns} FROM widget")
+    connection.execute("DROP TABLE widget")
+    connection.execute("ALTER TABLE widget_migrated RENAME TO widget")
+    for trigger in CONTENT_TRIGGERS:
+        connection.execute(trigger)
+    connection.execute(
+        "UPDATE content_blob SET refs = "
+        "(SELECT count(*) FROM widget WHERE widget.content_hash = content_blob.hash)"
+    )
+    return True
+
+
+VERSIONED_MODELS = (User, Set, Layout, Widget)
+
+
+@event.listens_for(db.session, "before_flush")
+def store_widget_contents(session, flush_context, instances):
+    widgets = [
+        obj for obj in list(session.new) + list(session.dirty)
+        if isinstance(obj, Widget) and inspect(obj).attrs.content.history.added
+    ]
+    # Replaced or deleted content may leave files to collect after commit
+    if any(isinstance(obj, Widget) for obj in session.deleted) or any(
+        obj in session.dirty for obj in widgets
+    ):
+        session.info["blob_garbage"] = True
+    if not widgets:
+        return
+    hashes = store_contents(session, [obj.content for obj in widgets])
+    for obj, digest in zip(widgets, hashes):
+        obj.content_hash = digest
+
+
+@event.listens_for(db.session, "before_flush")
+def bump_row_versions(session, flush_context, instances):
+    now = datetime.utcnow()
+    for obj in session.dirty:
+        if isinstance(obj, VERSIONED_MODELS) and session.is_modified(obj):
+            obj.version = type(obj).version + 1
+            obj.updated_at = now
+
+
+def _changed(session, new=True):
+    # new, dirty and deleted still hold the pre-flush state in after_flush,
+    # including objects removed through cascades
+    changed = list(session.deleted) + [
+        obj for obj in session.dirty if session.is_modified(obj)
+    ]
+    if new:
+        changed.extend(session.new)
+    return [obj for obj in changed if isinstance(obj, VERSIONED_MODELS)]
+
+
+@event.listens_for(db.session, "after_flush")
+def bump_table_versions(session, flush_context):
+    names = {obj.__table__.name for obj in _changed(session)}
+    if names:
+        touch_tables(session.connection(), names)
+
+
+@event.listens_for(db.session, "after_flush")
+def drop_snapshots(session, flush_context):
+    # New rows can't be part of a snapshot yet. Ids are taken both before
+    # and after the flush, which may have changed them.
+    ids = {Set: set(), Layout: set(), Widget: set()}
+    for obj in _changed(session, new=False):
+        if type(obj) in ids:
+            ids[type(obj)].add(obj.id)
+            ids[type(obj)].update(inspect(obj).attrs.id.history.deleted)
+    if not any(ids.values()):
+        return
+
+    # One IN over a union, as OR-ed IN conditions make SQLite scan the table
+    table = SetSnapshot.__table__
+    sources = [
+        select([column]).where(key.in_(ids[Model]))
+        for Model, column, key in (
+            (Set, table.c.set_id, table.c.set_id),
+            (Layout, snapshot_layouts.c.set_id, snapshot_layouts.c.layout_id),
+            (Widget, snapshot_widgets.c.set_id, snapshot_widgets.c.widget_id),
+        )
+        if ids[Model]
+    ]
+    session.connection().execute(
+        table.delete().where(table.c.set_id.in_(union_all(*sources)))
+    )
+
+
+@event.listens_for(db.session, "after_commit")
+def remove_blob_files(session):
+    # rows point at the written files now
+    session.info.pop("written_blobs", None)
+    if session.info.pop("blob_garbage", False):
+        batch = session.info.get("commit_batch")
+        if batch is not None:
+            # the group commit collects once the batch is in the database
+            batch.blob_garbage = True
+        else:
+            collect_blob_garbage()
+
+
+@event.listens_for(db.session, "after_rollback")
+def forget_blob_files(session):
+    session.info.pop("blob_garbage", None)
+
+
+@event.listens_for(db.session, "after_transaction_end")
+def remove_unused_blob_files(session, transaction):
+    # Files written by a transaction that was rolled back or closed without
+    # committing have no blob row pointing at them
+    if transaction.parent is None:
+        written = session.info.pop("written_blobs", None)
+        if written:
+            collect_blob_garbage(written)
+
+
+def collect_blob_garbage(candidates=()):
+    """
+    Removes the files of deleted blobs from the blob store, and those of
+    the given hashes that have no blob. Runs in a transaction of its own,
+    which holds the write lock while checking that no blob with the same
+    hash has been stored again since.
+
+    : param candidates: hashes of files written by transactions that ended
+        without committing
+    """
+
+    store = get_store()
+    with db.engine.begin() as connection:
+        hashes = {row[0] for row in connection.execute(select([blob_garbage.c.hash]))}
+        hashes.update(candidates)
+        if not hashes:
+            return
+        table = ContentBlob.__table__
+        alive = set()
+        ordered = sorted(hashes)
+        for start in range(0, len(ordered), SQL_MAX_VARIABLES):
+            chunk = ordered[start:start + SQL_MAX_VARIABLES]
+            # the delete takes the write lock before the blobs are checked
+            connection.execute(blob_garbage.delete().where(blob_garbage.c.hash.in_(chunk)))
+            alive.update(
+                row[0] for row in connection.execute(
+                    select([table.c.hash]).where(table.c.hash.in_(chunk))
+                )
+            )
+        for digest in hashes - alive:
+            store.remove(digest)
+
+
+def touch_tables(connection, names):
+    """
+    Bumps the change counters of the given tables. Writes that bypass the
+    ORM, such as bulk inserts, must call this themselves in their
+    transaction.
+
+    : param connection: connection of the transaction doing the writes
+    : param names: names of the changed tables
+    """
+
+    table = TableVersion.__table__
+    now = datetime.utcnow()
+    for name in sorted(names):
+        connection.execute(
+            table.insert().prefix_with("OR IGNORE"),
+            name=name, version=0
+        )
+        connection.execute(
+            table.update().where(table.c.name == name).values(
+                version=table.c.version + 1, updated_at=now
+            )
+        )
+
+
 
 import click
 from flask.cli import with_appcontext
@@ -169,6 +735,43 @@ def db_init_cmd():
     db.create_all()
     print("done")
 
+@click.command("db-migrate")
+@with_appcontext
+def db_migrate_cmd():
+    # Brings a database made by an older version up to date. Only what is
+    # missing is created, so running it again does nothing. Everything runs
+    # in one transaction, which pysqlite would otherwise commit before each
+    # ALTER TABLE, with foreign keys off while the widget table is rebuilt.
+    with db.get_engine().connect() as connection:
+        dbapi_connection = connection.connection.connection
+        isolation_level = dbapi_connection.isolation_level
+        dbapi_connection.isolation_level = None
+        foreign_keys = connection.execute("PRAGMA foreign_keys").scalar()
+        connection.execute("PRAGMA foreign_keys=OFF")
+        try:
+            with connection.begin():
+                connection.execute("BEGIN")
+                db.metadata.create_all(bind=connection)
+                for name in add_missing_columns(connection):
+                    print(f'added column {name}')
+                if move_widget_contents(connection):
+                    print("moved widget contents to content_blob")
+                inspector = inspect(connection)
+                for table in db.metadata.sorted_tables:
+                    existing = {index["name"] for index in inspector.get_indexes(table.name)}
+                    for index in table.indexes:
+                        if index.name not in existing:
+                            index.create(connection)
+                            print(f'created index {index.name}')
+                for name in create_search_indexes(connection):
+                    print(f'created search index {name}')
+                if connection.execute("PRAGMA foreign_key_check").first() is not None:
+                    raise click.ClickException("migrated rows break foreign keys")
+        finally:
+            connection.execute(f"PRAGMA foreign_keys={foreign_keys}")
+            dbapi_connection.isolation_level = isolation_level
+    print("done")
+
 @click.command("db-drop")
 @with_appcontext
 def db_drop_cmd():
@@ -0,0 +1,211 @@
+import base64
+import binascii
+import json
+
+from flask import request, url_for
+from sqlalchemy import tuple_
+
+from nautto.constants import *
+
+
+class PaginationError(ValueError):
+    """
+    Raised when the pagination query parameters of a request are malformed.
+    The message is meant to be shown to the client in an error response.
+    """
+
+
+def encode_cursor(key):
+    """
+    Turns a primary key value, or the sort value and primary key of a row,
+    into an opaque cursor string that is safe to use in query parameters.
+
+    : param key: primary key of the row the cursor points to, or a
+        [sort value, primary key] list
+    """
+
+    raw = (json.dumps(key) if isinstance(key, list) else str(key)).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, pair=False):
+    """
+    Reverses encode_cursor. Raises PaginationError if the cursor was not
+    produced by encode_cursor.
+
+    : param str cursor: cursor string from the query parameters
+    : param bool pair: whether the cursor holds a sort value as well
+    """
+
+    padded = cursor + "=" * (-len(cursor) % 4)
+    try:
+        raw = base64.urlsafe_b64decode(padded.encode("ascii")).decode("utf-8")
+        if not pair:
+            return int(raw)
+        value, key = json.loads(raw)
+        if isinstance(value, (list, dict)):
+            raise ValueError()
+        return value, int(key)
+    except (binascii.Error, UnicodeError, ValueError, TypeError):
+        raise PaginationError(f'Invalid cursor {cursor!r}')
+
+
+def parse_limit(value, default, maximum):
+    if value is None:
+        return default
+    if value == UNLIMITED:
+        return None
+    try:
+        limit = int(value)
+    except ValueError:
+        raise PaginationError(f'Limit must be an integer, got {value!r}')
+    if not 1 <= limit <= maximum:
+        raise PaginationError(f'Limit must be between 1 and {maximum}')
+    return limit
+
+
+class Page(object):
+    """
+    One page of a keyset paginated query. Rows are always ordered by the key
+    column, or by a sort column and the key. The cursors of the neighbouring
+    pages are None when there is nothing to link to. When the whole
+    collection was requested the limit is None and rows is a lazy iterator
+    instead of a list.
+    """
+
+    def __init__(self, rows, limit, next_cursor=None, prev_cursor=None, explicit_limit=False):
+        self.rows = rows
+        self.limit = limit
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+        self.explicit_limit = explicit_limit
+
+    def link_args(self, **cursor):
+        """
+        Returns the query arguments for a link to a neighbouring page. The
+        limit is only repeated if the client chose it. Other query arguments
+        of the current request, such as "fields", are carried over with all
+        of their values, so that repeated filters stay in the links.
+        """
+
+        args = {
+            name: values for name, values in request.args.lists()
+            if name not in PAGE_ARGS
+        }
+        args.update(cursor)
+        if self.explicit_limit:
+            args["limit"] = self.limit
+        return args
+
+
+def paginate(query, key, default_limit=PAGE_SIZE, max_limit=MAX_PAGE_SIZE,
+             sort=None, descending=False):
+    """
+    Applies keyset pagination to a query using the "after", "before" and
+    "limit" query parameters of the current request. Because the page is
+    selected with a range condition on the key instead of an OFFSET, the cost
+    of fetching a page does not depend on how deep it is.
+
+    Rows are ordered by the key, or by a sort column with the key breaking
+    ties, in which case the cursors hold both values and the range condition
+    compares them as a row value so that an index on the sort column serves
+    it.
+
+    With "limit=all" every remaining row is returned. The rows are then
+    fetched lazily in chunks of STREAM_CHUNK_SIZE so that the collection can
+    be streamed without holding it in memory.
+
+    : param query: SQLAlchemy query to paginate
+    : param key: the column to build cursors from, usually the primary key of
+        the model
+    : param int default_limit: page size when the request doesn't give one
+    : param int max_limit: largest accepted page size
+    : param sort: column to order by before the key, None for the key only
+    : param bool descending: whether to order from the largest value down
+    """
+
+    after = request.args.get("after")
+    before = request.args.get("before")
+    if after is not None and before is not None:
+        raise PaginationError("Only one of 'after' and 'before' can be given")
+    limit = parse_limit(request.args.get("limit"), default_limit, max_limit)
+    explicit_limit = "limit" in request.args
+
+    if sort is key:
+        sort = None
+    columns = [key] if sort is None else [sort, key]
+    query = query.add_columns(*columns)
+
+    def beyond(cursor, forwards):
+        # rows past a cursor in the given direction of the order
+        if sort is None:
+            bound, value = key, decode_cursor(cursor)
+        else:
+            bound, value = tuple_(*columns), tuple_(*decode_cursor(cursor, pair=True))
+        return bound > value if forwards != descending else bound < value
+
+    def ordered(forwards):
+        ascending = forwards != descending
+        return query.order_by(*[
+            column.asc() if ascending else column.desc() for column in columns
+        ])
+
+    def cursor(row):
+        return encode_cursor(row[1] if sort is None else list(row[1:]))
+
+    if limit is None:
+        if after is not None:
+            query = query.filter(beyond(after, True))
+        if before is not None:
+            query = query.filter(beyond(before, False))
+        rows = ordered(True).yield_per(STREAM_CHUNK_SIZE)
+        return Page((row[0] for row in rows), None, explicit_limit=explicit_limit)
+
+    if before is not None:
+        query = query.filter(beyond(before, False))
+        rows = ordered(False).limit(limit + 1).all()
+        has_more = len(rows) > limit
+        rows = rows[:limit][::-1]
+        page = Page([row[0] for row in rows], limit, explicit_limit=explicit_limit)
+        if rows:
+            page.next_cursor = cursor(rows[-1])
+            if has_more:
+                page.prev_cursor = cursor(rows[0])
+        return page
+
+    if after is not None:
+        query = query.filter(beyond(after, True))
+    rows = ordered(True).limit(limit + 1).all()
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    page = Page([row[0] for row in rows], limit, explicit_limit=explicit_limit)
+    if has_more:
+        page.next_cursor = cursor(rows[-1])
+    if after is not None and rows:
+        page.prev_cursor = cursor(rows[0])
+    return page
+
+
+def add_page_controls(body, page, endpoint, **values):
+    """
+    Adds Mason "next" and "prev" controls for the neighbouring pages of a
+    paginated collection to a response body.
+
+    : param body: the MasonBuilder to add the controls to
+    : param Page page: the current page
+    : param str endpoint: endpoint name of the paginated resource
+    : param values: URL values of the endpoint
+    """
+
+    if page.next_cursor is not None:
+        body.add_control(
+            "next",
+            url_for(endpoint, **values, **page.link_args(after=page.next_cursor)),
+            title="Next page"
+        )
+    if page.prev_cursor is not None:
+        body.add_control(
+            "prev",
+            url_for(endpoint, **values, **page.link_args(before=page.prev_cursor)),
+            title="Previous page"
+        )
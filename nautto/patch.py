@@ -0,0 +1,52 @@
+import copy
+
+from flask import request
+
+from nautto.projection import selectable_fields
+from nautto.constants import *
+
+
+def patch_schema(Model):
+    """
+    Derives the schema of JSON Merge Patch documents (RFC 7396) for a model
+    from its full schema. Nothing is required, and attributes that can be
+    empty accept null, which removes their value.
+
+    : param Model: the model whose schema is used
+    """
+
+    schema = copy.deepcopy(Model.get_schema())
+    schema.pop("required", None)
+    columns = Model.__table__.columns
+    for name, prop in schema["properties"].items():
+        if name in columns and columns[name].nullable:
+            prop["type"] = [prop["type"], "null"]
+    return schema
+
+
+def read_patch():
+    """
+    Returns the merge patch document of the current request, or None when
+    the request isn't sent as application/merge-patch+json.
+    """
+
+    if request.mimetype != MERGE_PATCH:
+        return None
+    return request.get_json(force=True)
+
+
+def apply_patch(obj, patch):
+    """
+    Sets the attributes of a model instance that are present in a validated
+    merge patch. Only the columns named in the patch are set, so the UPDATE
+    written for them leaves the other columns, such as the content of a
+    widget, alone; they don't even have to be loaded. Keys that aren't
+    attributes of the schema, like "items", are left to the caller.
+
+    : param obj: the model instance to change
+    : param dict patch: the merge patch document
+    """
+
+    for name in selectable_fields(type(obj)):
+        if name in patch:
+            setattr(obj, name, patch[name])
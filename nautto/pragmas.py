@@ -0,0 +1,58 @@
+import re
+
+from sqlalchemy import event
+
+from nautto import db
+from nautto.constants import *
+
+_VALUE = re.compile(r"^-?\d+$|^[A-Za-z_]+$")
+
+
+def resolve_pragmas(config):
+    """
+    Returns the pragmas to set on every new database connection: those of
+    the SQLITE_PROFILE profile updated with SQLITE_PRAGMAS. Names must be
+    known pragmas and values integers or keywords, since they are written
+    into the statements. Raises ValueError otherwise.
+
+    : param config: configuration of the application
+    """
+
+    name = config.get("SQLITE_PROFILE", SQLITE_PROFILE)
+    if name not in SQLITE_PROFILES:
+        raise ValueError(
+            f'Unknown SQLite profile {name!r}, expected one of {", ".join(SQLITE_PROFILES)}'
+        )
+    pragmas = dict(SQLITE_PROFILES[name])
+    pragmas.update(config.get("SQLITE_PRAGMAS") or {})
+    for pragma, value in pragmas.items():
+        if pragma not in SQLITE_PRAGMA_NAMES:
+            raise ValueError(f'Unsupported SQLite pragma {pragma!r}')
+        if not _VALUE.match(str(value)):
+            raise ValueError(f'Invalid value {value!r} for SQLite pragma {pragma}')
+    return pragmas
+
+
+def apply_pragmas(dbapi_connection, pragmas):
+    cursor = dbapi_connection.cursor()
+    for pragma, value in pragmas.items():
+        cursor.execute(f'PRAGMA {pragma}={value}')
+    cursor.close()
+
+
+def init_app(app):
+    """
+    Sets the pragmas of the configured profile on every connection the
+    engine of the application opens. The listener is attached to that
+    engine only, so applications with different settings can live in one
+    process.
+
+    : param app: the Flask application
+    """
+
+    pragmas = resolve_pragmas(app.config)
+    engine = db.get_engine(app)
+
+    @event.listens_for(engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        apply_pragmas(dbapi_connection, pragmas)
@@ -0,0 +1,88 @@
+from flask import request
+from sqlalchemy import inspect
+from sqlalchemy.orm import load_only
+
+from nautto.constants import *
+
+
+class FieldsError(ValueError):
+    """
+    Raised when the "fields" or "embed" query parameters of a request name
+    attributes or relations that the listed resource does not have. The
+    message is meant to be shown to the client in an error response.
+    """
+
+
+def selectable_fields(Model):
+    """
+    Returns the names of the attributes of a model that can be listed, in the
+    order of its schema.
+    """
+
+    columns = inspect(Model).column_attrs.keys()
+    return [name for name in Model.get_schema()["properties"] if name in columns]
+
+
+def parse_fields(Model, default=LIST_FIELDS):
+    """
+    Reads the sparse fieldset of the current request from the "fields" query
+    parameter, a comma separated list of attribute names. The id is always
+    included and comes first. Raises FieldsError for unknown attributes.
+
+    : param Model: the model whose attributes are listed
+    : param tuple default: fields used when the request doesn't give any
+    """
+
+    value = request.args.get("fields")
+    if value is None:
+        return list(default)
+
+    allowed = selectable_fields(Model)
+    fields = ["id"]
+    for name in value.split(","):
+        name = name.strip()
+        if name not in allowed:
+            raise FieldsError(
+                f'Unknown field {name!r}, expected some of {", ".join(allowed)}'
+            )
+        if name not in fields:
+            fields.append(name)
+    return fields
+
+
+def project(query, Model, fields):
+    """
+    Restricts a query to load only the given columns of a model so that large
+    columns, such as the content of widgets, are not read from the database
+    when they are not rendered.
+
+    : param query: SQLAlchemy query returning instances of Model
+    : param Model: the model whose columns are selected
+    : param list fields: names of the columns to load
+    """
+
+    return query.options(load_only(*[getattr(Model, name) for name in fields]))
+
+
+def parse_embed(allowed):
+    """
+    Reads the relations to expand inline from the "embed" query parameter of
+    the current request, a comma separated list. Raises FieldsError for
+    relations that can't be embedded.
+
+    : param tuple allowed: names of the relations that can be embedded
+    """
+
+    value = request.args.get("embed")
+    if value is None:
+        return set()
+
+    embed = set()
+    for name in value.split(","):
+        name = name.strip()
+        if name not in allowed:
+            raise FieldsError(
+                f'Unknown relation {name!r}, expected some of {", ".join(allowed)}'
+            )
+        embed.add(name)
+    return embed
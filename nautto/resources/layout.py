@@ -1,35 +1,83 @@
 import json
 
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from flask import Response, request, url_for
 from flask_restful import Resource
 from sqlalchemy.exc import IntegrityError
 
-from nautto.models import User, Widget, Layout
+from nautto.models import User, Widget, Layout, layout_widgets
 from nautto import db
 from nautto.utils import NauttoBuilder, create_error_response
+from nautto.pagination import PaginationError, paginate, add_page_controls
+from nautto.filtering import FilterError, paginate_collection
+from nautto.search import SearchError
+from nautto.projection import FieldsError, parse_embed, parse_fields, project, selectable_fields
+from nautto.streaming import stream_collection
+from nautto.urls import url_template
+from nautto.validation import validate, validate_patch
+from nautto.patch import apply_patch, read_patch
+from nautto.conditional import collection_validators, item_validators
+from nautto.cache import cached_response, cache_response, invalidate, layout_dependents
+from nautto.membership import MemberNotFound, insert_members, update_members
+from nautto.bulk import BulkError, create_many, read_documents
 from nautto.constants import *
 
 
+def _layout_items(rows, fields):
+    item_url = url_template("api.layoutitem")
+    for db_layout in rows:
+        item = NauttoBuilder((field, getattr(db_layout, field)) for field in fields)
+        item.add_control("self", item_url(layout=db_layout.id))
+        item.add_control("profile", LAYOUT_PROFILE)
+        yield item
+
+
+def _widget_of_layout_items(rows, fields, layout):
+    item_url = url_template("api.widgetoflayout")
+    for widget in rows:
+        item = NauttoBuilder((field, getattr(widget, field)) for field in fields)
+        item.add_control("self", item_url(widget=widget.id, layout=layout))
+        item.add_control("profile", WIDGET_PROFILE)
+        yield item
+
+
 class LayoutsByUserCollection(Resource):
 
     def get(self, user):
+        validators = collection_validators("layout")
+        not_modified = validators.not_modified()
+        if not_modified is not None:
+            return not_modified
+
+        try:
+            fields = parse_fields(Layout)
+            page = paginate_collection(
+                project(Layout.query.filter_by(user_id=user), Layout, fields), Layout
+            )
+        except (PaginationError, FieldsError, FilterError, SearchError) as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
         body = NauttoBuilder()
         body.add_namespace("nautto", LINK_RELATIONS_URL)
         body.add_control("self", url_for("api.layoutsbyusercollection", user=user))
         body.add_control_add_resource('layout', url_for("api.layoutsbyusercollection", user=user))
         body.add_control("author", url_for("api.useritem", user=user))
         body.add_control("nautto:layouts-all", url_for("api.layoutcollection"))
-        body["items"] = []
-        for db_layout in Layout.query.filter_by(user_id=user):
-            item = NauttoBuilder(id=db_layout.id, name=db_layout.name)
-            item.add_control("self", url_for("api.layoutitem", layout=db_layout.id))
-            item.add_control("profile", LAYOUT_PROFILE)
-            body["items"].append(item)
+        add_page_controls(body, page, "api.layoutsbyusercollection", user=user)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return validators.apply(stream_collection(body, _layout_items(page.rows, fields)))
 
     def post(self, user):
+        try:
+            documents = read_documents()
+        except BulkError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+        if documents is not None:
+            return create_many(
+                Layout, user, documents, "api.layoutitem", LAYOUT_PROFILE,
+                members=Layout.widgets
+            )
+
         if not request.json:
             return create_error_response(
                 415, "Unsupported media type",
@@ -37,7 +85,7 @@ class LayoutsByUserCollection(Resource):
             )
 
         try:
-            validate(request.json, Layout.get_schema())
+            validate(request.json, Layout)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -61,13 +109,19 @@ class LayoutsByUserCollection(Resource):
 
         try:
             db.session.add(layout)
+            db.session.flush()
+            layout_id = layout.id
+            if ('items' in request.json and
+                    request.json.get("membership") != MEMBERSHIP_REMOVE):
+                insert_members(Layout.widgets, {layout_id: request.json["items"]})
             db.session.commit()
         except IntegrityError as e:
             return create_error_response(409, "Already exists", str(e))
+        except MemberNotFound as e:
+            return create_error_response(404, "Not found", str(e))
 
-        db_layout = Layout.query.filter_by(id=layout.id).first()
         headers = {
-            "Location": url_for("api.layoutitem", layout=db_layout.id)
+            "Location": url_for("api.layoutitem", layout=layout_id)
         }
         return Response(status=201, headers=headers)
 
@@ -75,23 +129,43 @@ class LayoutsByUserCollection(Resource):
 class LayoutCollection(Resource):
 
     def get(self):
+        validators = collection_validators("layout")
+        not_modified = validators.not_modified()
+        if not_modified is not None:
+            return not_modified
+
+        try:
+            fields = parse_fields(Layout)
+            page = paginate_collection(project(Layout.query, Layout, fields), Layout)
+        except (PaginationError, FieldsError, FilterError, SearchError) as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
         body = NauttoBuilder()
         body.add_namespace("nautto", LINK_RELATIONS_URL)
         body.add_control("self", url_for("api.layoutcollection"))
         body.add_control_add_resource('layout', url_for('api.layoutcollection'))
-        body["items"] = []
-        for db_layout in Layout.query.all():
-            item = NauttoBuilder(id=db_layout.id, name=db_layout.name)
-            item.add_control("self", url_for("api.layoutitem", layout=db_layout.id))
-            item.add_control("profile", LAYOUT_PROFILE)
-            body["items"].append(item)
+        add_page_controls(body, page, "api.layoutcollection")
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return validators.apply(stream_collection(body, _layout_items(page.rows, fields)))
 
 
 class LayoutItem(Resource):
 
     def get(self, layout):
+        validators = item_validators(Layout, layout, "widget")
+        if validators is None:
+            return create_error_response(
+                404, "Not found",
+                f'No layout was found with the id {layout}'
+            )
+        not_modified = validators.not_modified()
+        if not_modified is not None:
+            return not_modified
+
+        cached = cached_response("layout", layout, validators.etag)
+        if cached is not None:
+            return validators.apply(cached)
+
         db_layout = Layout.query.filter_by(id=layout).first()
         if db_layout is None:
             return create_error_response(
@@ -99,6 +173,21 @@ class LayoutItem(Resource):
                 f'No layout was found with the id {layout}'
             )
 
+        members = Widget.query.join(layout_widgets).filter(
+            layout_widgets.c.layout_id == db_layout.id
+        )
+        try:
+            embed = parse_embed(LAYOUT_EMBEDS)
+            fields = parse_fields(
+                Widget,
+                default=selectable_fields(Widget) if "widgets" in embed else LIST_FIELDS
+            )
+            # keyed on the member table, whose primary key holds the
+            # members of a layout in order
+            page = paginate(project(members, Widget, fields), layout_widgets.c.widget_id)
+        except (PaginationError, FieldsError) as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
         body = NauttoBuilder(
             id=db_layout.id,
             name=db_layout.name,
@@ -112,14 +201,10 @@ class LayoutItem(Resource):
         body.add_control("author", url_for("api.useritem", user=db_layout.user_id))
         body.add_control_delete_resource('layout', url_for_item)
         body.add_control_modify_resource('layout', url_for_item)
-        body["items"] = []
-        for widget in db_layout.widgets:
-            item = NauttoBuilder(id=widget.id, name=widget.name)
-            item.add_control("self", url_for("api.widgetoflayout", widget=widget.id, layout=layout))
-            item.add_control("profile", WIDGET_PROFILE)
-            body["items"].append(item)
+        add_page_controls(body, page, "api.layoutitem", layout=layout)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        response = stream_collection(body, _widget_of_layout_items(page.rows, fields, layout))
+        return validators.apply(cache_response("layout", layout, validators.etag, response))
 
     def put(self, layout):
         db_layout = Layout.query.filter_by(id=layout).first()
@@ -136,12 +221,11 @@ class LayoutItem(Resource):
             )
 
         try:
-            validate(request.json, Layout.get_schema())
+            validate(request.json, Layout)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
-        if ('id' in request.json):
-            db_layout.id = request.json["id"]
+        stale = layout_dependents(db_layout)
 
         db_layout.name = request.json["name"]
         
@@ -149,15 +233,16 @@ class LayoutItem(Resource):
             db_layout.description = request.json["description"]
 
         if ('items' in request.json):
-            for item in request.json['items']:
-                widget = Widget.query.filter_by(id=item['id']).first()
-                if widget:
-                    db_layout.widgets.append(widget)
-                else:
-                    return create_error_response(
-                        404, "Not found",
-                        f'No widget was found with id {item["id"]}'
-                    )
+            try:
+                update_members(
+                    db_layout, Layout.widgets, request.json["items"],
+                    request.json.get("membership", MEMBERSHIP_ADD)
+                )
+            except MemberNotFound as e:
+                return create_error_response(404, "Not found", str(e))
+
+        if ('id' in request.json):
+            db_layout.id = request.json["id"]
 
         try:
             db.session.commit()
@@ -167,6 +252,51 @@ class LayoutItem(Resource):
                 "Layout with id '{}' already exists.".format(request.json["id"])
             )
 
+        invalidate(stale)
+        return Response(status=204)
+
+    def patch(self, layout):
+        db_layout = project(Layout.query.filter_by(id=layout), Layout, ["id"]).first()
+        if db_layout is None:
+            return create_error_response(
+                404, "Not found",
+                f'No layout was found with the id {layout}'
+            )
+
+        patch = read_patch()
+        if patch is None:
+            return create_error_response(
+                415, "Unsupported media type",
+                f'Requests must be {MERGE_PATCH}'
+            )
+
+        try:
+            validate_patch(patch, Layout)
+        except ValidationError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        stale = layout_dependents(db_layout)
+
+        if ('items' in patch):
+            try:
+                update_members(
+                    db_layout, Layout.widgets, patch["items"],
+                    patch.get("membership", MEMBERSHIP_REPLACE)
+                )
+            except MemberNotFound as e:
+                return create_error_response(404, "Not found", str(e))
+
+        apply_patch(db_layout, patch)
+
+        try:
+            db.session.commit()
+        except IntegrityError:
+            return create_error_response(
+                409, "Already exists",
+                "Layout with id '{}' already exists.".format(patch["id"])
+            )
+
+        invalidate(stale)
         return Response(status=204)
 
     def delete(self, layout):
@@ -177,8 +307,10 @@ class LayoutItem(Resource):
                 f'No layout was found with the id {layout}'
             )
 
+        stale = layout_dependents(db_layout)
         db.session.delete(db_layout)
         db.session.commit()
+        invalidate(stale)
 
         return Response(status=204)
 
@@ -186,6 +318,15 @@ class LayoutItem(Resource):
 class LayoutOfSet(Resource):
 
     def get(self, set, layout):
+        validators = item_validators(Layout, layout)
+        if validators is None:
+            return create_error_response(
+                404, "Not found",
+                f'No layout was found with the id {layout}'
+            )
+        not_modified = validators.not_modified()
+        if not_modified is not None:
+            return not_modified
 
         db_layout = Layout.query.filter_by(id=layout).first()
         if db_layout is None:
@@ -209,4 +350,4 @@ class LayoutOfSet(Resource):
         body.add_control_modify_resource('layout', url_for_item)
         body.add_control('up', url_for("api.setitem", set=set))
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
\ No newline at end of file
+        return validators.apply(Response(json.dumps(body), 200, mimetype=MASON))
\ No newline at end of file
@@ -1,35 +1,93 @@
-import json
+from datetime import datetime
 
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from flask import Response, request, url_for
 from flask_restful import Resource
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload
 
-from nautto.models import Set, User, Layout
+from nautto.models import Set, User, Layout, Widget, set_layouts
 from nautto import db
 from nautto.utils import NauttoBuilder, create_error_response
+from nautto.pagination import PaginationError, paginate, add_page_controls
+from nautto.filtering import FilterError, paginate_collection
+from nautto.search import SearchError
+from nautto.projection import FieldsError, parse_embed, parse_fields, project, selectable_fields
+from nautto.streaming import stream_collection
+from nautto.urls import url_template
+from nautto.validation import validate, validate_patch
+from nautto.patch import apply_patch, read_patch
+from nautto.conditional import Validators, collection_validators, item_validators
+from nautto.cache import cached_response, cache_response, invalidate, set_dependents
+from nautto.resources.layout import _widget_of_layout_items
+from nautto.snapshots import (
+    build_snapshot_later, encode_tree, load_snapshot, render_snapshot, render_tree,
+    resolve_tree
+)
+from nautto.membership import MemberNotFound, insert_members, update_members
+from nautto.bulk import BulkError, create_many, read_documents
 from nautto.constants import *
 
 
+def _set_items(rows, fields):
+    item_url = url_template("api.setitem")
+    for db_set in rows:
+        item = NauttoBuilder((field, getattr(db_set, field)) for field in fields)
+        item.add_control("self", item_url(set=db_set.id))
+        item.add_control("profile", SET_PROFILE)
+        yield item
+
+
+def _layout_of_set_items(rows, fields, set, embed_widgets=False):
+    item_url = url_template("api.layoutofset")
+    widget_fields = selectable_fields(Widget)
+    for layout in rows:
+        item = NauttoBuilder((field, getattr(layout, field)) for field in fields)
+        item.add_control("self", item_url(layout=layout.id, set=set))
+        item.add_control("profile", LAYOUT_PROFILE)
+        if embed_widgets:
+            widgets = sorted(layout.widgets, key=lambda widget: widget.id)
+            item["items"] = list(_widget_of_layout_items(widgets, widget_fields, layout.id))
+        yield item
+
+
 class SetsByUserCollection(Resource):
 
     def get(self, user):
+        validators = collection_validators("set")
+        not_modified = validators.not_modified()
+        if not_modified is not None:
+            return not_modified
+
+        try:
+            fields = parse_fields(Set)
+            page = paginate_collection(
+                project(Set.query.filter_by(user_id=user), Set, fields), Set
+            )
+        except (PaginationError, FieldsError, FilterError, SearchError) as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
         body = NauttoBuilder()
         body.add_namespace("nautto", LINK_RELATIONS_URL)
         body.add_control("self", url_for("api.setsbyusercollection", user=user))
         body.add_control_add_resource('set', url_for("api.setsbyusercollection", user=user))
         body.add_control("author", url_for("api.useritem", user=user))
         body.add_control("nautto:sets-all", url_for("api.setcollection"))
-        body["items"] = []
-        for db_set in Set.query.filter_by(user_id=user):
-            item = NauttoBuilder(id=db_set.id, name=db_set.name)
-            item.add_control("self", url_for("api.setitem", set=db_set.id))
-            item.add_control("profile", SET_PROFILE)
-            body["items"].append(item)
+        add_page_controls(body, page, "api.setsbyusercollection", user=user)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return validators.apply(stream_collection(body, _set_items(page.rows, fields)))
 
     def post(self, user):
+        try:
+            documents = read_documents()
+        except BulkError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+        if documents is not None:
+            return create_many(
+                Set, user, documents, "api.setitem", SET_PROFILE,
+                members=Set.layouts
+            )
+
         if not request.json:
             return create_error_response(
                 415, "Unsupported media type",
@@ -37,7 +95,7 @@ class SetsByUserCollection(Resource):
             )
 
         try:
-            validate(request.json, Set.get_schema())
+            validate(request.json, Set)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -61,13 +119,19 @@ class SetsByUserCollection(Resource):
 
         try:
             db.session.add(set)
+            db.session.flush()
+            set_id = set.id
+            if ('items' in request.json and
+                    request.json.get("membership") != MEMBERSHIP_REMOVE):
+                insert_members(Set.layouts, {set_id: request.json["items"]})
             db.session.commit()
         except IntegrityError as e:
             return create_error_response(409, "Already exists", str(e))
+        except MemberNotFound as e:
+            return create_error_response(404, "Not found", str(e))
 
-        db_set = Set.query.filter_by(id=set.id).first()
         headers = {
-            "Location": url_for("api.setitem", set=db_set.id)
+            "Location": url_for("api.setitem", set=set_id)
         }
         return Response(status=201, headers=headers)
 
@@ -75,23 +139,43 @@ class SetsByUserCollection(Resource):
 class SetCollection(Resource):
 
     def get(self):
+        validators = collection_validators("set")
+        not_modified = validators.not_modified()
+        if not_modified is not None:
+            return not_modified
+
+        try:
+            fields = parse_fields(Set)
+            page = paginate_collection(project(Set.query, Set, fields), Set)
+        except (PaginationError, FieldsError, FilterError, SearchError) as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
         body = NauttoBuilder()
         body.add_namespace("nautto", LINK_RELATIONS_URL)
         body.add_control("self", url_for("api.setcollection"))
         body.add_control_add_resource('set', url_for('api.setcollection'))
-        body["items"] = []
-        for db_set in Set.query.all():
-            item = NauttoBuilder(id=db_set.id, name=db_set.name)
-            item.add_control("self", url_for("api.setitem", set=db_set.id))
-            item.add_control("profile", SET_PROFILE)
-            body["items"].append(item)
+        add_page_controls(body, page, "api.setcollection")
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return validators.apply(stream_collection(body, _set_items(page.rows, fields)))
 
 
 class SetItem(Resource):
 
     def get(self, set):
+        validators = item_validators(Set, set, "layout", "widget")
+        if validators is None:
+            return create_error_response(
+                404, "Not found",
+                f'No set was found with the id {set}'
+            )
+        not_modified = validators.not_modified()
+        if not_modified is not None:
+            return not_modified
+
+        cached = cached_response("set", set, validators.etag)
+        if cached is not None:
+            return validators.apply(cached)
+
         db_set = Set.query.filter_by(id=set).first()
         if db_set is None:
             return create_error_response(
@@ -99,6 +183,24 @@ class SetItem(Resource):
                 f'No set was found with the id {set}'
             )
 
+        members = Layout.query.join(set_layouts).filter(
+            set_layouts.c.set_id == db_set.id
+        )
+        try:
+            embed = parse_embed(SET_EMBEDS)
+            if "widgets" in embed:
+                embed.add("layouts")
+                members = members.options(selectinload(Layout.widgets))
+            fields = parse_fields(
+                Layout,
+                default=selectable_fields(Layout) if "layouts" in embed else LIST_FIELDS
+            )
+            # keyed on the member table, whose primary key holds the
+            # members of a set in order
+            page = paginate(project(members, Layout, fields), set_layouts.c.layout_id)
+        except (PaginationError, FieldsError) as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
         body = NauttoBuilder(
             id=db_set.id,
             name=db_set.name,
@@ -110,16 +212,15 @@ class SetItem(Resource):
         body.add_control("profile", SET_PROFILE)
         body.add_control("collection", url_for("api.setcollection"))
         body.add_control("author", url_for("api.useritem", user=db_set.user_id))
+        body.add_control("nautto:tree", url_for("api.settree", set=set))
         body.add_control_delete_resource('set', url_for_item)
         body.add_control_modify_resource('set', url_for_item)
-        body["items"] = []
-        for layout in db_set.layouts:
-            item = NauttoBuilder(id=layout.id, name=layout.name)
-            item.add_control("self", url_for("api.layoutofset", layout=layout.id, set=set))
-            item.add_control("profile", LAYOUT_PROFILE)
-            body["items"].append(item)
+        add_page_controls(body, page, "api.setitem", set=set)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        response = stream_collection(
+            body, _layout_of_set_items(page.rows, fields, set, "widgets" in embed)
+        )
+        return validators.apply(cache_response("set", set, validators.etag, response))
 
     def put(self, set):
         db_set = Set.query.filter_by(id=set).first()
@@ -136,12 +237,11 @@ class SetItem(Resource):
             )
 
         try:
-            validate(request.json, Set.get_schema())
+            validate(request.json, Set)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
-        if ('id' in request.json):
-            db_set.id = request.json["id"]
+        stale = set_dependents(db_set)
 
         db_set.name = request.json["name"]
         
@@ -149,16 +249,16 @@ class SetItem(Resource):
             db_set.description = request.json["description"]
 
         if ('items' in request.json):
-            for item in request.json['items']:
-                layout = Layout.query.filter_by(id=item['id']).first()
-                if layout:
-                    db_set.layouts.append(layout)
-                else:
-                    return create_error_response(
-                        404, "Not found",
-                        f'No layout was found with id {item["id"]}'
-                    )
+            try:
+                update_members(
+                    db_set, Set.layouts, request.json["items"],
+                    request.json.get("membership", MEMBERSHIP_ADD)
+                )
+            except MemberNotFound as e:
+                return create_error_response(404, "Not found", str(e))
 
+        if ('id' in request.json):
+            db_set.id = request.json["id"]
 
         try:
             db.session.commit()
@@ -168,6 +268,51 @@ class SetItem(Resource):
                 "Set with id '{}' already exists.".format(request.json["id"])
             )
 
+        invalidate(stale)
+        return Response(status=204)
+
+    def patch(self, set):
+        db_set = project(Set.query.filter_by(id=set), Set, ["id"]).first()
+        if db_set is None:
+            return create_error_response(
+                404, "Not found",
+                f'No set was found with the id {set}'
+            )
+
+        patch = read_patch()
+        if patch is None:
+            return create_error_response(
+                415, "Unsupported media type",
+                f'Requests must be {MERGE_PATCH}'
+            )
+
+        try:
+            validate_patch(patch, Set)
+        except ValidationError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        stale = set_dependents(db_set)
+
+        if ('items' in patch):
+            try:
+                update_members(
+                    db_set, Set.layouts, patch["items"],
+                    patch.get("membership", MEMBERSHIP_REPLACE)
+                )
+            except MemberNotFound as e:
+                return create_error_response(404, "Not found", str(e))
+
+        apply_patch(db_set, patch)
+
+        try:
+            db.session.commit()
+        except IntegrityError:
+            return create_error_response(
+                409, "Already exists",
+                "Set with id '{}' already exists.".format(patch["id"])
+            )
+
+        invalidate(stale)
         return Response(status=204)
 
     def delete(self, set):
@@ -178,7 +323,42 @@ class SetItem(Resource):
                 f'No set was found with the id {set}'
             )
 
+        stale = set_dependents(db_set)
         db.session.delete(db_set)
         db.session.commit()
+        invalidate(stale)
 
         return Response(status=204)
+
+
+class SetTree(Resource):
+
+    def get(self, set):
+        # An unchanged set costs one statement. Otherwise the snapshot miss
+        # is followed by the three statements of resolve_tree.
+        stored = load_snapshot(set)
+        if stored is not None:
+            snapshot, contents = stored
+            digest, built_at = snapshot.digest, snapshot.built_at
+        else:
+            tree = resolve_tree(set)
+            if tree is None:
+                return create_error_response(
+                    404, "Not found",
+                    f'No set was found with the id {set}'
+                )
+            _, digest = encode_tree(tree)
+            built_at = datetime.utcnow().replace(microsecond=0)
+
+        validators = Validators(("set-tree", digest), built_at)
+        not_modified = validators.not_modified()
+        if not_modified is not None:
+            response = not_modified
+        elif stored is not None:
+            body = render_snapshot(snapshot.data, contents)
+            response = validators.apply(Response(body, 200, mimetype=JSON))
+        else:
+            response = validators.apply(Response(render_tree(tree), 200, mimetype=JSON))
+        if stored is None:
+            return build_snapshot_later(response, set)
+        return response
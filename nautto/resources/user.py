@@ -1,6 +1,6 @@
 import json
 
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from flask import Response, request, url_for
 from flask_restful import Resource
 from sqlalchemy.exc import IntegrityError
@@ -8,24 +8,48 @@ from sqlalchemy.exc import IntegrityError
 from nautto.models import User
 from nautto import db
 from nautto.utils import NauttoBuilder, create_error_response
+from nautto.pagination import PaginationError, add_page_controls
+from nautto.filtering import FilterError, paginate_collection
+from nautto.projection import FieldsError, parse_fields, project
+from nautto.streaming import stream_collection
+from nautto.urls import url_template
+from nautto.validation import validate, validate_patch
+from nautto.patch import apply_patch, read_patch
+from nautto.conditional import collection_validators, item_validators
+from nautto.cache import cached_response, cache_response, invalidate, user_dependents
 from nautto.constants import *
 
 
+def _user_items(rows, fields):
+    item_url = url_template("api.useritem")
+    for db_user in rows:
+        item = NauttoBuilder((field, getattr(db_user, field)) for field in fields)
+        item.add_control("self", item_url(user=db_user.id))
+        item.add_control("profile", USER_PROFILE)
+        yield item
+
+
 class UserCollection(Resource):
 
     def get(self):
+        validators = collection_validators("user")
+        not_modified = validators.not_modified()
+        if not_modified is not None:
+            return not_modified
+
+        try:
+            fields = parse_fields(User)
+            page = paginate_collection(project(User.query, User, fields), User)
+        except (PaginationError, FieldsError, FilterError) as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
         body = NauttoBuilder()
         body.add_namespace("nautto", LINK_RELATIONS_URL)
         body.add_control("self", url_for("api.usercollection"))
         body.add_control_add_resource('user', url_for('api.usercollection'))
-        body["items"] = []
-        for db_user in User.query.all():
-            item = NauttoBuilder(id=db_user.id, name=db_user.name)
-            item.add_control("self", url_for("api.useritem", user=db_user.id))
-            item.add_control("profile", USER_PROFILE)
-            body["items"].append(item)
+        add_page_controls(body, page, "api.usercollection")
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return validators.apply(stream_collection(body, _user_items(page.rows, fields)))
 
     def post(self):
         if not request.json:
@@ -35,7 +59,7 @@ class UserCollection(Resource):
             )
 
         try:
-            validate(request.json, User.get_schema())
+            validate(request.json, User)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -49,6 +73,8 @@ class UserCollection(Resource):
 
         try:
             db.session.add(user)
+            db.session.flush()
+            user_id = user.id
             db.session.commit()
         except IntegrityError:
             return create_error_response(
@@ -57,9 +83,8 @@ class UserCollection(Resource):
                     request.json["id"])
             )
 
-        db_user = User.query.filter_by(id=user.id).first()
         headers = {
-            "Location": url_for("api.useritem", user=db_user.id)
+            "Location": url_for("api.useritem", user=user_id)
         }
         return Response(status=201, headers=headers)
 
@@ -67,6 +92,20 @@ class UserCollection(Resource):
 class UserItem(Resource):
 
     def get(self, user):
+        validators = item_validators(User, user)
+        if validators is None:
+            return create_error_response(
+                404, "Not found",
+                f'No user was found with the id {user}'
+            )
+        not_modified = validators.not_modified()
+        if not_modified is not None:
+            return not_modified
+
+        cached = cached_response("user", user, validators.etag)
+        if cached is not None:
+            return validators.apply(cached)
+
         db_user = User.query.filter_by(id=user).first()
         if db_user is None:
             return create_error_response(
@@ -90,7 +129,8 @@ class UserItem(Resource):
         body.add_control_delete_resource('user', url_for_item)
         body.add_control_modify_resource('user', url_for_item)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        response = Response(json.dumps(body), 200, mimetype=MASON)
+        return validators.apply(cache_response("user", user, validators.etag, response))
 
     def put(self, user):
         db_user = User.query.filter_by(id=user).first()
@@ -107,10 +147,12 @@ class UserItem(Resource):
             )
 
         try:
-            validate(request.json, User.get_schema())
+            validate(request.json, User)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
+        stale = user_dependents(db_user, owned='id' in request.json)
+
         if ('id' in request.json):
             db_user.id = request.json["id"]
 
@@ -126,6 +168,42 @@ class UserItem(Resource):
                     request.json["id"])
             )
 
+        invalidate(stale)
+        return Response(status=204)
+
+    def patch(self, user):
+        db_user = project(User.query.filter_by(id=user), User, ["id"]).first()
+        if db_user is None:
+            return create_error_response(
+                404, "Not found",
+                f'No user was found with the id {user}'
+            )
+
+        patch = read_patch()
+        if patch is None:
+            return create_error_response(
+                415, "Unsupported media type",
+                f'Requests must be {MERGE_PATCH}'
+            )
+
+        try:
+            validate_patch(patch, User)
+        except ValidationError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        stale = user_dependents(db_user, owned='id' in patch)
+
+        apply_patch(db_user, patch)
+
+        try:
+            db.session.commit()
+        except IntegrityError:
+            return create_error_response(
+                409, "Already exists",
+                "User with id '{}' already exists.".format(patch["id"])
+            )
+
+        invalidate(stale)
         return Response(status=204)
 
     def delete(self, user):
@@ -136,7 +214,9 @@ class UserItem(Resource):
                 f'No user was found with the id {user}'
             )
 
+        stale = user_dependents(db_user, owned=True)
         db.session.delete(db_user)
         db.session.commit()
+        invalidate(stale)
 
         return Response(status=204)
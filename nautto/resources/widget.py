@@ -1,36 +1,84 @@
 import json
+import os
 
-from jsonschema import validate, ValidationError
+from jsonschema import ValidationError
 from flask import Response, request, url_for
 from flask_restful import Resource
+from sqlalchemy import select, type_coerce
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.types import NULLTYPE
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
+from werkzeug.wsgi import wrap_file
 
-from nautto.models import Widget, User
+from nautto.models import ContentBlob, Widget, User
 from nautto import db
 from nautto.utils import NauttoBuilder, create_error_response
+from nautto.pagination import PaginationError, add_page_controls
+from nautto.filtering import FilterError, paginate_collection
+from nautto.search import SearchError
+from nautto.projection import FieldsError, parse_fields, project
+from nautto.streaming import stream_collection
+from nautto.urls import url_template
+from nautto.validation import validate, validate_patch
+from nautto.patch import apply_patch, read_patch
+from nautto.conditional import Validators, collection_validators, item_validators
+from nautto.blobstore import MappedBlob, get_store
+from nautto.cache import cached_response, cache_response, invalidate, widget_dependents
+from nautto.bulk import BulkError, create_many, read_documents
 from nautto.constants import *
 
 
+def _widget_items(rows, fields):
+    item_url = url_template("api.widgetitem")
+    for db_widget in rows:
+        item = NauttoBuilder((field, getattr(db_widget, field)) for field in fields)
+        item.add_control("self", item_url(widget=db_widget.id))
+        item.add_control("profile", WIDGET_PROFILE)
+        yield item
+
+
+def _media_type(widget_type):
+    # Widget types are free form: either a known name or a media type.
+    # Text types get the utf-8 charset from the response class.
+    if "/" in widget_type:
+        return widget_type
+    return WIDGET_MEDIA_TYPES.get(widget_type.lower(), "text/plain")
+
+
 class WidgetsByUserCollection(Resource):
 
     def get(self, user):
+        validators = collection_validators("widget")
+        not_modified = validators.not_modified()
+        if not_modified is not None:
+            return not_modified
+
+        try:
+            fields = parse_fields(Widget)
+            page = paginate_collection(
+                project(Widget.query.filter_by(user_id=user), Widget, fields), Widget
+            )
+        except (PaginationError, FieldsError, FilterError, SearchError) as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
         body = NauttoBuilder()
         body.add_namespace("nautto", LINK_RELATIONS_URL)
         body.add_control("self", url_for("api.widgetsbyusercollection", user=user))
         body.add_control_add_resource('widget', url_for("api.widgetsbyusercollection", user=user))
         body.add_control("author", url_for("api.useritem", user=user))
         body.add_control("nautto:widgets-all", url_for("api.widgetcollection"))
-        body["items"] = []
-        for db_widget in Widget.query.filter_by(user_id=user):
-            item = NauttoBuilder(id=db_widget.id, name=db_widget.name)
-            item.add_control("self", url_for(
-                "api.widgetitem", widget=db_widget.id))
-            item.add_control("profile", WIDGET_PROFILE)
-            body["items"].append(item)
+        add_page_controls(body, page, "api.widgetsbyusercollection", user=user)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return validators.apply(stream_collection(body, _widget_items(page.rows, fields)))
 
     def post(self, user):
+        try:
+            documents = read_documents()
+        except BulkError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+        if documents is not None:
+            return create_many(Widget, user, documents, "api.widgetitem", WIDGET_PROFILE)
+
         if not request.json:
             return create_error_response(
                 415, "Unsupported media type",
@@ -38,7 +86,7 @@ class WidgetsByUserCollection(Resource):
             )
 
         try:
-            validate(request.json, Widget.get_schema())
+            validate(request.json, Widget)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -64,13 +112,14 @@ class WidgetsByUserCollection(Resource):
 
         try:
             db.session.add(widget)
+            db.session.flush()
+            widget_id = widget.id
             db.session.commit()
         except IntegrityError as e:
             return create_error_response(409, "Already exists", str(e))
 
-        db_widget = Widget.query.filter_by(id=widget.id).first()
         headers = {
-            "Location": url_for("api.widgetitem", widget=db_widget.id)
+            "Location": url_for("api.widgetitem", widget=widget_id)
         }
         return Response(status=201, headers=headers)
 
@@ -78,23 +127,43 @@ class WidgetsByUserCollection(Resource):
 class WidgetCollection(Resource):
 
     def get(self):
+        validators = collection_validators("widget")
+        not_modified = validators.not_modified()
+        if not_modified is not None:
+            return not_modified
+
+        try:
+            fields = parse_fields(Widget)
+            page = paginate_collection(project(Widget.query, Widget, fields), Widget)
+        except (PaginationError, FieldsError, FilterError, SearchError) as e:
+            return create_error_response(400, "Invalid query parameter", str(e))
+
         body = NauttoBuilder()
         body.add_namespace("nautto", LINK_RELATIONS_URL)
         body.add_control("self", url_for("api.widgetcollection"))
         body.add_control_add_resource('widget', url_for('api.widgetcollection'))
-        body["items"] = []
-        for db_widget in Widget.query.all():
-            item = NauttoBuilder(id=db_widget.id, name=db_widget.name)
-            item.add_control("self", url_for("api.widgetitem", widget=db_widget.id))
-            item.add_control("profile", WIDGET_PROFILE)
-            body["items"].append(item)
+        add_page_controls(body, page, "api.widgetcollection")
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return validators.apply(stream_collection(body, _widget_items(page.rows, fields)))
 
 
 class WidgetItem(Resource):
 
     def get(self, widget):
+        validators = item_validators(Widget, widget)
+        if validators is None:
+            return create_error_response(
+                404, "Not found",
+                f'No widget was found with the id {widget}'
+            )
+        not_modified = validators.not_modified()
+        if not_modified is not None:
+            return not_modified
+
+        cached = cached_response("widget", widget, validators.etag)
+        if cached is not None:
+            return validators.apply(cached)
+
         db_widget = Widget.query.filter_by(id=widget).first()
         if db_widget is None:
             return create_error_response(
@@ -115,10 +184,12 @@ class WidgetItem(Resource):
         body.add_control("profile", WIDGET_PROFILE)
         body.add_control("collection", url_for("api.widgetcollection"))
         body.add_control("author", url_for("api.useritem", user=db_widget.user_id))
+        body.add_control("nautto:content", url_for("api.widgetcontent", widget=db_widget.id))
         body.add_control_delete_resource('widget', url_for_item)
         body.add_control_modify_resource('widget', url_for_item)
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        response = Response(json.dumps(body), 200, mimetype=MASON)
+        return validators.apply(cache_response("widget", widget, validators.etag, response))
 
     def put(self, widget):
         db_widget = Widget.query.filter_by(id=widget).first()
@@ -135,10 +206,12 @@ class WidgetItem(Resource):
             )
 
         try:
-            validate(request.json, Widget.get_schema())
+            validate(request.json, Widget)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
+        stale = widget_dependents(db_widget)
+
         if ('id' in request.json):
             db_widget.id = request.json["id"]
 
@@ -157,6 +230,42 @@ class WidgetItem(Resource):
                 "Widget with id '{}' already exists.".format(request.json["id"])
             )
 
+        invalidate(stale)
+        return Response(status=204)
+
+    def patch(self, widget):
+        db_widget = project(Widget.query.filter_by(id=widget), Widget, ["id"]).first()
+        if db_widget is None:
+            return create_error_response(
+                404, "Not found",
+                f'No widget was found with the id {widget}'
+            )
+
+        patch = read_patch()
+        if patch is None:
+            return create_error_response(
+                415, "Unsupported media type",
+                f'Requests must be {MERGE_PATCH}'
+            )
+
+        try:
+            validate_patch(patch, Widget)
+        except ValidationError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        stale = widget_dependents(db_widget)
+
+        apply_patch(db_widget, patch)
+
+        try:
+            db.session.commit()
+        except IntegrityError:
+            return create_error_response(
+                409, "Already exists",
+                "Widget with id '{}' already exists.".format(patch["id"])
+            )
+
+        invalidate(stale)
         return Response(status=204)
 
     def delete(self, widget):
@@ -167,8 +276,10 @@ class WidgetItem(Resource):
                 f'No widget was found with the id {widget}'
             )
 
+        stale = widget_dependents(db_widget)
         db.session.delete(db_widget)
         db.session.commit()
+        invalidate(stale)
 
         return Response(status=204)
 
@@ -176,6 +287,16 @@ class WidgetItem(Resource):
 class WidgetOfLayout(Resource):
 
     def get(self, layout, widget):
+        validators = item_validators(Widget, widget)
+        if validators is None:
+            return create_error_response(
+                404, "Not found",
+                f'No widget was found with the id {widget}'
+            )
+        not_modified = validators.not_modified()
+        if not_modified is not None:
+            return not_modified
+
         db_widget = Widget.query.filter_by(id=widget).first()
         if db_widget is None:
             return create_error_response(
@@ -196,8 +317,63 @@ class WidgetOfLayout(Resource):
         body.add_control("profile", WIDGET_PROFILE)
         body.add_control("collection", url_for("api.widgetcollection"))
         body.add_control("author", url_for("api.useritem", user=db_widget.user_id))
+        body.add_control("nautto:content", url_for("api.widgetcontent", widget=db_widget.id))
         body.add_control_delete_resource('widget', url_for_item)
         body.add_control_modify_resource('widget', url_for_item)
         body.add_control('up', url_for("api.layoutitem", layout=layout))
 
-        return Response(json.dumps(body), 200, mimetype=MASON)
\ No newline at end of file
+        return validators.apply(Response(json.dumps(body), 200, mimetype=MASON))
+
+
+class WidgetContent(Resource):
+
+    def get(self, widget):
+        widget_table, blob_table = Widget.__table__, ContentBlob.__table__
+        # The raw column value tells inline content (TEXT) from content in
+        # the blob store (a BLOB holding the hash) without reading the file.
+        row = db.session.execute(
+            select([
+                widget_table.c.type, widget_table.c.content_hash,
+                type_coerce(blob_table.c.data, NULLTYPE)
+            ]).select_from(
+                widget_table.join(blob_table, widget_table.c.content_hash == blob_table.c.hash)
+            ).where(widget_table.c.id == widget)
+        ).first()
+        if row is None:
+            return create_error_response(
+                404, "Not found",
+                f'No widget was found with the id {widget}'
+            )
+        widget_type, digest, data = row
+
+        # The content hash is a strong validator of the raw bytes
+        validators = Validators(None, None, etag=digest)
+        not_modified = validators.not_modified()
+        if not_modified is not None:
+            return not_modified
+
+        if not isinstance(data, bytes):
+            body = data.encode("utf-8")
+            response = Response(body, 200, mimetype=_media_type(widget_type))
+            length = len(body)
+        else:
+            # Whole files go to wsgi.file_wrapper, which servers can send
+            # with sendfile; ranges are cut from a memory map of the file.
+            blob_file = get_store().open(digest)
+            length = os.fstat(blob_file.fileno()).st_size
+            if "Range" in request.headers:
+                body = MappedBlob(blob_file)
+            else:
+                body = wrap_file(request.environ, blob_file, BLOB_CHUNK_SIZE)
+            response = Response(
+                body, 200, mimetype=_media_type(widget_type), direct_passthrough=True
+            )
+            response.content_length = length
+
+        validators.apply(response)
+        response.accept_ranges = "bytes"
+        try:
+            return response.make_conditional(request, accept_ranges=True, complete_length=length)
+        except RequestedRangeNotSatisfiable:
+            response.close()
+            raise
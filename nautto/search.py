@@ -0,0 +1,78 @@
+import re
+
+from flask import request
+from sqlalchemy import Column, Float, Integer, MetaData, Table, Text
+
+from nautto.pagination import paginate
+from nautto.constants import *
+
+# The FTS5 tables are made by DDL in models and only described here
+_metadata = MetaData()
+_TERM = re.compile(r"\w+\*?")
+
+
+class SearchError(ValueError):
+    """
+    Raised when the search query parameter of a request has nothing to
+    search for. The message is meant to be shown to the client in an error
+    response.
+    """
+
+
+def search_table(Model):
+    name = f'{Model.__tablename__}_search'
+    if name not in _metadata.tables:
+        Table(
+            name, _metadata,
+            Column("rowid", Integer, primary_key=True),
+            Column("rank", Float),
+            Column(name, Text),
+        )
+    return _metadata.tables[name]
+
+
+def match_expression(text):
+    """
+    Turns the words of a search query into an FTS5 query that matches rows
+    containing all of them. Each word is quoted, so operators and column
+    filters can't be injected; a trailing * makes a word a prefix. Raises
+    SearchError when there are no words.
+
+    : param str text: the search query from the request
+    """
+
+    terms = []
+    for term in _TERM.findall(text):
+        if term.endswith("*"):
+            terms.append(f'"{term[:-1]}"*')
+        else:
+            terms.append(f'"{term}"')
+    if not terms:
+        raise SearchError(f'Search query {text!r} contains no words')
+    return " ".join(terms)
+
+
+def search(query, Model, default_limit=PAGE_SIZE, sort=None, descending=False):
+    """
+    Restricts a query to the rows matching the search query parameter of
+    the current request and returns a page of them. The rows are found
+    through the FTS5 index of the model and, unless another sort column is
+    given, ranked with bm25, best matches first. Pages are selected like in
+    paginate and take the same parameters.
+
+    : param query: SQLAlchemy query returning instances of Model
+    : param Model: the searched model, one of those in SEARCH_COLUMNS
+    : param int default_limit: page size when the request doesn't give one
+    : param sort: column to order by instead of the rank
+    : param bool descending: whether to order from the largest value down
+    """
+
+    fts = search_table(Model)
+    query = query.join(fts, fts.c.rowid == Model.id).filter(
+        fts.c[fts.name].op("MATCH")(match_expression(request.args[SEARCH_ARG]))
+    )
+    if sort is None:
+        sort = fts.c.rank
+    return paginate(
+        query, Model.id, default_limit=default_limit, sort=sort, descending=descending
+    )
@@ -0,0 +1,235 @@
+import hashlib
+import json
+from datetime import datetime
+
+from flask import current_app
+from sqlalchemy import func, literal_column, null, select, true, type_coerce, union_all
+from sqlalchemy.exc import OperationalError
+
+from nautto import db
+from nautto.models import (
+    ContentBlob, Layout, Set, SetSnapshot, Widget, layout_widgets, set_layouts,
+    snapshot_layouts, snapshot_widgets
+)
+from nautto.projection import selectable_fields
+from nautto.constants import *
+
+
+def resolve_tree(set_id):
+    """
+    Reads a set, its layouts and their widgets with three statements on the
+    tables and association tables directly. Returns None if the set doesn't
+    exist. Widgets shared by several layouts are listed once; layouts refer
+    to them by id. Widgets hold their content, read from the blob table in
+    the same statement, and the hash of it, which snapshots store instead.
+    """
+
+    set_table, layout_table, widget_table = Set.__table__, Layout.__table__, Widget.__table__
+    tree_fields = ("id", "name", "description")
+
+    row = db.session.execute(
+        select([set_table.c[field] for field in tree_fields]).where(set_table.c.id == set_id)
+    ).first()
+    if row is None:
+        return None
+    tree = dict(zip(tree_fields, row))
+
+    layouts = {}
+    rows = db.session.execute(
+        select(
+            [layout_table.c[field] for field in tree_fields] + [layout_widgets.c.widget_id]
+        ).select_from(
+            set_layouts.join(
+                layout_table, set_layouts.c.layout_id == layout_table.c.id
+            ).outerjoin(
+                layout_widgets, layout_widgets.c.layout_id == layout_table.c.id
+            )
+        ).where(
+            set_layouts.c.set_id == tree["id"]
+        ).order_by(set_layouts.c.layout_id, layout_widgets.c.widget_id)
+    )
+    for row in rows:
+        layout = layouts.get(row[0])
+        if layout is None:
+            layout = layouts[row[0]] = dict(zip(tree_fields, row))
+            layout["widgets"] = []
+        if row[-1] is not None:
+            layout["widgets"].append(row[-1])
+    tree["layouts"] = list(layouts.values())
+
+    blob_table = ContentBlob.__table__
+    widget_fields = list(selectable_fields(Widget)) + ["content_hash"]
+    members = select([layout_widgets.c.widget_id]).select_from(
+        layout_widgets.join(set_layouts, set_layouts.c.layout_id == layout_widgets.c.layout_id)
+    ).where(set_layouts.c.set_id == tree["id"])
+    rows = db.session.execute(
+        select([
+            blob_table.c.data if field == "content" else widget_table.c[field]
+            for field in widget_fields
+        ]).select_from(
+            widget_table.join(blob_table, blob_table.c.hash == widget_table.c.content_hash)
+        ).where(
+            widget_table.c.id.in_(members)
+        ).order_by(widget_table.c.id)
+    )
+    tree["widgets"] = [dict(zip(widget_fields, row)) for row in rows]
+    return tree
+
+
+def encode_tree(tree):
+    """
+    Returns the stored form of a resolved tree and its digest, which
+    changes whenever the served tree does. Widgets hold the hash of their
+    content in place of the content, so that content kept in the blob store
+    is never copied into a snapshot.
+    """
+
+    stored = dict(tree, widgets=[
+        {
+            ("content_hash" if key == "content" else key):
+                (widget["content_hash"] if key == "content" else value)
+            for key, value in widget.items() if key != "content_hash"
+        }
+        for widget in tree["widgets"]
+    ])
+    data = json.dumps(stored, separators=(",", ":"))
+    return data, hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+def render_tree(tree):
+    """
+    Returns the served document of a resolved tree.
+    """
+
+    served = dict(tree, widgets=[
+        {key: value for key, value in widget.items() if key != "content_hash"}
+        for widget in tree["widgets"]
+    ])
+    return json.dumps(served, separators=(",", ":"))
+
+
+def render_snapshot(data, contents):
+    """
+    Returns the served document of a stored tree, the same one render_tree
+    returns for the tree it was encoded from.
+
+    : param str data: the tree as stored by build_snapshot
+    : param dict contents: widget contents by their hashes
+    """
+
+    tree = json.loads(data)
+    tree["widgets"] = [
+        {
+            ("content" if key == "content_hash" else key):
+                (contents.get(value) if key == "content_hash" else value)
+            for key, value in widget.items()
+        }
+        for widget in tree["widgets"]
+    ]
+    return json.dumps(tree, separators=(",", ":"))
+
+
+def load_snapshot(set_id):
+    """
+    Returns the materialized snapshot of a set, which is not attached to
+    the session, and the contents of its widgets by their hashes, or None if
+    there is no snapshot. Both come from one statement: a lookup of the
+    snapshot by its key and of the contents by theirs, whose hashes SQLite
+    reads from the stored tree itself. Content kept in the blob store is
+    read from there.
+
+    : param set_id: id of the set from the URL
+    """
+
+    snapshot_table, blob_table = SetSnapshot.__table__, ContentBlob.__table__
+    entries = func.json_each(snapshot_table.c.data, "$.widgets").alias("entries")
+    hashes = select([
+        func.json_extract(literal_column("entries.value"), "$.content_hash")
+    ]).select_from(
+        snapshot_table.join(entries, true())
+    ).where(snapshot_table.c.set_id == set_id)
+    # The snapshot is the row without a hash. Its data column holds the
+    # stored tree, and that of the other rows a content.
+    rows = db.session.execute(union_all(
+        select([
+            blob_table.c.hash, blob_table.c.data,
+            type_coerce(null(), snapshot_table.c.digest.type).label("digest"),
+            type_coerce(null(), snapshot_table.c.built_at.type).label("built_at"),
+        ]).where(blob_table.c.hash.in_(hashes)),
+        select([
+            null().label("hash"), snapshot_table.c.data, snapshot_table.c.digest, snapshot_table.c.built_at,
+        ]).where(snapshot_table.c.set_id == set_id),
+    ))
+    snapshot = None
+    contents = {}
+    for digest, data, tree_digest, built_at in rows:
+        if digest is None:
+            snapshot = SetSnapshot(set_id=set_id, data=data, digest=tree_digest, built_at=built_at)
+        else:
+            contents[digest] = data
+    if snapshot is None:
+        return None
+    return snapshot, contents
+
+
+def build_snapshot(set_id):
+    """
+    Resolves the tree of a set and stores it as its snapshot together with
+    the layouts and widgets it depends on. Returns the snapshot, which is
+    not attached to the session, or None if the set doesn't exist.
+
+    : param set_id: id of the set from the URL
+    """
+
+    table = SetSnapshot.__table__
+    connection = db.session.connection()
+    # Deleting first takes the write lock, so no writer can commit between
+    # the reads below and the insert and leave a stale snapshot behind.
+    connection.execute(table.delete().where(table.c.set_id == set_id))
+    tree = resolve_tree(set_id)
+    if tree is None:
+        db.session.rollback()
+        return None
+
+    data, digest = encode_tree(tree)
+    snapshot = SetSnapshot(
+        set_id=tree["id"],
+        data=data,
+        digest=digest,
+        built_at=datetime.utcnow().replace(microsecond=0),
+    )
+    connection.execute(table.insert(), {
+        "set_id": snapshot.set_id, "data": snapshot.data,
+        "digest": snapshot.digest, "built_at": snapshot.built_at,
+    })
+    layouts = [{"set_id": tree["id"], "layout_id": layout["id"]} for layout in tree["layouts"]]
+    if layouts:
+        connection.execute(snapshot_layouts.insert(), layouts)
+    widgets = [{"set_id": tree["id"], "widget_id": widget["id"]} for widget in tree["widgets"]]
+    if widgets:
+        connection.execute(snapshot_widgets.insert(), widgets)
+    db.session.commit()
+    return snapshot
+
+
+def build_snapshot_later(response, set_id):
+    """
+    Builds the snapshot of a set once the response has been sent, so that a
+    read never waits for the write lock the build takes. When the lock
+    can't be had the set is left without a snapshot until the next read.
+
+    : param response: the response of the read
+    : param set_id: id of the set from the URL
+    """
+
+    app = current_app._get_current_object()
+
+    def build():
+        with app.app_context():
+            try:
+                build_snapshot(set_id)
+            except OperationalError:
+                db.session.rollback()
+
+    response.call_on_close(build)
+    return response
@@ -0,0 +1,49 @@
+import json
+
+from flask import Response, stream_with_context
+
+from nautto.constants import *
+
+
+def _generate_collection(body, items, chunk_size):
+    head = json.dumps(body)
+    if body:
+        yield head[:-1] + ', "items": ['
+    else:
+        yield '{"items": ['
+
+    chunk = []
+    first = True
+    for item in items:
+        chunk.append(json.dumps(item) if first else ", " + json.dumps(item))
+        first = False
+        if len(chunk) >= chunk_size:
+            yield "".join(chunk)
+            chunk = []
+    chunk.append("]}")
+    yield "".join(chunk)
+
+
+def stream_collection(body, items, status=200, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Creates a response that writes a Mason document with an "items" array
+    through a generator instead of serializing it in one go. The envelope is
+    sent first and the items are serialized one at a time as they are pulled
+    from the iterable, so the memory used does not grow with the number of
+    items. The output is identical to json.dumps of the body with the items
+    added as its last key.
+
+    The iterable is consumed inside the request context, which means it can
+    lazily run database queries and call url_for.
+
+    : param body: the MasonBuilder of the document, without "items"
+    : param items: iterable producing the items of the collection
+    : param int status: status code of the response
+    : param int chunk_size: number of items written per chunk
+    """
+
+    return Response(
+        stream_with_context(_generate_collection(body, items, chunk_size)),
+        status,
+        mimetype=MASON
+    )
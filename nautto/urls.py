@@ -0,0 +1,75 @@
+import re
+
+from flask import current_app, request, url_for
+
+_RULE_ARGUMENT = re.compile(r"<(?:[^<>:]+:)?([^<>:]+)>")
+
+
+class UrlTemplate(object):
+    """
+    A precompiled form of one URL rule. Building a URL from it is a single
+    string format instead of a trip through the Werkzeug URL map, while the
+    values are still converted with the converters of the rule so the result
+    is the same as what url_for would return. Values that the rule doesn't
+    take make it fall back to url_for, which turns them into a query string.
+    """
+
+    def __init__(self, rule):
+        self.endpoint = rule.endpoint
+        self.arguments = frozenset(rule.arguments)
+        self._converters = dict(rule._converters)
+        self._format = _RULE_ARGUMENT.sub(
+            lambda match: "{" + match.group(1) + "}",
+            rule.rule.replace("{", "{{").replace("}", "}}")
+        )
+
+    def build(self, script_root, values):
+        """
+        Builds the URL of the rule for the given values.
+
+        : param str script_root: root the application is mounted at
+        : param dict values: URL values of the rule
+        """
+
+        if values.keys() != self.arguments:
+            return url_for(self.endpoint, **values)
+        for name, value in values.items():
+            if type(value) is int:
+                values[name] = str(value)
+            else:
+                values[name] = self._converters[name].to_url(value)
+        return script_root + self._format.format(**values)
+
+
+def init_app(app, prefix="api."):
+    """
+    Compiles URL templates for all routes of the api blueprint. Must be
+    called after the blueprint has been registered.
+
+    : param app: the Flask application
+    : param str prefix: endpoint prefix of the routes to compile
+    """
+
+    app.extensions["url_templates"] = {
+        rule.endpoint: UrlTemplate(rule)
+        for rule in app.url_map.iter_rules()
+        if rule.endpoint.startswith(prefix)
+    }
+
+
+def url_template(endpoint):
+    """
+    Returns a function that builds URLs for an endpoint of the api and gives
+    the same hrefs as url_for. Meant to be looked up once and then called for
+    every item of a collection.
+
+    : param str endpoint: endpoint name, e.g. "api.widgetitem"
+    """
+
+    template = current_app.extensions["url_templates"][endpoint]
+    script_root = request.script_root
+
+    def build(**values):
+        return template.build(script_root, values)
+
+    return build
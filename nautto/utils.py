@@ -1,6 +1,6 @@
 import json
 
-from flask import Response, request, url_for
+from flask import Response, current_app, request, url_for
 
 from nautto.constants import *
 
@@ -76,10 +76,31 @@ def _getModel(resource):
     return vars(nautto.models)[resource.capitalize()]
 
 
+def schema_mode():
+    """
+    Returns how schemas are attached to controls in the current response,
+    either "inline" (the "schema" property) or "url" (the "schemaUrl"
+    property). Clients can choose with a "Prefer: schema=url" or
+    "Prefer: schema=inline" header, otherwise the SCHEMA_MODE setting of the
+    deployment is used.
+    """
+
+    for preference in request.headers.get("Prefer", "").split(","):
+        name, _, value = preference.strip().partition("=")
+        if name == "schema" and value in SCHEMA_MODES:
+            return value
+    return current_app.config.get("SCHEMA_MODE", SCHEMA_INLINE)
+
+
+def _schema_properties(resource):
+    if schema_mode() == SCHEMA_URL:
+        return {"schemaUrl": url_for("send_schema", model=resource)}
+    return {"schema": _getModel(resource).get_schema()}
+
+
 class NauttoBuilder(MasonBuilder):
 
     def add_control_add_resource(self, resource, url):
-        Model = _getModel(resource)
         self.add_control(
             f'nautto:add-{resource}',
             # url_for(f'api.{collection_name}'),
@@ -87,11 +108,10 @@ class NauttoBuilder(MasonBuilder):
             method="POST",
             encoding="json",
             title=f'Add a new {resource}',
-            schema=Model.get_schema()
+            **_schema_properties(resource)
         )
 
     def add_control_modify_resource(self, resource, url):
-        Model = _getModel(resource)
         self.add_control(
             "edit",
             #url_for(f'api.{item_name}', **{resource: identifier}),
@@ -99,7 +119,7 @@ class NauttoBuilder(MasonBuilder):
             method="PUT",
             encoding="json",
             title=f'Edit this {resource}',
-            schema=Model.get_schema()
+            **_schema_properties(resource)
         )
 
     def add_control_delete_resource(self, resource, url):
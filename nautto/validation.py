@@ -0,0 +1,67 @@
+from flask import current_app
+from jsonschema import validators
+from jsonschema.exceptions import best_match
+
+
+def compile_schema(schema):
+    """
+    Checks a JSON schema and creates a validator for it that can be reused
+    for any number of documents.
+
+    : param dict schema: the JSON schema
+    """
+
+    cls = validators.validator_for(schema)
+    cls.check_schema(schema)
+    return cls(schema)
+
+
+def init_app(app):
+    """
+    Compiles a validator for the schema of every model that is accepted in
+    POST and PUT requests, and one for its merge patches.
+
+    : param app: the Flask application
+    """
+
+    from nautto.models import User, Widget, Layout, Set
+    from nautto.patch import patch_schema
+    app.extensions["validators"] = {
+        Model: compile_schema(Model.get_schema())
+        for Model in (User, Widget, Layout, Set)
+    }
+    app.extensions["patch_validators"] = {
+        Model: compile_schema(patch_schema(Model))
+        for Model in (User, Widget, Layout, Set)
+    }
+
+
+def validate(instance, Model):
+    """
+    Validates a document against the schema of a model with the validator
+    compiled at app start. Behaves like jsonschema.validate and raises the
+    same ValidationError for invalid documents.
+
+    : param instance: the document to validate
+    : param Model: the model whose schema the document must match
+    """
+
+    validator = current_app.extensions["validators"][Model]
+    error = best_match(validator.iter_errors(instance))
+    if error is not None:
+        raise error
+
+
+def validate_patch(instance, Model):
+    """
+    Validates a merge patch document for a model. Raises ValidationError
+    like validate.
+
+    : param instance: the merge patch document
+    : param Model: the model the patch is applied to
+    """
+
+    validator = current_app.extensions["patch_validators"][Model]
+    error = best_match(validator.iter_errors(instance))
+    if error is not None:
+        raise error
@@ -3,8 +3,10 @@ import click
 import pytest
 import tempfile
 import os
+import sqlite3
 
 from nautto import create_app, db
+from nautto.models import ContentBlob, Widget
 
 # based on http://flask.pocoo.org/docs/1.0/testing/
 # we don't need a client for database testing, just the db handle
@@ -39,4 +41,75 @@ def test_db_populate(app):
 def test_db_drop(app):
     runner = app.test_cli_runner()
     result = runner.invoke(args=['db-drop'])
-    assert 'done' in result.output
\ No newline at end of file
+    assert 'done' in result.output
+
+
+# the schema of the first version, before row versions and content blobs
+OLD_SCHEMA = """
+CREATE TABLE user (
+    id INTEGER NOT NULL, name VARCHAR(128) NOT NULL, description VARCHAR(1024),
+    PRIMARY KEY (id), UNIQUE (id)
+);
+CREATE TABLE layout (
+    id INTEGER NOT NULL, name VARCHAR(120) NOT NULL, description VARCHAR(1024), user_id INTEGER,
+    PRIMARY KEY (id), UNIQUE (id), FOREIGN KEY(user_id) REFERENCES user (id) ON DELETE CASCADE
+);
+CREATE TABLE widget (
+    id INTEGER NOT NULL, name VARCHAR(128) NOT NULL, description VARCHAR(1024),
+    type VARCHAR(64) NOT NULL, content TEXT NOT NULL, user_id INTEGER,
+    PRIMARY KEY (id), UNIQUE (id), FOREIGN KEY(user_id) REFERENCES user (id) ON DELETE CASCADE
+);
+CREATE TABLE layout_widgets (
+    layout_id INTEGER NOT NULL, widget_id INTEGER NOT NULL, PRIMARY KEY (layout_id, widget_id),
+    FOREIGN KEY(layout_id) REFERENCES layout (id), FOREIGN KEY(widget_id) REFERENCES widget (id)
+);
+INSERT INTO user (id, name) VALUES (1, 'Mikko Mallikas');
+INSERT INTO layout (id, name, user_id) VALUES (1, 'layout1', 1);
+INSERT INTO widget (id, name, type, content, user_id) VALUES (1, 'widget1', 'HTML', '<p>one</p>', 1);
+INSERT INTO widget (id, name, type, content, user_id) VALUES (2, 'widget2', 'HTML', '<p>one</p>', 1);
+INSERT INTO layout_widgets VALUES (1, 1);
+"""
+
+
+@pytest.fixture
+def old_app():
+    db_fd, db_fname = tempfile.mkstemp()
+    connection = sqlite3.connect(db_fname)
+    connection.executescript(OLD_SCHEMA)
+    connection.close()
+    config = {
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "TESTING": True
+    }
+
+    yield create_app(config)
+
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+def test_db_migrate_old_schema(old_app):
+    runner = old_app.test_cli_runner()
+    result = runner.invoke(args=['db-migrate'])
+    assert 'added column widget.version' in result.output
+    assert 'moved widget contents' in result.output
+    assert 'done' in result.output
+    # already up to date
+    result = runner.invoke(args=['db-migrate'])
+    assert result.output == 'done\n'
+
+    client = old_app.test_client()
+    resp = client.get("/api/widgets/1/")
+    assert resp.status_code == 200
+    assert resp.get_json()["content"] == "<p>one</p>"
+    resp = client.get("/api/widgets/?q=widget2")
+    assert [item["id"] for item in resp.get_json()["items"]] == [2]
+    resp = client.get("/api/layouts/1/")
+    assert resp.status_code == 200
+
+    with old_app.app_context():
+        assert db.session.query(Widget).get(2).version == 1
+        assert db.session.query(ContentBlob).one().refs == 2
+    resp = client.delete("/api/widgets/2/")
+    assert resp.status_code == 204
+    with old_app.app_context():
+        assert db.session.query(ContentBlob).one().refs == 1
@@ -8,7 +8,7 @@ from sqlalchemy import event
 from sqlalchemy.exc import IntegrityError, StatementError
 
 from nautto import create_app, db
-from nautto.models import User, Widget, Layout, Set
+from nautto.models import User, Widget, Layout, Set, ContentBlob, create_search_indexes
 
 
 @event.listens_for(Engine, "connect")
@@ -301,3 +301,75 @@ def test_set_columns(app):
         db.session.add(set)
         with pytest.raises(StatementError):
             db.session.commit()
+
+
+def test_content_blobs(app):
+    """
+    Tests that widget content is stored once per hash, that the blobs count
+    their references and that they are removed with the last one.
+    """
+
+    with app.app_context():
+        user = _get_user()
+        widgets = [_get_widget(number) for number in range(3)]
+        for widget in widgets:
+            widget.user = user
+        db.session.add_all(widgets)
+        db.session.commit()
+        assert ContentBlob.query.count() == 1
+        assert ContentBlob.query.first().refs == 3
+        assert len({widget.content_hash for widget in widgets}) == 1
+        assert Widget.query.first().content == "<p> test <p>"
+
+        widgets[0].content = "<p> changed <p>"
+        db.session.commit()
+        assert ContentBlob.query.count() == 2
+        assert Widget.query.get(widgets[0].id).content == "<p> changed <p>"
+        assert db.session.query(ContentBlob.refs).filter(
+            ContentBlob.hash == widgets[1].content_hash
+        ).scalar() == 2
+
+        db.session.delete(widgets[0])
+        db.session.commit()
+        assert ContentBlob.query.count() == 1
+        db.session.delete(user)
+        db.session.commit()
+        assert ContentBlob.query.count() == 0
+
+
+def test_search_indexes(app):
+    """
+    Tests that the search indexes are created and filled for a database
+    made before they existed, and kept up to date after that.
+    """
+
+    with app.app_context():
+        user = _get_user()
+        widget = _get_widget()
+        widget.user = user
+        db.session.add(widget)
+        db.session.commit()
+
+        # turn the database into one without search indexes
+        objects = db.session.execute(
+            "SELECT type, name FROM sqlite_master "
+            "WHERE name LIKE '%search%' AND type IN ('table', 'view')"
+        ).fetchall()
+        for kind, name in objects:
+            db.session.execute(f'DROP {kind.upper()} IF EXISTS {name}')
+        db.session.commit()
+
+        created = create_search_indexes(db.session.connection())
+        db.session.commit()
+        assert sorted(created) == ["layout_search", "set_search", "widget_search"]
+        assert create_search_indexes(db.session.connection()) == []
+        match = "SELECT rowid FROM widget_search WHERE widget_search MATCH :q"
+        assert db.session.execute(match, {"q": "test"}).fetchall() == [(widget.id,)]
+
+        widget.content = "<p> replaced <p>"
+        db.session.commit()
+        assert db.session.execute(match, {"q": "replaced"}).fetchall() == [(widget.id,)]
+        assert db.session.execute(match, {"q": "test"}).fetchall() == [(widget.id,)]
+        db.session.delete(widget)
+        db.session.commit()
+        assert db.session.execute(match, {"q": "test"}).fetchall() == []
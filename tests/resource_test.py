@@ -1,17 +1,32 @@
+import asyncio
+import gzip
+import hashlib
+import itertools
 import json
 import os
 import pytest
+import re
+import shutil
+import subprocess
+import sys
 import tempfile
+import threading
 import time
-from datetime import datetime
+from concurrent import futures
+from urllib.parse import urlencode
 
-from jsonschema import validate
+from flask import url_for
+from jsonschema import validate, ValidationError
 from sqlalchemy.engine import Engine
 from sqlalchemy import event
-from sqlalchemy.exc import IntegrityError, StatementError
 
 from nautto import create_app, db
-from nautto.models import User, Widget, Layout, Set
+from nautto.asgi import AsgiApp
+from nautto.constants import FILTER_PREFIX
+from nautto.models import User, Widget, Layout, Set, SetSnapshot, ContentBlob
+from nautto.instrumentation import count_queries
+from nautto.urls import url_template
+from nautto.validation import validate as validate_model
 
 
 @pytest.fixture
@@ -21,8 +36,12 @@ def client():
     we don't need a client for database testing, just the db handle
     '''
     db_fd, db_fname = tempfile.mkstemp()
+    metrics_dir = tempfile.mkdtemp()
+    blob_dir = tempfile.mkdtemp()
     config = {
         "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "METRICS_DIR": metrics_dir,
+        "BLOB_DIR": blob_dir,
         "TESTING": True
     }
 
@@ -36,6 +55,11 @@ def client():
 
     os.close(db_fd)
     os.unlink(db_fname)
+    for suffix in ("-wal", "-shm"):
+        if os.path.exists(db_fname + suffix):
+            os.unlink(db_fname + suffix)
+    shutil.rmtree(metrics_dir)
+    shutil.rmtree(blob_dir)
 
 
 def _get_user(number=1):
@@ -212,6 +236,60 @@ def _check_control_post_method(ctrl, client, obj, body):
     assert resp.status_code == 201
 
 
+def _check_query_budget(client, url, budget):
+    """
+    Fetches a URL and checks that serving it ran at most the given number of
+    SQL statements. Used to catch N+1 query regressions.
+    """
+
+    with count_queries() as queries:
+        resp = client.get(url)
+        resp.data
+    assert resp.status_code == 200
+    assert queries.count <= budget, f'{url} ran {queries.count} queries, budget is {budget}'
+
+
+def _check_query_plans(client, method, url, **kwargs):
+    """
+    Sends a request and runs EXPLAIN QUERY PLAN on every statement it
+    executed. Fails if any of them reads a whole table instead of searching
+    an index, or sorts rows instead of reading them in the order of an
+    index. Used to catch missing indexes.
+    """
+
+    statements = []
+    def record(conn, cursor, statement, parameters, context, executemany):
+        statements.append((statement, parameters[0] if executemany else parameters))
+    engine = db.get_engine(client.application)
+    event.listen(engine, "before_cursor_execute", record)
+    try:
+        resp = client.open(url, method=method, **kwargs)
+        resp.data
+    finally:
+        event.remove(engine, "before_cursor_execute", record)
+    assert resp.status_code < 400
+
+    connection = engine.raw_connection()
+    try:
+        for statement, parameters in statements:
+            if statement.startswith(("PRAGMA", "BEGIN", "COMMIT", "ROLLBACK")):
+                continue
+            plan = connection.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            for row in plan.fetchall():
+                scan = re.match(r"SCAN (\w+)$", row[3])
+                # the blob garbage queue is emptied as a whole
+                assert not scan or scan.group(1) == "blob_garbage", (row[3], statement)
+                # full-text matches come from the search index, which can't
+                # keep them in the order of the page
+                sorted_matches = " MATCH " in statement
+                assert not row[3].startswith("USE TEMP B-TREE") or sorted_matches, (
+                    row[3], statement
+                )
+    finally:
+        connection.close()
+    return resp
+
+
 class TestUserCollection(object):
 
     RESOURCE_URL = "/api/users/"
@@ -642,6 +720,1199 @@ class TestSetItem(object):
         assert resp.status_code == 404
 
 
+class TestPagination(object):
+
+    RESOURCE_URL = "/api/widgets/"
+
+    def _add_widgets(self, client, count):
+        for number in range(2, count + 2):
+            resp = client.post("/api/users/1/widgets/", json=_get_widget_json(number))
+            assert resp.status_code == 201
+
+    def _walk(self, client, url, ctrl):
+        ids = []
+        while url:
+            resp = client.get(url)
+            assert resp.status_code == 200
+            body = json.loads(resp.data)
+            ids.extend(item["id"] for item in body["items"])
+            url = body["@controls"].get(ctrl, {}).get("href")
+        return ids
+
+    def test_next_and_prev(self, client):
+        self._add_widgets(client, 6)
+        resp = client.get(self.RESOURCE_URL + "?limit=3")
+        body = json.loads(resp.data)
+        assert [item["id"] for item in body["items"]] == [1, 2, 3]
+        assert "prev" not in body["@controls"]
+
+        # walk forwards through all pages and back again from the last one
+        ids = self._walk(client, self.RESOURCE_URL + "?limit=3", "next")
+        assert ids == list(range(1, 8))
+        last = client.get(body["@controls"]["next"]["href"]).json
+        last = client.get(last["@controls"]["next"]["href"]).json
+        assert [item["id"] for item in last["items"]] == [7]
+        assert "next" not in last["@controls"]
+        ids = self._walk(client, last["@controls"]["prev"]["href"], "prev")
+        assert sorted(ids) == list(range(1, 7))
+
+    def test_default_limit(self, client):
+        resp = client.get(self.RESOURCE_URL)
+        body = json.loads(resp.data)
+        assert "next" not in body["@controls"]
+        assert "prev" not in body["@controls"]
+
+    def test_invalid_parameters(self, client):
+        for query in ["?after=!!!", "?after=abc", "?limit=0", "?limit=x",
+                      "?limit=100000", "?after=MQ&before=MQ"]:
+            resp = client.get(self.RESOURCE_URL + query)
+            assert resp.status_code == 400
+            resp = client.get("/api/layouts/1/" + query)
+            assert resp.status_code == 400
+
+    def test_embedded_items(self, client):
+        self._add_widgets(client, 4)
+        resp = client.put("/api/layouts/1/", json={
+            "name": "test-layout-1",
+            "items": [{"id": str(number)} for number in range(2, 6)]
+        })
+        assert resp.status_code == 204
+        ids = self._walk(client, "/api/layouts/1/?limit=2", "next")
+        assert ids == list(range(1, 6))
+
+
+class TestStreaming(object):
+
+    RESOURCE_URL = "/api/widgets/"
+
+    def test_limit_all(self, client):
+        for number in range(2, 8):
+            resp = client.post("/api/users/1/widgets/", json=_get_widget_json(number))
+            assert resp.status_code == 201
+        resp = client.get(self.RESOURCE_URL + "?limit=all")
+        assert resp.status_code == 200
+        assert resp.is_streamed
+        body = json.loads(resp.data)
+        assert [item["id"] for item in body["items"]] == list(range(1, 8))
+        assert "next" not in body["@controls"]
+        _check_control_get_method("self", client, body["items"][0])
+
+        cursor = client.get(self.RESOURCE_URL + "?limit=3").json["@controls"]["next"]["href"]
+        resp = client.get(cursor.replace("limit=3", "limit=all"))
+        assert [item["id"] for item in resp.json["items"]] == list(range(4, 8))
+
+    def test_same_document(self, client):
+        resp = client.get("/api/layouts/1/")
+        body = json.loads(resp.data)
+        assert resp.data.decode() == json.dumps(body)
+        assert list(body)[-1] == "items"
+
+
+class TestFields(object):
+
+    RESOURCE_URL = "/api/widgets/"
+
+    def test_content_not_loaded(self, client):
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(Engine, "before_cursor_execute", record)
+        try:
+            resp = client.get(self.RESOURCE_URL)
+            assert json.loads(resp.data)["items"]
+            resp = client.get("/api/layouts/1/")
+            assert json.loads(resp.data)["items"]
+        finally:
+            event.remove(Engine, "before_cursor_execute", record)
+        assert statements
+        assert not any("widget.content" in statement for statement in statements)
+
+    def test_sparse_fieldset(self, client):
+        for number in range(2, 5):
+            resp = client.post("/api/users/1/widgets/", json=_get_widget_json(number))
+            assert resp.status_code == 201
+        resp = client.get(self.RESOURCE_URL + "?fields=type,content&limit=2")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        item = body["items"][0]
+        assert item["id"] == 1
+        assert item["type"] == "HTML"
+        assert item["content"] == "<h1> Hello from widget id 1"
+        assert "name" not in item
+
+        # the fieldset is kept when moving to the next page
+        resp = client.get(body["@controls"]["next"]["href"])
+        assert set(resp.json["items"][0]) == {"id", "type", "content", "@controls"}
+
+        resp = client.get("/api/sets/1/?fields=description")
+        assert resp.json["items"][0]["description"] == "test-layout-1-desc"
+
+    def test_invalid_fields(self, client):
+        for url in [self.RESOURCE_URL, "/api/users/", "/api/layouts/1/"]:
+            resp = client.get(url + "?fields=password")
+            assert resp.status_code == 400
+        resp = client.get("/api/layouts/?fields=items")
+        assert resp.status_code == 400
+
+
+class TestUrlTemplates(object):
+
+    def test_same_as_url_for(self, client):
+        app = client.application
+        values = [1, 12345, "abc", "ä ö/?&#%", "x y"]
+        for script_root in ["", "/mount"]:
+            with app.test_request_context("/", environ_base={"SCRIPT_NAME": script_root}):
+                for rule in app.url_map.iter_rules():
+                    if not rule.endpoint.startswith("api."):
+                        continue
+                    build = url_template(rule.endpoint)
+                    for value in values:
+                        args = {name: value for name in rule.arguments}
+                        assert build(**args) == url_for(rule.endpoint, **args)
+                    args["after"] = "MQ"
+                    assert build(**args) == url_for(rule.endpoint, **args)
+
+
+class TestValidation(object):
+
+    def test_same_errors_as_jsonschema(self, client):
+        documents = [
+            _get_widget_json(),
+            {"name": "x"},
+            {"name": 1, "type": "HTML", "content": "x"},
+            {"name": "x", "type": "HTML", "content": ["x"], "description": 2},
+            [],
+        ]
+        with client.application.app_context():
+            for document in documents:
+                try:
+                    validate(document, Widget.get_schema())
+                    expected = None
+                except ValidationError as e:
+                    expected = str(e)
+                try:
+                    validate_model(document, Widget)
+                    result = None
+                except ValidationError as e:
+                    result = str(e)
+                assert result == expected
+
+
+class TestSchemaUrl(object):
+
+    def test_inline_by_default(self, client):
+        body = client.get("/api/widgets/1/").json
+        assert "schema" in body["@controls"]["edit"]
+        assert "schemaUrl" not in body["@controls"]["edit"]
+
+    def test_prefer_url(self, client):
+        resp = client.get("/api/widgets/", headers={"Prefer": "schema=url"})
+        assert "Prefer" in resp.headers["Vary"]
+        ctrl = resp.json["@controls"]["nautto:add-widget"]
+        assert "schema" not in ctrl
+        resp = client.get(ctrl["schemaUrl"])
+        assert resp.status_code == 200
+        assert resp.json == Widget.get_schema()
+        assert "max-age" in resp.headers["Cache-Control"]
+
+        # the schema can be revalidated cheaply
+        resp = client.get(ctrl["schemaUrl"], headers={"If-None-Match": resp.headers["ETag"]})
+        assert resp.status_code == 304
+
+        body = client.get("/api/sets/1/", headers={"Prefer": "schema=url"}).json
+        assert body["@controls"]["edit"]["schemaUrl"] == "/schemas/set/"
+        assert client.get("/schemas/nothing/").status_code == 404
+
+    def test_deployment_setting(self, client):
+        client.application.config["SCHEMA_MODE"] = "url"
+        body = client.get("/api/users/1/").json
+        assert body["@controls"]["edit"]["schemaUrl"] == "/schemas/user/"
+        body = client.get("/api/users/1/", headers={"Prefer": "schema=inline"}).json
+        assert "schema" in body["@controls"]["edit"]
+
+
+class TestRepresentationCache(object):
+
+    def _stats(self, client):
+        return client.application.extensions["representation_cache"].stats()
+
+    def test_hits_and_misses(self, client):
+        first = client.get("/api/widgets/1/")
+        assert self._stats(client)["misses"] == 1
+        second = client.get("/api/widgets/1/")
+        assert self._stats(client)["hits"] == 1
+        assert first.data == second.data
+
+        # other variants of the same item are cached separately
+        resp = client.get("/api/layouts/1/?fields=name")
+        assert "description" not in resp.json["items"][0]
+        resp = client.get("/api/layouts/1/?fields=description")
+        assert "description" in resp.json["items"][0]
+
+    def test_invalidation(self, client):
+        assert client.get("/api/layouts/1/").json["items"][0]["name"] == "test-widget-1"
+        assert client.get("/api/sets/1/").json["items"][0]["name"] == "test-layout-1"
+
+        # renaming a widget shows up in the layouts listing it
+        body = _get_widget_json()
+        body["name"] = "renamed"
+        assert client.put("/api/widgets/1/", json=body).status_code == 204
+        assert client.get("/api/widgets/1/").json["name"] == "renamed"
+        assert client.get("/api/layouts/1/").json["items"][0]["name"] == "renamed"
+
+        # so does a renamed layout in its sets
+        body = _get_layout_json()
+        body["name"] = "renamed"
+        assert client.put("/api/layouts/1/", json=body).status_code == 204
+        assert client.get("/api/sets/1/").json["items"][0]["name"] == "renamed"
+
+        # membership changes
+        client.post("/api/users/1/widgets/", json=_get_widget_json(2))
+        body["items"] = [{"id": "2"}]
+        assert client.put("/api/layouts/1/", json=body).status_code == 204
+        assert len(client.get("/api/layouts/1/").json["items"]) == 2
+
+        # deletes
+        assert client.delete("/api/widgets/2/").status_code == 204
+        assert client.get("/api/widgets/2/").status_code == 404
+        assert len(client.get("/api/layouts/1/").json["items"]) == 1
+        client.get("/api/users/1/")
+        assert client.delete("/api/users/1/").status_code == 204
+        for url in ["/api/users/1/", "/api/widgets/1/", "/api/layouts/1/", "/api/sets/1/"]:
+            assert client.get(url).status_code == 404
+
+    def test_writes_of_other_workers(self, client):
+        # another app on the same database, like a second worker process
+        other = create_app(dict(client.application.config)).test_client()
+        assert client.get("/api/widgets/1/").json["content"] == "<h1> Hello from widget id 1"
+        body = _get_widget_json()
+        body["content"] = "new"
+        assert other.put("/api/widgets/1/", json=body).status_code == 204
+        resp = client.get("/api/widgets/1/")
+        assert resp.json["content"] == "new"
+        assert resp.headers["ETag"] == other.get("/api/widgets/1/").headers["ETag"]
+
+    def test_invalidation_queries(self, client):
+        def patch_count():
+            with count_queries() as queries:
+                resp = client.patch(
+                    "/api/widgets/1/", data=json.dumps({"name": "patched"}),
+                    content_type="application/merge-patch+json"
+                )
+            assert resp.status_code == 204
+            return queries.count
+
+        few = patch_count()
+        for number in range(2, 12):
+            layout = _get_layout_json(number)
+            client.post("/api/users/1/layouts/", json=layout)
+            layout["items"] = [{"id": "1"}]
+            assert client.put(f'/api/layouts/{number}/', json=layout).status_code == 204
+            body = _get_set_json(number)
+            client.post("/api/users/1/sets/", json=body)
+            body["items"] = [{"id": str(number)}]
+            assert client.put(f'/api/sets/{number}/', json=body).status_code == 204
+            client.get(f'/api/sets/{number}/')
+        # the layouts and sets showing the widget are found in one statement
+        assert patch_count() == few
+        resp = client.get("/api/sets/11/")
+        assert resp.json["items"][0]["name"] == "test-layout-11"
+        resp = client.get("/api/layouts/11/")
+        assert resp.json["items"][0]["name"] == "patched"
+
+    def test_refused_writes_skip_invalidation(self, client):
+        # only the item is looked up before the document is refused
+        for url in ("/api/widgets/1/", "/api/layouts/1/", "/api/sets/1/"):
+            with count_queries() as queries:
+                resp = client.put(url, data="name", content_type="text/plain")
+            assert resp.status_code == 415
+            assert queries.count == 1
+            with count_queries() as queries:
+                resp = client.patch(
+                    url, data=json.dumps({"name": 1}),
+                    content_type="application/merge-patch+json"
+                )
+            assert resp.status_code == 400
+            assert queries.count == 1
+
+    def test_lru_eviction(self, client):
+        cache = client.application.extensions["representation_cache"]
+        cache.max_size = 2
+        client.get("/api/users/1/")
+        client.get("/api/users/2/")
+        client.get("/api/users/1/")
+        client.get("/api/widgets/1/")
+        assert len(cache) == 2
+        hits = cache.hits
+        client.get("/api/users/1/")
+        client.get("/api/users/2/")
+        assert cache.hits == hits + 1
+
+
+class TestConditionalRequests(object):
+
+    def _get(self, client, url, **kwargs):
+        # streamed bodies must be consumed to close the request context
+        resp = client.get(url, **kwargs)
+        resp.data
+        return resp
+
+    def _revalidate(self, client, url, resp):
+        return self._get(client, url, headers={"If-None-Match": resp.headers["ETag"]})
+
+    def test_items(self, client):
+        for url in ["/api/users/1/", "/api/widgets/1/", "/api/layouts/1/",
+                    "/api/sets/1/", "/api/layouts/1/widgets/1/", "/api/sets/1/layouts/1/"]:
+            resp = self._get(client, url)
+            assert resp.status_code == 200
+            assert resp.headers["ETag"]
+            last_modified = resp.headers["Last-Modified"]
+            resp = self._revalidate(client, url, resp)
+            assert resp.status_code == 304
+            assert not resp.data
+            resp = self._get(client, url, headers={"If-Modified-Since": last_modified})
+            assert resp.status_code == 304
+
+        # query arguments and schema mode change the representation
+        first = self._get(client, "/api/layouts/1/")
+        other = self._get(client, "/api/layouts/1/?fields=description")
+        assert first.headers["ETag"] != other.headers["ETag"]
+        other = self._get(client, "/api/layouts/1/", headers={"Prefer": "schema=url"})
+        assert first.headers["ETag"] != other.headers["ETag"]
+
+        assert self._get(client, "/api/widgets/1234/").status_code == 404
+
+    def test_writes_change_etags(self, client):
+        widget = self._get(client, "/api/widgets/1/")
+        layout = self._get(client, "/api/layouts/1/")
+        collection = self._get(client, "/api/widgets/")
+        assert self._revalidate(client, "/api/widgets/", collection).status_code == 304
+
+        body = _get_widget_json()
+        body["name"] = "renamed"
+        assert client.put("/api/widgets/1/", json=body).status_code == 204
+        assert self._revalidate(client, "/api/widgets/1/", widget).status_code == 200
+        assert self._revalidate(client, "/api/layouts/1/", layout).status_code == 200
+        assert self._revalidate(client, "/api/widgets/", collection).status_code == 200
+
+        # membership changes bump the version of the layout
+        layout = self._get(client, "/api/layouts/1/")
+        client.post("/api/users/1/widgets/", json=_get_widget_json(2))
+        assert self._revalidate(client, "/api/layouts/1/", layout).status_code == 200
+        layout = self._get(client, "/api/layouts/1/")
+        sets = self._get(client, "/api/sets/")
+        body = _get_layout_json()
+        body["items"] = [{"id": "2"}]
+        assert client.put("/api/layouts/1/", json=body).status_code == 204
+        assert self._revalidate(client, "/api/layouts/1/", layout).status_code == 200
+        assert self._revalidate(client, "/api/sets/", sets).status_code == 304
+
+        # cascaded deletes count as changes too
+        widgets = self._get(client, "/api/widgets/")
+        assert client.delete("/api/users/1/").status_code == 204
+        assert self._revalidate(client, "/api/widgets/", widgets).status_code == 200
+
+
+class TestCompression(object):
+
+    def test_gzip(self, client):
+        plain = client.get("/api/widgets/1/")
+        assert "Content-Encoding" not in plain.headers
+        assert "Accept-Encoding" in plain.headers["Vary"]
+
+        resp = client.get("/api/widgets/1/", headers={"Accept-Encoding": "gzip"})
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(resp.data) == plain.data
+        assert resp.headers["ETag"] == plain.headers["ETag"][:-1] + '-gzip"'
+
+        # the compressed representation validates the cached copy
+        etag = resp.headers["ETag"]
+        resp = client.get("/api/widgets/1/", headers={
+            "Accept-Encoding": "gzip", "If-None-Match": etag
+        })
+        assert resp.status_code == 304
+        assert resp.headers["ETag"] == etag
+
+    def test_streamed(self, client):
+        plain = client.get("/api/widgets/")
+        resp = client.get("/api/widgets/", headers={"Accept-Encoding": "gzip"})
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert gzip.decompress(resp.data) == plain.data
+
+    def test_threshold(self, client):
+        client.application.config["COMPRESSION_MIN_SIZE"] = 100000
+        resp = client.get("/api/widgets/1/", headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in resp.headers
+        resp = client.get("/api/widgets/1234/", headers={"Accept-Encoding": "gzip"})
+        assert "Content-Encoding" not in resp.headers
+
+    def test_precompressed_cache_entries(self, client):
+        cache = client.application.extensions["representation_cache"]
+        first = client.get("/api/layouts/1/", headers={"Accept-Encoding": "gzip"})
+        (representation,) = cache._entries.values()
+        assert representation.encoded["gzip"] == first.data
+        second = client.get("/api/layouts/1/", headers={"Accept-Encoding": "gzip"})
+        assert cache.hits == 1
+        assert second.data == first.data
+
+    def test_brotli(self, client):
+        brotli = pytest.importorskip("brotli")
+        plain = client.get("/api/widgets/1/")
+        resp = client.get("/api/widgets/1/", headers={"Accept-Encoding": "gzip, br"})
+        assert resp.headers["Content-Encoding"] == "br"
+        assert brotli.decompress(resp.data) == plain.data
+        resp = client.get("/api/widgets/", headers={"Accept-Encoding": "br"})
+        assert json.loads(brotli.decompress(resp.data))["items"]
+
+
+class TestEmbed(object):
+
+    def _build_tree(self, client, width):
+        widget_ids = []
+        for number in range(2, width + 2):
+            resp = client.post("/api/users/1/widgets/", json=_get_widget_json(number))
+            widget_ids.append(resp.headers["Location"].split("/")[-2])
+        for number in range(2, width + 2):
+            resp = client.post("/api/users/1/layouts/", json=_get_layout_json(number))
+            layout_id = resp.headers["Location"].split("/")[-2]
+            body = _get_layout_json(number)
+            body["items"] = [{"id": widget} for widget in widget_ids]
+            assert client.put(f'/api/layouts/{layout_id}/', json=body).status_code == 204
+            body = _get_set_json()
+            body["items"] = [{"id": layout_id}]
+            assert client.put("/api/sets/1/", json=body).status_code == 204
+
+    def _count_statements(self, client, url):
+        statements = []
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        event.listen(Engine, "before_cursor_execute", record)
+        try:
+            resp = client.get(url)
+            body = json.loads(resp.data)
+        finally:
+            event.remove(Engine, "before_cursor_execute", record)
+        return body, len(statements)
+
+    def test_embed_set(self, client):
+        body, narrow = self._count_statements(client, "/api/sets/1/?embed=layouts,widgets")
+        layout = body["items"][0]
+        assert layout["description"] == "test-layout-1-desc"
+        assert layout["items"][0]["content"] == "<h1> Hello from widget id 1"
+        _check_control_get_method("self", client, layout["items"][0])
+
+        self._build_tree(client, 5)
+        body, wide = self._count_statements(client, "/api/sets/1/?embed=widgets")
+        assert len(body["items"]) == 6
+        assert [len(layout["items"]) for layout in body["items"]] == [1] + [5] * 5
+        assert wide == narrow
+
+        body, _ = self._count_statements(client, "/api/sets/1/?embed=widgets&limit=all")
+        assert len(body["items"]) == 6
+
+        body = client.get("/api/sets/1/?embed=layouts").json
+        assert "items" not in body["items"][0]
+        assert "description" in body["items"][0]
+
+    def test_embed_layout(self, client):
+        body = client.get("/api/layouts/1/?embed=widgets").json
+        assert body["items"][0]["content"] == "<h1> Hello from widget id 1"
+        body = client.get("/api/layouts/1/?embed=widgets&fields=type").json
+        assert "content" not in body["items"][0]
+
+    def test_invalid_embed(self, client):
+        assert client.get("/api/layouts/1/?embed=layouts").status_code == 400
+        assert client.get("/api/sets/1/?embed=users").status_code == 400
+
+    def test_embedded_widget_changes(self, client):
+        client.get("/api/sets/1/?embed=widgets")
+        body = _get_widget_json()
+        body["content"] = "changed"
+        assert client.put("/api/widgets/1/", json=body).status_code == 204
+        body = client.get("/api/sets/1/?embed=widgets").json
+        assert body["items"][0]["items"][0]["content"] == "changed"
+
+
+class TestQueryBudget(object):
+
+    BUDGETS = {
+        "/api/users/": 2,
+        "/api/users/1/": 2,
+        "/api/users/1/widgets/": 2,
+        "/api/users/1/layouts/": 2,
+        "/api/users/1/sets/": 2,
+        "/api/widgets/": 2,
+        "/api/widgets/1/": 2,
+        "/api/layouts/": 2,
+        "/api/layouts/1/": 4,
+        "/api/layouts/1/?embed=widgets": 4,
+        "/api/layouts/1/widgets/1/": 2,
+        "/api/sets/": 2,
+        "/api/sets/1/": 4,
+        "/api/sets/1/?embed=layouts,widgets": 5,
+        "/api/sets/1/layouts/1/": 2,
+        "/api/sets/1/tree/": 8,
+    }
+
+    def test_budgets(self, client):
+        client.application.extensions["representation_cache"].max_size = 0
+        for number in range(2, 6):
+            client.post("/api/users/1/widgets/", json=_get_widget_json(number))
+            client.post("/api/users/1/layouts/", json=_get_layout_json(number))
+            client.post("/api/users/1/sets/", json=_get_set_json(number))
+        body = _get_layout_json()
+        body["items"] = [{"id": str(number)} for number in range(2, 6)]
+        client.put("/api/layouts/1/", json=body)
+        body = _get_set_json()
+        body["items"] = [{"id": str(number)} for number in range(2, 6)]
+        client.put("/api/sets/1/", json=body)
+
+        for url, budget in self.BUDGETS.items():
+            _check_query_budget(client, url, budget)
+
+    def test_post_does_not_requery(self, client):
+        with count_queries() as queries:
+            resp = client.post("/api/users/1/widgets/", json=_get_widget_json(2))
+        assert resp.status_code == 201
+        # one of them stores the content blob
+        assert queries.count <= 5
+
+    def test_server_timing(self, client):
+        resp = client.get("/api/widgets/1/")
+        assert "Server-Timing" not in resp.headers
+        client.application.config["SERVER_TIMING"] = True
+        # served from the representation cache after the version lookup
+        resp = client.get("/api/widgets/1/")
+        timing = resp.headers["Server-Timing"]
+        assert 'db;dur=' in timing
+        assert 'desc="1 queries"' in timing
+        assert "serialize;dur=" in timing
+        assert "total;dur=" in timing
+
+
+class TestMetrics(object):
+
+    RESOURCE_URL = "/metrics"
+
+    def _samples(self, text):
+        samples = {}
+        for line in text.splitlines():
+            if line and not line.startswith("#"):
+                name, value = line.rsplit(" ", 1)
+                samples[name] = float(value)
+        return samples
+
+    def test_get(self, client):
+        client.get("/api/widgets/1/")
+        client.get("/api/widgets/1/")
+        client.get("/api/widgets/").data
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/plain"
+        samples = self._samples(resp.data.decode())
+        labels = 'endpoint="api.widgetitem",method="GET",status="200"'
+        assert samples[f'nautto_requests_total{{{labels}}}'] == 2
+        assert samples['nautto_request_duration_seconds_count{endpoint="api.widgetitem"}'] == 2
+        assert samples['nautto_request_duration_seconds_bucket{endpoint="api.widgetitem",le="+Inf"}'] == 2
+        assert samples['nautto_response_size_bytes_sum{endpoint="api.widgetcollection"}'] > 0
+        assert samples['nautto_db_queries_total{endpoint="api.widgetitem"}'] >= 2
+        assert samples['nautto_cache_hits_total{endpoint="api.widgetitem"}'] == 1
+        assert samples['nautto_cache_misses_total{endpoint="api.widgetitem"}'] == 1
+        assert samples["nautto_cache_hit_ratio"] == 0.5
+
+    def test_workers_are_added_up(self, client):
+        from nautto.metrics import MetricsStore
+
+        client.get("/api/users/1/")
+        store = client.application.extensions["metrics"]
+        other = MetricsStore(store.directory, 0)
+        other.inc("nautto_requests_total", {
+            "endpoint": "api.useritem", "method": "GET", "status": "200"
+        }, 3)
+        other.observe("nautto_request_duration_seconds", {"endpoint": "api.useritem"}, 0.2)
+        other.flush()
+
+        samples = self._samples(client.get(self.RESOURCE_URL).data.decode())
+        labels = 'endpoint="api.useritem",method="GET",status="200"'
+        assert samples[f'nautto_requests_total{{{labels}}}'] == 4
+        assert samples['nautto_request_duration_seconds_count{endpoint="api.useritem"}'] == 2
+
+    def test_exited_workers_are_folded(self, client):
+        from nautto.metrics import MetricsStore
+
+        store = client.application.extensions["metrics"]
+        labels = {"endpoint": "api.useritem", "method": "GET", "status": "200"}
+        for _ in range(3):
+            # a recycled worker, whose process is gone
+            worker = subprocess.Popen([sys.executable, "-c", ""])
+            worker.wait()
+            other = MetricsStore(store.directory, 0)
+            other.inc("nautto_requests_total", labels, 2)
+            other.flush()
+            os.replace(other._path, os.path.join(
+                store.directory, f'{worker.pid}-{os.path.basename(other._path)}'
+            ))
+
+        text = 'nautto_requests_total{endpoint="api.useritem",method="GET",status="200"}'
+        for _ in range(2):
+            samples = self._samples(client.get(self.RESOURCE_URL).data.decode())
+            assert samples[text] == 6
+        files = [name for name in os.listdir(store.directory) if name.endswith(".json")]
+        assert sorted(files) == sorted(["aggregate.json", os.path.basename(store._path)])
+
+    def test_last_interval_of_exited_worker(self, client):
+        store = client.application.extensions["metrics"]
+        # a worker that only writes its file once per hour, then exits
+        script = (
+            "from nautto import create_app\n"
+            f"app = create_app({{'METRICS_DIR': {store.directory!r}, "
+            f"'METRICS_FLUSH_INTERVAL': 3600, 'SQLALCHEMY_DATABASE_URI': 'sqlite://'}})\n"
+            "client = app.test_client()\n"
+            "for _ in range(3):\n"
+            "    client.get('/missing/').close()\n"
+        )
+        subprocess.run([sys.executable, "-c", script], check=True)
+
+        samples = self._samples(client.get(self.RESOURCE_URL).data.decode())
+        requests = 'nautto_requests_total{endpoint="unmatched",method="GET",status="404"}'
+        assert samples[requests] == 3
+        sizes = 'nautto_response_size_bytes_count{endpoint="unmatched"}'
+        assert samples[sizes] == 3
+        files = [name for name in os.listdir(store.directory) if name.endswith(".json")]
+        assert sorted(files) == sorted(["aggregate.json", os.path.basename(store._path)])
+
+
+class TestBulkCreate(object):
+
+    RESOURCE_URL = "/api/users/1/widgets/"
+
+    def test_json_array(self, client):
+        documents = [_get_widget_json(number) for number in range(2, 102)]
+        with count_queries() as queries:
+            resp = client.post(self.RESOURCE_URL, json=documents)
+        assert resp.status_code == 201
+        assert queries.count <= 8
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 100
+        assert body["items"][0]["id"] == 2
+        for item, document in zip(body["items"], documents):
+            resp = client.get(item["@controls"]["self"]["href"])
+            assert resp.status_code == 200
+            assert json.loads(resp.data)["name"] == document["name"]
+
+    def test_ndjson(self, client):
+        documents = [_get_layout_json(number) for number in range(2, 5)]
+        documents[1]["id"] = "20"
+        resp = client.post(
+            "/api/users/1/layouts/",
+            data="\n".join(json.dumps(document) for document in documents) + "\n",
+            content_type="application/x-ndjson"
+        )
+        assert resp.status_code == 201
+        ids = [item["id"] for item in json.loads(resp.data)["items"]]
+        assert ids == [21, 20, 22]
+        resp = client.get("/api/users/1/layouts/?limit=all")
+        assert len(json.loads(resp.data)["items"]) == 4
+
+        resp = client.post(
+            "/api/users/1/sets/", data='{"name": "a"}\n{"name": ',
+            content_type="application/x-ndjson"
+        )
+        assert resp.status_code == 400
+        assert "Line 2" in json.loads(resp.data)["@error"]["@messages"][0]
+
+    def test_all_or_nothing(self, client):
+        documents = [_get_widget_json(number) for number in range(2, 6)]
+        del documents[1]["content"]
+        documents[3]["id"] = "abc"
+        resp = client.post(self.RESOURCE_URL, json=documents)
+        assert resp.status_code == 400
+        messages = json.loads(resp.data)["@error"]["@messages"]
+        assert len(messages) == 2
+        assert messages[0].startswith("Item 1:")
+        assert messages[1].startswith("Item 3:")
+
+        documents = [_get_widget_json(number) for number in range(2, 5)]
+        documents[2]["id"] = "1"
+        resp = client.post(self.RESOURCE_URL, json=documents)
+        assert resp.status_code == 409
+        assert json.loads(resp.data)["@error"]["@messages"] == [
+            "Item 2: id 1 already exists"
+        ]
+
+        documents[2]["id"] = "10"
+        documents[0]["id"] = "10"
+        resp = client.post(self.RESOURCE_URL, json=documents)
+        assert resp.status_code == 400
+
+        resp = client.post(self.RESOURCE_URL, json=[])
+        assert resp.status_code == 400
+        resp = client.post("/api/users/99/widgets/", json=[_get_widget_json()])
+        assert resp.status_code == 404
+
+        resp = client.get("/api/widgets/?limit=all")
+        assert len(json.loads(resp.data)["items"]) == 1
+
+    def test_members(self, client):
+        def members(url):
+            return [item["id"] for item in json.loads(client.get(url + "?limit=all").data)["items"]]
+
+        documents = [_get_layout_json(number) for number in range(2, 5)]
+        documents[0]["items"] = [{"id": "1"}]
+        documents[2]["items"] = [{"id": "1"}]
+        documents[2]["membership"] = "remove"
+        with count_queries() as queries:
+            resp = client.post("/api/users/1/layouts/", json=documents)
+            assert [item["id"] for item in json.loads(resp.data)["items"]] == [2, 3, 4]
+        assert resp.status_code == 201
+        # one lookup and one insert for the members of all layouts
+        assert queries.count <= 7
+        assert members("/api/layouts/2/") == [1]
+        assert members("/api/layouts/3/") == []
+        assert members("/api/layouts/4/") == []
+
+        documents = [_get_set_json(number) for number in range(2, 4)]
+        documents[1]["items"] = [{"id": "2"}, {"id": "1"}]
+        resp = client.post("/api/users/1/sets/", json=documents)
+        assert resp.status_code == 201
+        assert [item["id"] for item in json.loads(resp.data)["items"]] == [2, 3]
+        assert members("/api/sets/3/") == [1, 2]
+
+        # all or nothing when a member doesn't exist
+        documents = [_get_set_json(number) for number in range(4, 6)]
+        documents[1]["items"] = [{"id": "99"}]
+        resp = client.post("/api/users/1/sets/", json=documents)
+        assert resp.status_code == 404
+        assert client.get("/api/sets/4/").status_code == 404
+
+        # a single document gets its members too
+        document = _get_layout_json(5)
+        document["items"] = [{"id": "1"}]
+        resp = client.post("/api/users/1/layouts/", json=document)
+        assert resp.status_code == 201
+        assert members(resp.headers["Location"]) == [1]
+        with client.application.app_context():
+            # a new layout, not a changed one
+            assert Layout.query.filter_by(name="test-layout-5").one().version == 1
+
+    def test_collection_validators(self, client):
+        resp = client.get("/api/widgets/")
+        etag = resp.headers["ETag"]
+        resp.data
+        client.post(self.RESOURCE_URL, json=[_get_widget_json(2)])
+        resp = client.get("/api/widgets/", headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        resp.data
+
+
+class TestMembership(object):
+
+    RESOURCE_URL = "/api/layouts/1/"
+
+    def _members(self, client, url=RESOURCE_URL):
+        body = json.loads(client.get(url + "?limit=all").data)
+        return [item["id"] for item in body["items"]]
+
+    def _put(self, client, ids, membership=None, url=RESOURCE_URL):
+        body = _get_layout_json()
+        body["items"] = [{"id": str(number)} for number in ids]
+        if membership is not None:
+            body["membership"] = membership
+        return client.put(url, json=body)
+
+    def test_modes(self, client):
+        client.post("/api/users/1/widgets/", json=[
+            _get_widget_json(number) for number in range(2, 6)
+        ])
+        assert self._put(client, [1, 2, 3]).status_code == 204
+        assert self._members(client) == [1, 2, 3]
+        assert self._put(client, [3, 4], "add").status_code == 204
+        assert self._members(client) == [1, 2, 3, 4]
+        assert self._put(client, [1, 3, 5], "remove").status_code == 204
+        assert self._members(client) == [2, 4]
+        assert self._put(client, [4, 5], "replace").status_code == 204
+        assert self._members(client) == [4, 5]
+        assert self._put(client, [], "replace").status_code == 204
+        assert self._members(client) == []
+
+        resp = self._put(client, [1], "merge")
+        assert resp.status_code == 400
+        resp = self._put(client, [1, 100], "replace")
+        assert resp.status_code == 404
+        assert self._members(client) == []
+
+    def test_sets(self, client):
+        client.post("/api/users/1/layouts/", json=[
+            _get_layout_json(number) for number in range(2, 4)
+        ])
+        url = "/api/sets/1/"
+        assert self._put(client, [1, 2], url=url).status_code == 204
+        assert self._put(client, [2, 3], "replace", url=url).status_code == 204
+        assert self._members(client, url) == [2, 3]
+
+    def test_version_bump(self, client):
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+        resp.data
+        self._put(client, [1])
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        client.post("/api/users/1/widgets/", json=_get_widget_json(2))
+        self._put(client, [2])
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        resp.data
+
+    def test_constant_queries(self, client):
+        client.post("/api/users/1/widgets/", json=[
+            _get_widget_json(number) for number in range(2, 5002)
+        ])
+        with count_queries() as few:
+            self._put(client, range(1, 11), "replace")
+        with count_queries() as many:
+            self._put(client, range(1, 5002), "replace")
+        assert many.count == few.count
+        assert len(self._members(client)) == 5001
+        with count_queries() as removed:
+            self._put(client, [1], "replace")
+        assert removed.count == few.count
+        assert self._members(client) == [1]
+
+
+class TestPatch(object):
+
+    RESOURCE_URL = "/api/widgets/1/"
+
+    def _patch(self, client, url, patch):
+        return client.patch(
+            url, data=json.dumps(patch), content_type="application/merge-patch+json"
+        )
+
+    def test_widget(self, client):
+        before = json.loads(client.get(self.RESOURCE_URL).data)
+
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        engine = db.get_engine(client.application)
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            resp = self._patch(client, self.RESOURCE_URL, {"name": "renamed"})
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+        assert resp.status_code == 204
+        updates = [statement for statement in statements if statement.startswith("UPDATE widget")]
+        assert len(updates) == 1
+        assert "content" not in updates[0]
+        assert "type" not in updates[0]
+        assert not any("widget.content" in statement for statement in statements)
+
+        after = json.loads(client.get(self.RESOURCE_URL).data)
+        assert after["name"] == "renamed"
+        assert after["content"] == before["content"]
+        assert after["description"] == before["description"]
+
+        resp = self._patch(client, self.RESOURCE_URL, {"description": None})
+        assert resp.status_code == 204
+        assert json.loads(client.get(self.RESOURCE_URL).data)["description"] is None
+
+    def test_errors(self, client):
+        resp = client.patch(self.RESOURCE_URL, json={"name": "renamed"})
+        assert resp.status_code == 415
+        resp = self._patch(client, "/api/widgets/100/", {"name": "renamed"})
+        assert resp.status_code == 404
+        resp = self._patch(client, self.RESOURCE_URL, {"name": None})
+        assert resp.status_code == 400
+        resp = self._patch(client, self.RESOURCE_URL, {"content": 5})
+        assert resp.status_code == 400
+        resp = self._patch(client, "/api/users/1/", {"id": "2"})
+        assert resp.status_code == 409
+        resp = self._patch(client, "/api/layouts/1/", {"items": [{"id": "100"}]})
+        assert resp.status_code == 404
+
+    def test_ignores_internal_columns(self, client):
+        etag = client.get(self.RESOURCE_URL).headers["ETag"]
+        resp = self._patch(client, self.RESOURCE_URL, {"version": 1, "user_id": 2})
+        assert resp.status_code == 204
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+
+    def test_all_items(self, client):
+        client.post("/api/users/1/widgets/", json=_get_widget_json(2))
+        client.post("/api/users/1/layouts/", json=_get_layout_json(2))
+
+        resp = self._patch(client, "/api/layouts/1/", {"items": [{"id": "2"}]})
+        assert resp.status_code == 204
+        body = json.loads(client.get("/api/layouts/1/").data)
+        assert [item["id"] for item in body["items"]] == [2]
+        assert body["name"] == "test-layout-1"
+
+        resp = self._patch(client, "/api/sets/1/", {
+            "items": [{"id": "2"}], "membership": "add", "description": "patched"
+        })
+        assert resp.status_code == 204
+        body = json.loads(client.get("/api/sets/1/").data)
+        assert [item["id"] for item in body["items"]] == [1, 2]
+        assert body["description"] == "patched"
+
+        resp = self._patch(client, "/api/users/2/", {"name": "patched"})
+        assert resp.status_code == 204
+        assert json.loads(client.get("/api/users/2/").data)["name"] == "patched"
+
+
+class TestSetTree(object):
+
+    RESOURCE_URL = "/api/sets/1/tree/"
+
+    def test_get(self, client):
+        client.post("/api/users/1/widgets/", json=[_get_widget_json(2), _get_widget_json(3)])
+        client.post("/api/users/1/layouts/", json=_get_layout_json(2))
+        body = _get_layout_json()
+        body["items"] = [{"id": "1"}, {"id": "2"}]
+        client.put("/api/layouts/1/", json=body)
+        body = _get_layout_json(2)
+        body["items"] = [{"id": "2"}, {"id": "3"}]
+        client.put("/api/layouts/2/", json=body)
+        client.post("/api/users/1/layouts/", json=_get_layout_json(3))
+        body = _get_set_json()
+        body["items"] = [{"id": "2"}, {"id": "3"}]
+        client.put("/api/sets/1/", json=body)
+
+        set_body = json.loads(client.get("/api/sets/1/").data)
+        assert set_body["@controls"]["nautto:tree"]["href"] == self.RESOURCE_URL
+
+        with count_queries() as queries:
+            resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.mimetype == "application/json"
+        # the snapshot miss and the three statements of the tree
+        assert queries.count == 4
+        with count_queries() as queries:
+            # the snapshot is built once the response has been sent
+            resp.close()
+        assert queries.count > 0
+        # the snapshot and the contents in one
+        _check_query_budget(client, self.RESOURCE_URL, 1)
+        resp = client.get(self.RESOURCE_URL)
+        tree = json.loads(resp.data)
+        assert tree["id"] == 1
+        assert tree["name"] == "test-layout-1"
+        assert [(layout["id"], layout["widgets"]) for layout in tree["layouts"]] == [
+            (1, [1, 2]), (2, [2, 3]), (3, [])
+        ]
+        assert [widget["id"] for widget in tree["widgets"]] == [1, 2, 3]
+        assert tree["widgets"][2]["content"] == _get_widget_json(3)["content"]
+        assert b"@controls" not in resp.data
+
+        resp = client.get("/api/sets/100/tree/")
+        assert resp.status_code == 404
+
+    def test_invalidation(self, client):
+        resp = client.get(self.RESOURCE_URL)
+        assert json.loads(resp.data)["widgets"][0]["name"] == "test-widget-1"
+        client.patch(
+            "/api/widgets/1/", data=json.dumps({"name": "renamed"}),
+            content_type="application/merge-patch+json"
+        )
+        resp = client.get(self.RESOURCE_URL)
+        assert json.loads(resp.data)["widgets"][0]["name"] == "renamed"
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.mimetype == "application/json"
+
+    def _snapshots(self, client):
+        with client.application.app_context():
+            return [snapshot.set_id for snapshot in SetSnapshot.query.order_by(SetSnapshot.set_id)]
+
+    def test_stored_content(self, client):
+        client.application.config["BLOB_INLINE_MAX"] = 1024
+        document = _get_widget_json(1)
+        document["content"] = "<p>" + "x" * 5000 + "</p>"
+        client.put("/api/widgets/1/", json=document)
+        resp = client.get(self.RESOURCE_URL)
+        resp.close()
+        assert json.loads(resp.data)["widgets"][0]["content"] == document["content"]
+        # the snapshot refers to the content by hash
+        with client.application.app_context():
+            data = SetSnapshot.query.one().data
+        assert "x" * 100 not in data
+        # read from the blob store after the one statement
+        _check_query_budget(client, self.RESOURCE_URL, 1)
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": resp.headers["ETag"]})
+        assert resp.status_code == 304
+
+    def _read(self, client, url, **kwargs):
+        # closing the response builds the snapshot, as servers do
+        resp = client.get(url, **kwargs)
+        resp.close()
+        return resp
+
+    def test_dependency_index(self, client):
+        client.post("/api/users/1/widgets/", json=_get_widget_json(2))
+        client.post("/api/users/1/layouts/", json=_get_layout_json(2))
+        client.post("/api/users/1/sets/", json=_get_set_json(2))
+        body = _get_set_json(2)
+        body["items"] = [{"id": "2"}]
+        client.put("/api/sets/2/", json=body)
+        self._read(client, self.RESOURCE_URL)
+        self._read(client, "/api/sets/2/tree/")
+        assert self._snapshots(client) == [1, 2]
+
+        # widget 2 is in no layout, layout 2 is only in set 2
+        client.put("/api/widgets/2/", json=_get_widget_json(3))
+        assert self._snapshots(client) == [1, 2]
+        body = _get_layout_json(2)
+        body["items"] = [{"id": "2"}]
+        client.put("/api/layouts/2/", json=body)
+        assert self._snapshots(client) == [1]
+        self._read(client, "/api/sets/2/tree/")
+        client.delete("/api/widgets/2/")
+        assert self._snapshots(client) == [1]
+        self._read(client, "/api/sets/2/tree/")
+        client.delete("/api/sets/2/")
+        assert self._snapshots(client) == [1]
+        resp = self._read(client, "/api/sets/2/tree/")
+        assert resp.status_code == 404
+
+        etag = self._read(client, self.RESOURCE_URL).headers["ETag"]
+        client.delete("/api/layouts/1/")
+        assert self._snapshots(client) == []
+        resp = self._read(client, self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["layouts"] == []
+
+
+class TestContentBlobs(object):
+
+    def _blobs(self, client):
+        with client.application.app_context():
+            return dict(db.session.query(ContentBlob.data, ContentBlob.refs))
+
+    def test_deduplication(self, client):
+        document = _get_widget_json(2)
+        client.post("/api/users/1/widgets/", json=[document] * 50)
+        client.post("/api/users/2/widgets/", json=[document] * 50)
+        client.post("/api/users/2/widgets/", json=document)
+        blobs = self._blobs(client)
+        assert blobs[document["content"]] == 101
+        assert len(blobs) == 2
+
+        resp = client.get("/api/widgets/102/")
+        assert json.loads(resp.data)["content"] == document["content"]
+        resp = client.get("/api/widgets/?fields=content&limit=all")
+        assert all(item["content"] for item in json.loads(resp.data)["items"])
+
+        client.patch(
+            "/api/widgets/1/", data=json.dumps({"content": document["content"]}),
+            content_type="application/merge-patch+json"
+        )
+        assert self._blobs(client) == {document["content"]: 102}
+        client.delete("/api/users/2/")
+        assert self._blobs(client) == {document["content"]: 51}
+
+
+class TestWidgetContent(object):
+
+    RESOURCE_URL = "/api/widgets/1/content/"
+
+    def test_inline(self, client):
+        content = _get_widget_json(1)["content"]
+        body = json.loads(client.get("/api/widgets/1/").data)
+        assert body["@controls"]["nautto:content"]["href"] == self.RESOURCE_URL
+
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.data == content.encode("utf-8")
+        assert resp.headers["Content-Type"] == "text/html; charset=utf-8"
+        assert resp.headers["Accept-Ranges"] == "bytes"
+        etag = hashlib.sha256(content.encode("utf-8")).hexdigest()
+        assert resp.headers["ETag"] == f'"{etag}"'
+
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": f'"{etag}"'})
+        assert resp.status_code == 304
+        resp = client.get(self.RESOURCE_URL, headers={"Range": "bytes=0-3"})
+        assert resp.status_code == 206
+        assert resp.data == content.encode("utf-8")[:4]
+        assert resp.headers["Content-Range"] == f'bytes 0-3/{len(content)}'
+        resp = client.get(
+            self.RESOURCE_URL, headers={"Range": "bytes=0-3", "If-Range": '"stale"'}
+        )
+        assert resp.status_code == 200
+        assert resp.data == content.encode("utf-8")
+
+        resp = client.get("/api/widgets/100/content/")
+        assert resp.status_code == 404
+
+    def test_blob_store(self, client):
+        client.application.config["BLOB_INLINE_MAX"] = 1024
+        store = client.application.extensions["blob_store"]
+        document = _get_widget_json(2)
+        document["type"] = "SVG"
+        document["content"] = "<svg>" + "ä" * 5000 + "</svg>"
+        data = document["content"].encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        client.post("/api/users/1/widgets/", json=[document, document])
+        assert os.path.exists(store.path(digest))
+
+        resp = client.get("/api/widgets/2/")
+        assert json.loads(resp.data)["content"] == document["content"]
+        resp = client.get("/api/widgets/2/content/")
+        assert resp.status_code == 200
+        assert resp.mimetype == "image/svg+xml"
+        assert resp.headers["Content-Length"] == str(len(data))
+        assert "Content-Encoding" not in resp.headers
+        assert resp.data == data
+
+        resp = client.get("/api/widgets/2/content/", headers={"Range": "bytes=1000-2999"})
+        assert resp.status_code == 206
+        assert resp.data == data[1000:3000]
+        resp = client.get("/api/widgets/2/content/", headers={"Range": "bytes=-10"})
+        assert resp.data == data[-10:]
+        resp = client.get("/api/widgets/2/content/", headers={"Range": f'bytes={len(data)}-'})
+        assert resp.status_code == 416
+
+        client.delete("/api/widgets/2/")
+        assert os.path.exists(store.path(digest))
+        client.patch(
+            "/api/widgets/3/", data=json.dumps({"content": "small"}),
+            content_type="application/merge-patch+json"
+        )
+        assert not os.path.exists(store.path(digest))
+        resp = client.get("/api/widgets/3/content/")
+        assert resp.data == b"small"
+
+    def test_rolled_back_files(self, client):
+        client.application.config["BLOB_INLINE_MAX"] = 16
+        store = client.application.extensions["blob_store"]
+        client.post("/api/users/1/widgets/", json=_get_widget_json(2))
+
+        # the new id is taken
+        document = _get_widget_json(1)
+        document["id"] = "2"
+        document["content"] = "k" * 30
+        resp = client.put("/api/widgets/1/", json=document)
+        assert resp.status_code == 409
+        digest = hashlib.sha256(b"k" * 30).hexdigest()
+        assert not os.path.exists(store.path(digest))
+
+        document = _get_widget_json(3)
+        document["id"] = "2"
+        document["content"] = "b" * 30
+        resp = client.post("/api/users/1/widgets/", json=document)
+        assert resp.status_code == 409
+        digest = hashlib.sha256(b"b" * 30).hexdigest()
+        assert not os.path.exists(store.path(digest))
+
+        # files of committed writes stay
+        document = _get_widget_json(1)
+        document["content"] = "k" * 30
+        assert client.put("/api/widgets/1/", json=document).status_code == 204
+        assert client.get("/api/widgets/1/content/").data == b"k" * 30
+
+
 class TestEntryPoint(object):
 
     RESOURCE_URL = "/api/"
@@ -662,4 +1933,543 @@ class TestIndex(object):
     def test_get(self, client):
 
         resp = client.get(self.RESOURCE_URL)
-        assert resp.status_code == 200
\ No newline at end of file
+        assert resp.status_code == 200
+
+
+class TestSqlitePragmas(object):
+
+    def _pragma(self, app, name):
+        with app.app_context():
+            return db.session.execute(f'PRAGMA {name}').scalar()
+
+    def _app(self, db_fname, **config):
+        config.update({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+            "METRICS_DIR": self.directory,
+            "BLOB_DIR": self.directory,
+            "TESTING": True,
+        })
+        return create_app(config)
+
+    def setup_method(self, method):
+        self.directory = tempfile.mkdtemp()
+
+    def teardown_method(self, method):
+        shutil.rmtree(self.directory)
+
+    def test_default_profile(self, client):
+        app = client.application
+        assert self._pragma(app, "journal_mode") == "delete"
+        assert self._pragma(app, "synchronous") == 2
+        assert self._pragma(app, "foreign_keys") == 1
+
+    def test_performance_profile(self):
+        db_fd, db_fname = tempfile.mkstemp()
+        try:
+            app = self._app(db_fname, SQLITE_PROFILE="performance")
+            assert self._pragma(app, "journal_mode") == "wal"
+            assert self._pragma(app, "synchronous") == 1
+            assert self._pragma(app, "busy_timeout") == 5000
+            assert self._pragma(app, "cache_size") == -65536
+            assert self._pragma(app, "temp_store") == 2
+            assert self._pragma(app, "foreign_keys") == 1
+        finally:
+            os.close(db_fd)
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(db_fname + suffix):
+                    os.unlink(db_fname + suffix)
+
+    def test_profiles_per_app(self):
+        safe_fd, safe_fname = tempfile.mkstemp()
+        fast_fd, fast_fname = tempfile.mkstemp()
+        try:
+            safe = self._app(safe_fname, SQLITE_PROFILE="safe")
+            fast = self._app(
+                fast_fname, SQLITE_PROFILE="performance", SQLITE_PRAGMAS={"busy_timeout": 250}
+            )
+            # the listener of one app must not leak into the other
+            assert self._pragma(safe, "journal_mode") == "delete"
+            assert self._pragma(safe, "busy_timeout") != 250
+            assert self._pragma(safe, "foreign_keys") == 1
+            assert self._pragma(fast, "journal_mode") == "wal"
+            assert self._pragma(fast, "busy_timeout") == 250
+        finally:
+            for handle, fname in ((safe_fd, safe_fname), (fast_fd, fast_fname)):
+                os.close(handle)
+                for suffix in ("", "-wal", "-shm"):
+                    if os.path.exists(fname + suffix):
+                        os.unlink(fname + suffix)
+
+    def test_invalid_pragmas(self):
+        with pytest.raises(ValueError):
+            self._app("unused.db", SQLITE_PROFILE="reckless")
+        with pytest.raises(ValueError):
+            self._app("unused.db", SQLITE_PRAGMAS={"writable_schema": "ON"})
+        with pytest.raises(ValueError):
+            self._app("unused.db", SQLITE_PRAGMAS={"cache_size": "1; DROP TABLE user"})
+
+
+class TestQueryPlans(object):
+
+    def test_collections_by_user(self, client):
+        for resource in ("widgets", "layouts", "sets"):
+            _check_query_plans(client, "GET", f'/api/users/1/{resource}/')
+            _check_query_plans(client, "GET", f'/api/users/1/{resource}/?q=test')
+            _check_query_plans(client, "GET", f'/api/{resource}/?q=test')
+
+    def test_items(self, client):
+        for url in (
+            "/api/users/1/", "/api/widgets/1/", "/api/widgets/1/content/",
+            "/api/layouts/1/", "/api/sets/1/", "/api/sets/1/tree/",
+            "/api/layouts/1/widgets/1/", "/api/sets/1/layouts/1/",
+        ):
+            _check_query_plans(client, "GET", url)
+        # the snapshot is built once the first response has been sent
+        _check_query_plans(client, "GET", "/api/sets/1/tree/").close()
+        _check_query_plans(client, "GET", "/api/sets/1/tree/")
+
+    def test_writes(self, client):
+        _check_query_plans(client, "PUT", "/api/widgets/1/", json=_get_widget_json())
+        _check_query_plans(client, "PUT", "/api/layouts/1/", json=_get_layout_json())
+        _check_query_plans(client, "PUT", "/api/sets/1/", json=_get_set_json())
+
+    def test_deletes(self, client):
+        # removing a widget or layout looks up where it is used
+        _check_query_plans(client, "DELETE", "/api/widgets/1/")
+        _check_query_plans(client, "DELETE", "/api/layouts/1/")
+        _check_query_plans(client, "DELETE", "/api/sets/1/")
+        _check_query_plans(client, "DELETE", "/api/users/1/")
+
+
+class TestSearch(object):
+
+    def _add_widget(self, client, name, content, user=1):
+        document = _get_widget_json()
+        document.update(name=name, content=content)
+        resp = client.post(f'/api/users/{user}/widgets/', json=document)
+        assert resp.status_code == 201
+        return int(resp.headers["Location"].rstrip("/").rsplit("/", 1)[1])
+
+    def _ids(self, client, url):
+        resp = client.get(url)
+        assert resp.status_code == 200
+        return [item["id"] for item in json.loads(resp.data)["items"]]
+
+    def test_widgets(self, client):
+        weather = self._add_widget(client, "weather", "<p>Weather: rain today, rain tomorrow</p>")
+        clock = self._add_widget(client, "clock", "<p>Time and weather</p>")
+        assert self._ids(client, "/api/widgets/?q=weather") == [weather, clock]
+        assert self._ids(client, "/api/widgets/?q=rain") == [weather]
+        assert self._ids(client, "/api/widgets/?q=RAIN+time") == []
+        assert self._ids(client, "/api/widgets/?q=tomo*") == [weather]
+        assert self._ids(client, "/api/widgets/?q=hello") == [1]
+        # descriptions are searched too
+        assert sorted(self._ids(client, "/api/widgets/?q=desc")) == [1, weather, clock]
+
+    def test_by_user(self, client):
+        first = self._add_widget(client, "news", "headlines", user=1)
+        self._add_widget(client, "news", "headlines", user=2)
+        assert self._ids(client, "/api/users/1/widgets/?q=news") == [first]
+        assert self._ids(client, "/api/users/1/layouts/?q=layout") == [1]
+        assert self._ids(client, "/api/users/2/layouts/?q=layout") == []
+        assert self._ids(client, "/api/users/1/sets/?q=set") == [1]
+
+    def test_layouts_and_sets(self, client):
+        assert self._ids(client, "/api/layouts/?q=test-layout-1") == [1]
+        assert self._ids(client, "/api/sets/?q=set") == [1]
+        assert self._ids(client, "/api/sets/?q=layout") == []
+
+    def test_index_follows_changes(self, client):
+        body = _get_widget_json()
+        body.update(name="renamed", content="<p>fresh</p>")
+        assert client.put("/api/widgets/1/", json=body).status_code == 204
+        assert self._ids(client, "/api/widgets/?q=hello") == []
+        assert self._ids(client, "/api/widgets/?q=fresh+renamed") == [1]
+        resp = client.patch(
+            "/api/sets/1/", data=json.dumps({"description": "lobby"}),
+            content_type="application/merge-patch+json"
+        )
+        assert resp.status_code == 204
+        assert self._ids(client, "/api/sets/?q=lobby") == [1]
+        assert client.delete("/api/users/1/").status_code == 204
+        assert self._ids(client, "/api/widgets/?q=fresh") == []
+        assert self._ids(client, "/api/sets/?q=lobby") == []
+
+    def test_pages(self, client):
+        for number in range(7):
+            self._add_widget(client, f'match {"match " * number}', "page")
+        expected = self._ids(client, "/api/widgets/?q=match&limit=all")
+        assert len(expected) == 7
+        # more mentions rank higher
+        assert expected[0] == 8 and expected[-1] == 2
+
+        ids = []
+        url = "/api/widgets/?q=match&limit=3"
+        while url:
+            body = json.loads(client.get(url).data)
+            ids.extend(item["id"] for item in body["items"])
+            url = body["@controls"].get("next", {}).get("href")
+            last = body
+        assert ids == expected
+        prev = json.loads(client.get(last["@controls"]["prev"]["href"]).data)
+        assert [item["id"] for item in prev["items"]] == expected[3:6]
+
+    def test_invalid_query(self, client):
+        resp = client.get("/api/widgets/?q=%22%28")
+        assert resp.status_code == 400
+        resp = client.get("/api/widgets/?q=match&after=nonsense")
+        assert resp.status_code == 400
+        # operators are searched for as words instead of being applied
+        assert self._ids(client, '/api/widgets/?q=name%3Ahello+OR+NOT') == []
+
+
+class TestFiltering(object):
+
+    def _add(self, client, url, **document):
+        resp = client.post(url, json=document)
+        assert resp.status_code == 201
+        return int(resp.headers["Location"].rstrip("/").rsplit("/", 1)[1])
+
+    def _widget(self, client, name, type="HTML", user=1):
+        document = _get_widget_json()
+        document.update(name=name, type=type)
+        return self._add(client, f'/api/users/{user}/widgets/', **document)
+
+    def _ids(self, client, url):
+        resp = client.get(url)
+        assert resp.status_code == 200, resp.data
+        return [item["id"] for item in json.loads(resp.data)["items"]]
+
+    def test_filters(self, client):
+        clock = self._widget(client, "clock", type="text")
+        banner = self._widget(client, "banner", type="svg", user=2)
+        board = self._widget(client, "board", type="text", user=2)
+        assert self._ids(client, "/api/widgets/?type=text") == [clock, board]
+        # ordered by type, the order of the index serving them
+        assert self._ids(client, "/api/widgets/?type=text&type=svg") == [banner, clock, board]
+        assert self._ids(client, "/api/widgets/?name_prefix=b") == [banner, board]
+        assert self._ids(client, "/api/widgets/?name_prefix=bo") == [board]
+        assert self._ids(client, "/api/widgets/?user=2") == [banner, board]
+        assert self._ids(client, "/api/widgets/?user=2&type=text") == [board]
+        assert self._ids(client, "/api/users/2/widgets/?name_prefix=ban") == [banner]
+        assert self._ids(client, "/api/users/?name_prefix=test-user-2") == [2]
+        assert self._ids(client, "/api/layouts/?user=2") == []
+        assert self._ids(client, "/api/sets/?user=1&name_prefix=test") == [1]
+
+    def test_sort(self, client):
+        clock = self._widget(client, "clock", type="text")
+        banner = self._widget(client, "banner", type="svg")
+        assert self._ids(client, "/api/widgets/?sort=name") == [banner, clock, 1]
+        assert self._ids(client, "/api/widgets/?sort=-name") == [1, clock, banner]
+        assert self._ids(client, "/api/widgets/?sort=-id") == [banner, clock, 1]
+        assert self._ids(client, "/api/widgets/?sort=type") == [1, banner, clock]
+        assert self._ids(client, "/api/widgets/?sort=name&limit=all") == [banner, clock, 1]
+        assert self._ids(client, "/api/users/?sort=-name") == [2, 1]
+
+    def test_sorted_pages(self, client):
+        # ties in the sort column are broken by id, so pages never overlap
+        names = ["b", "a", "b", "c", "a", "b", "c"]
+        ids = [self._widget(client, name) for name in names]
+        rows = [("test-widget-1", 1)] + list(zip(names, ids))
+        expected = [identifier for name, identifier in sorted(rows, reverse=True)]
+
+        walked = []
+        url = "/api/widgets/?sort=-name&limit=3"
+        while url:
+            body = json.loads(client.get(url).data)
+            walked.extend(item["id"] for item in body["items"])
+            url = body["@controls"].get("next", {}).get("href")
+            last = body
+        assert walked == expected
+        prev = json.loads(client.get(last["@controls"]["prev"]["href"]).data)
+        assert [item["id"] for item in prev["items"]] == expected[3:6]
+
+    def test_repeated_filter_pages(self, client):
+        ids = [self._widget(client, name, type=type) for name, type in (
+            ("a", "text"), ("b", "svg"), ("c", "CSS"), ("d", "text"), ("e", "svg"),
+        )]
+        walked = []
+        url = "/api/widgets/?type=text&type=svg&limit=2"
+        while url:
+            body = json.loads(client.get(url).data)
+            walked.extend(item["id"] for item in body["items"])
+            url = body["@controls"].get("next", {}).get("href")
+        assert walked == [ids[1], ids[4], ids[0], ids[3]]
+
+    def test_with_search(self, client):
+        first = self._widget(client, "news b", type="text")
+        second = self._widget(client, "news a", type="svg")
+        assert self._ids(client, "/api/widgets/?q=news&sort=name") == [second, first]
+        assert self._ids(client, "/api/widgets/?q=news&type=svg") == [second]
+
+    def test_invalid(self, client):
+        for url in (
+            "/api/widgets/?sort=content", "/api/widgets/?sort=--id",
+            "/api/widgets/?user=one", "/api/layouts/?type=HTML&sort=type",
+            "/api/widgets/?name_prefix=a&name_prefix=b", "/api/users/?q=test",
+            "/api/widgets/?sort=name&after=MQ",
+        ):
+            resp = client.get(url)
+            assert resp.status_code == 400, url
+
+    def test_indexes(self, client):
+        # every combination of filters, sort and direction either runs on
+        # indexes or is refused
+        for url, Model in (
+            ("/api/widgets/", Widget), ("/api/users/1/widgets/", Widget),
+            ("/api/layouts/", Layout), ("/api/users/1/layouts/", Layout),
+            ("/api/sets/", Set), ("/api/users/1/sets/", Set), ("/api/users/", User),
+        ):
+            choices = []
+            for name, (column, operator) in Model.FILTERS.items():
+                value = "1" if column == "user_id" else "test"
+                repeated = [] if operator == FILTER_PREFIX else [[(name, value), (name, "2")]]
+                choices.append([[], [(name, value)]] + repeated)
+            orders = [[]] + [
+                [("sort", prefix + sort)] for sort in Model.SORTS for prefix in ("", "-")
+            ]
+            for filters in itertools.product(*choices):
+                args = [arg for chosen in filters for arg in chosen]
+                served = all(len(chosen) < 2 for chosen in filters) and not any(
+                    Model.FILTERS[name][1] == FILTER_PREFIX for name, value in args
+                )
+                for order in orders:
+                    if not args and order in ([], [("sort", "id")], [("sort", "-id")]):
+                        # pages of the whole table read it in key order
+                        continue
+                    query = urlencode(args + order + [("limit", 2)])
+                    resp = client.get(f'{url}?{query}')
+                    resp.close()
+                    if resp.status_code == 400:
+                        # only filters that need an order of their own are
+                        # refused, with other orders or with each other
+                        assert not served, query
+                        continue
+                    _check_query_plans(client, "GET", f'{url}?{query}')
+
+    def test_filter_order(self, client):
+        clock = self._widget(client, "clock", type="text")
+        banner = self._widget(client, "banner", type="svg", user=2)
+        # repeated values and prefixes are served in the order of their column
+        assert self._ids(client, "/api/widgets/?type=text&type=svg&sort=-type") == [clock, banner]
+        assert self._ids(client, "/api/widgets/?name_prefix=c&sort=-name") == [clock]
+        for url in (
+            "/api/widgets/?type=text&type=svg&sort=name", "/api/widgets/?user=1&user=2&sort=id",
+            "/api/widgets/?name_prefix=c&sort=type", "/api/widgets/?name_prefix=c&user=1&user=2",
+        ):
+            resp = client.get(url)
+            assert resp.status_code == 400, url
+
+    def test_unknown_parameters(self, client):
+        for url in (
+            "/api/layouts/?type=HTML", "/api/widgets/?usr=3", "/api/users/?user=1",
+            "/api/users/1/sets/?name=set",
+        ):
+            resp = client.get(url)
+            assert resp.status_code == 400, url
+        assert self._ids(client, "/api/widgets/?fields=name&embed=&limit=all") == [1]
+
+
+class TestAsgi(object):
+
+    def _request(self, app, method, path, query=b"", headers=(), body=b"", send=None):
+        """
+        Runs one request through the ASGI application and returns the status,
+        headers and body it sent.
+        """
+
+        received = [{"type": "http.request", "body": body, "more_body": False}]
+        messages = []
+
+        async def receive():
+            if received:
+                return received.pop()
+            await asyncio.sleep(3600)
+
+        async def record(message):
+            messages.append(message)
+            if send is not None:
+                await send(message)
+
+        scope = {
+            "type": "http", "http_version": "1.1", "method": method, "scheme": "http",
+            "path": path, "query_string": query, "root_path": "",
+            "headers": [(name.encode(), value.encode()) for name, value in headers],
+            "server": ("localhost", 80), "client": ("127.0.0.1", 5000),
+        }
+        asyncio.run(app(scope, receive, record))
+        start = messages[0]
+        assert start["type"] == "http.response.start"
+        return (
+            start["status"],
+            {name.decode(): value.decode() for name, value in start["headers"]},
+            b"".join(message.get("body", b"") for message in messages[1:]),
+        )
+
+    def test_same_responses(self, client):
+        app = AsgiApp(client.application, threads=2)
+        for path, query in (
+            ("/api/widgets/1/", b""), ("/api/users/1/widgets/", b"limit=all"),
+            ("/api/widgets/", b"q=hello&sort=-name"), ("/api/widgets/99/", b""),
+            ("/api/widgets/1/content/", b""),
+        ):
+            status, headers, body = self._request(app, "GET", path, query)
+            resp = client.get(path, query_string=query.decode())
+            assert status == resp.status_code
+            assert body == resp.data
+            assert headers["content-type"] == resp.headers["Content-Type"]
+
+    def test_conditional_and_writes(self, client):
+        app = AsgiApp(client.application, threads=2)
+        status, headers, body = self._request(app, "GET", "/api/widgets/1/")
+        status, _, body = self._request(
+            app, "GET", "/api/widgets/1/", headers=[("If-None-Match", headers["etag"])]
+        )
+        assert status == 304 and body == b""
+
+        document = json.dumps(_get_widget_json(2)).encode()
+        status, headers, _ = self._request(
+            app, "POST", "/api/users/1/widgets/", body=document,
+            headers=[("Content-Type", "application/json")]
+        )
+        assert status == 201
+        assert headers["location"].endswith("/api/widgets/2/")
+        status, _, body = self._request(app, "GET", "/api/widgets/2/")
+        assert status == 200
+        assert json.loads(body)["name"] == "test-widget-2"
+
+    def test_client_disconnects(self, client):
+        for number in range(2, 40):
+            client.post("/api/users/1/widgets/", json=_get_widget_json(number))
+        app = AsgiApp(client.application, threads=1, queue_chunks=1)
+
+        async def fail(message):
+            if message["type"] == "http.response.body":
+                raise OSError("connection reset")
+
+        with pytest.raises(OSError):
+            self._request(
+                app, "GET", "/api/widgets/", b"limit=all&fields=id,content", send=fail
+            )
+        # the only thread was given back and its session released
+        status, _, body = self._request(app, "GET", "/api/widgets/", b"limit=all")
+        assert status == 200
+        assert len(json.loads(body)["items"]) == 39
+
+
+class TestGroupCommit(object):
+
+    def setup_method(self, method):
+        self.directory = tempfile.mkdtemp()
+        db_fd, self.db_fname = tempfile.mkstemp()
+        os.close(db_fd)
+        self.app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + self.db_fname,
+            "METRICS_DIR": self.directory,
+            "BLOB_DIR": self.directory,
+            "GROUP_COMMIT_WINDOW": 0.05,
+            "TESTING": True,
+        })
+        with self.app.app_context():
+            db.create_all()
+            _populate_db()
+        self.commits = []
+        event.listen(
+            self.app.extensions["group_commit"].engine, "commit",
+            lambda conn: self.commits.append(conn)
+        )
+
+    def teardown_method(self, method):
+        self.app.extensions["group_commit"].connection.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.db_fname + suffix):
+                os.unlink(self.db_fname + suffix)
+        shutil.rmtree(self.directory)
+
+    def _concurrently(self, requests):
+        """
+        Sends the given (method, url, document) requests from a thread each
+        and returns the responses in the same order.
+        """
+
+        barrier = threading.Barrier(len(requests))
+
+        def send(method, url, document):
+            client = self.app.test_client()
+            barrier.wait()
+            return client.open(url, method=method, json=document)
+
+        with futures.ThreadPoolExecutor(len(requests)) as executor:
+            return list(executor.map(lambda args: send(*args), requests))
+
+    def test_disabled_by_default(self, client):
+        assert "group_commit" not in client.application.extensions
+
+    def test_concurrent_writes(self):
+        responses = self._concurrently([
+            ("POST", "/api/users/1/widgets/", _get_widget_json(number))
+            for number in range(2, 22)
+        ])
+        assert [resp.status_code for resp in responses] == [201] * 20
+        # fewer transactions than writes
+        assert 0 < len(self.commits) < 20
+
+        client = self.app.test_client()
+        resp = client.get("/api/widgets/", query_string={"limit": "all"})
+        names = {item["name"] for item in json.loads(resp.data)["items"]}
+        assert names == {f'test-widget-{number}' for number in range(1, 22)}
+
+    def test_conflicts_stay_with_their_request(self):
+        requests = [
+            ("POST", "/api/users/", dict(_get_user_json(number), id=str(number)))
+            for number in range(3, 13)
+        ]
+        # id 1 is taken
+        requests[4] = ("POST", "/api/users/", dict(_get_user_json(7), id="1"))
+        responses = self._concurrently(requests)
+        statuses = [resp.status_code for resp in responses]
+        assert statuses == [201] * 4 + [409] + [201] * 5
+
+        client = self.app.test_client()
+        resp = client.get("/api/users/", query_string={"limit": "all"})
+        ids = sorted(item["id"] for item in json.loads(resp.data)["items"])
+        assert ids == [1, 2, 3, 4, 5, 6, 8, 9, 10, 11, 12]
+        resp = client.get("/api/users/1/")
+        assert json.loads(resp.data)["name"] == "test-user-1"
+
+    def test_writes_after_commit(self):
+        client = self.app.test_client()
+        self.app.config["BLOB_INLINE_MAX"] = 1024
+        store = self.app.extensions["blob_store"]
+        resp = client.get("/api/widgets/1/")
+        assert json.loads(resp.data)["name"] == "test-widget-1"
+
+        document = _get_widget_json(1)
+        document["content"] = "<p>" + "x" * 5000 + "</p>"
+        digest = hashlib.sha256(document["content"].encode("utf-8")).hexdigest()
+        resp = client.put("/api/widgets/1/", json=document)
+        assert resp.status_code == 204
+        assert os.path.exists(store.path(digest))
+        # the cached representation was dropped once the batch was committed
+        resp = client.get("/api/widgets/1/")
+        assert json.loads(resp.data)["content"] == document["content"]
+
+        resp = client.delete("/api/widgets/1/")
+        assert resp.status_code == 204
+        assert not os.path.exists(store.path(digest))
+        assert client.get("/api/widgets/1/").status_code == 404
+        # files of requests rolled back inside a batch are removed with it
+        resp = client.post("/api/users/1/widgets/", json=_get_widget_json(2))
+        document = _get_widget_json(3)
+        document["id"] = resp.headers["Location"].rstrip("/").rsplit("/", 1)[1]
+        document["content"] = "b" * 5000
+        assert client.post("/api/users/1/widgets/", json=document).status_code == 409
+        # the batch ends a window after the request left it
+        time.sleep(0.2)
+        digest = hashlib.sha256(document["content"].encode("utf-8")).hexdigest()
+        assert not os.path.exists(store.path(digest))
+
+        # requests that wrote nothing don't wait for a commit
+        commits = len(self.commits)
+        assert client.delete("/api/widgets/99/").status_code == 404
+        assert len(self.commits) == commits